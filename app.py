@@ -1,24 +1,393 @@
-from flask import Flask, render_template, redirect, url_for, flash, request, session, g
+from flask import (Flask, Request, Response, render_template, redirect, url_for, flash, request, session, g,
+                   jsonify, send_file, stream_with_context)
+from markupsafe import escape
+from werkzeug.middleware.proxy_fix import ProxyFix
 import sqlite3
-import hashlib
 from datetime import datetime
+import base64
+import functools
+import heapq
+import json
 import os
 import re
+import threading
+import time
+
+import backup
+import community_cache
+import db_stats
+import export
+import live
+import maintenance
+import media
+import moderation
+import notifications
+import passwords
+import profiles
+import profiling
+import query_cache
+import ratelimit
+import repository
+import revisions
+import rollups
+import sharding
+import simhash
+import startup
+import trending
+
+
+class MediaRequest(Request):
+    """Файлы multipart пишутся сразу во временный файл хранилища медиа, SHA-256
+    считается по ходу записи (см. media.py)"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return media.storage.upload_file()
+
 
 app = Flask(__name__)
+app.request_class = MediaRequest
 app.config['SECRET_KEY'] = 'your-secret-key-here-change-in-production'
 app.config['DATABASE'] = 'instance/app.db'
+# Количество шардов для posts/comments/votes (None - прочитать из базы, 0 - один файл)
+app.config['DB_SHARDS'] = None
+# Резервные копии: каталог, период фонового копирования в секундах (0 - выключено), сколько хранить
+app.config['BACKUP_DIR'] = 'instance/backups'
+app.config['BACKUP_INTERVAL'] = 0
+app.config['BACKUP_KEEP'] = 7
+# Бюджет времени SQL на запрос (секунды) для тяжелых маршрутов
+app.config['QUERY_BUDGETS'] = {
+    'search_posts': 0.5,
+    'search_communities': 0.5,
+    'debug_database': 2.0,
+}
+# Сколько запросов к одному тяжелому маршруту выполняется одновременно, остальные получают 503
+app.config['EXPENSIVE_CONCURRENCY'] = 4
+app.config['RETRY_AFTER'] = 2
+# Размер кэша результатов запросов в байтах (0 - выключен)
+app.config['QUERY_CACHE_BYTES'] = 8 * 1024 * 1024
+# Живые обновления (SSE): пауза для склейки событий, период heartbeat, лимиты
+app.config['LIVE_COALESCE'] = 0.3
+app.config['LIVE_HEARTBEAT'] = 15
+app.config['LIVE_MAX_CONNECTIONS'] = 500
+app.config['LIVE_MAX_POSTS'] = 100
+# JSON API: размер страницы по умолчанию и максимумы для JSON и потокового NDJSON
+app.config['API_DEFAULT_LIMIT'] = 25
+app.config['API_MAX_LIMIT'] = 100
+app.config['API_MAX_NDJSON_LIMIT'] = 10000
+# Размер порции строк при выгрузке данных
+app.config['EXPORT_CHUNK_SIZE'] = 500
+# Статистика базы: кто видит /debug/* (пусто - любой вошедший), как долго кэшировать
+# размеры из dbstat, с какой длительности запрос попадает в список медленных
+app.config['ADMIN_USERNAMES'] = ()
+app.config['DB_STATS_SIZE_TTL'] = 60
+app.config['SLOW_QUERY_SECONDS'] = 0.05
+# Фоновое обслуживание базы: включено ли, расписание задач (период в секундах и окно
+# 'HH:MM'-'HH:MM' или None) и бюджет времени одной задачи на файл
+app.config['MAINTENANCE_ENABLED'] = False
+app.config['MAINTENANCE_TASKS'] = {
+    'vacuum': {'every': 600, 'window': ('02:00', '06:00')},
+    'optimize': {'every': 3600, 'window': ('02:00', '06:00')},
+    'rollups': {'every': 3600, 'window': None},
+    'trending': {'every': 3600, 'window': None},
+    'notifications': {'every': 86400, 'window': None},
+    'media': {'every': 3600, 'window': None},
+}
+app.config['MAINTENANCE_BUDGET'] = 0.2
+# Сообщества в тренде: как часто пересчитывать рейтинг (секунды) и сколько хранить
+app.config['TRENDING_REFRESH'] = 300
+app.config['TRENDING_SIZE'] = 10
+# Почти одинаковые посты: максимальное число различающихся битов SimHash (0..3)
+# и что делать с найденным дубликатом - 'flag' (пометить) или 'reject' (не создавать)
+app.config['DUPLICATE_MAX_DISTANCE'] = 3
+app.config['DUPLICATE_ACTION'] = 'flag'
+# Уведомления: сколько событий копить до записи пачкой и сколько секунд ждать
+app.config['NOTIFY_BATCH_SIZE'] = 100
+app.config['NOTIFY_FLUSH_DELAY'] = 1.0
+# Хэширование паролей: схема и параметры (None - по умолчанию для схемы), число
+# процессов, сколько паролей может ждать в очереди и сколько секунд ждать результат
+app.config['PASSWORD_SCHEME'] = 'scrypt'
+app.config['PASSWORD_PARAMS'] = None
+app.config['PASSWORD_WORKERS'] = 2
+app.config['PASSWORD_QUEUE'] = 32
+app.config['PASSWORD_TIMEOUT'] = 5.0
+# Байткод-кэш скомпилированных шаблонов, общий для процессов (None - без кэша)
+app.config['TEMPLATE_CACHE_DIR'] = 'instance/jinja_cache'
+# Профилирование: маршруты (имена view-функций), которые профилируются всегда,
+# и доля остальных запросов; меняется и на /debug/profile
+app.config['PROFILE_ROUTES'] = ()
+app.config['PROFILE_SAMPLE_RATE'] = 0.0
+# Кэш метаданных сообществ: число записей, время жизни записи (секунды) и сколько
+# самых популярных сообществ загрузить при старте
+app.config['COMMUNITY_CACHE_SIZE'] = 1024
+app.config['COMMUNITY_CACHE_TTL'] = 300
+app.config['COMMUNITY_CACHE_WARM'] = 100
+# Заголовки кэширования блоков боковой панели (/fragments/<name>)
+app.config['FRAGMENT_CACHE_CONTROL'] = {
+    'trending': 'public, max-age=300',
+    'popular-communities': 'public, max-age=60',
+    'user-stats': 'private, max-age=15',
+}
+# Записей ленты активности на странице профиля
+app.config['USER_ACTIVITY_PAGE_SIZE'] = 20
+# Изображения постов: каталог хранилища, размер файла, файлов на пост, через сколько
+# секунд удалять файлы без ссылок и max-age ответа (имя файла - его SHA-256)
+app.config['MEDIA_DIR'] = 'instance/media'
+app.config['MEDIA_MAX_BYTES'] = 16 * 1024 * 1024
+app.config['MEDIA_MAX_FILES'] = 4
+app.config['MEDIA_ORPHAN_GRACE'] = 3600
+app.config['MEDIA_MAX_AGE'] = 365 * 24 * 3600
+app.config['MAX_CONTENT_LENGTH'] = app.config['MEDIA_MAX_FILES'] * app.config['MEDIA_MAX_BYTES'] + 1024 * 1024
+# Лимиты записи (token bucket): (запросов, за сколько секунд) на пользователя и на IP, None - без
+# лимита. Ведра лежат в отдельном файле, общем для всех процессов
+app.config['RATE_LIMIT_DATABASE'] = 'instance/ratelimit.db'
+app.config['RATE_LIMITS'] = {
+    'vote_post': {'user': (60, 60), 'ip': (300, 60)},
+    'add_comment': {'user': (10, 60), 'ip': (60, 60)},
+    'create_post': {'user': (10, 600), 'ip': (30, 600)},
+    'toggle_bookmark': {'user': (60, 60), 'ip': (300, 60)},
+    'register': {'user': None, 'ip': (10, 3600)},
+}
+# Сколько обратных прокси стоит перед приложением. Их X-Forwarded-For считается достоверным,
+# и лимиты на IP считаются по адресу клиента, а не прокси (0 - приложение открыто напрямую)
+app.config['TRUSTED_PROXIES'] = 0
+
+startup.configure_template_cache(app, app.config['TEMPLATE_CACHE_DIR'])
+
+if app.config['TRUSTED_PROXIES']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'])
+
+# Счетчики сброшенных (shed) и прерванных по бюджету (aborted) запросов
+load_stats = {'shed': 0, 'aborted': 0}
+_load_lock = threading.Lock()
+_expensive_slots = {}
+
+result_cache = query_cache.QueryCache(app.config['QUERY_CACHE_BYTES'])
+
+live_hub = live.Hub(max_connections=app.config['LIVE_MAX_CONNECTIONS'],
+                    max_posts=app.config['LIVE_MAX_POSTS'])
+
+db_stats.slow_queries.threshold = app.config['SLOW_QUERY_SECONDS']
+
+media.storage.root = app.config['MEDIA_DIR']
+media.storage.max_bytes = app.config['MEDIA_MAX_BYTES']
+media.storage.grace = app.config['MEDIA_ORPHAN_GRACE']
+
+trending_cache = trending.TrendingCache(refresh=app.config['TRENDING_REFRESH'],
+                                        k=app.config['TRENDING_SIZE'])
+
+notification_queue = notifications.NotificationQueue(
+    lambda: sqlite3.connect(app.config['DATABASE'], timeout=5),
+    batch_size=app.config['NOTIFY_BATCH_SIZE'], delay=app.config['NOTIFY_FLUSH_DELAY'])
+
+password_pool = passwords.HashPool(app.config['PASSWORD_SCHEME'], app.config['PASSWORD_PARAMS'],
+                                   workers=app.config['PASSWORD_WORKERS'],
+                                   max_queue=app.config['PASSWORD_QUEUE'],
+                                   timeout=app.config['PASSWORD_TIMEOUT'])
+
+community_meta = community_cache.CommunityCache(app.config['COMMUNITY_CACHE_SIZE'],
+                                                app.config['COMMUNITY_CACHE_TTL'])
+
+route_profiler = profiling.RouteProfiler(app.config['PROFILE_ROUTES'], app.config['PROFILE_SAMPLE_RATE'])
+
+rate_limiter = ratelimit.RateLimiter(app.config['RATE_LIMIT_DATABASE'])
 
 
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(app.config['DATABASE'])
+        g.db = sqlite3.connect(app.config['DATABASE'], factory=query_cache.CacheConnection)
         g.db.row_factory = sqlite3.Row
+        install_query_budget(g.db)
     return g.db
 
 
+def get_shard_count():
+    """Количество шардов, записанное в базе командой sharding.py reshard"""
+    if app.config['DB_SHARDS'] is None:
+        app.config['DB_SHARDS'] = sharding.read_shard_count(get_db())
+    return app.config['DB_SHARDS']
+
+
+def get_shard_db(shard):
+    """Соединение с шардом (основная база подключена к нему через ATTACH)"""
+    if 'shard_dbs' not in g:
+        g.shard_dbs = {}
+    if shard not in g.shard_dbs:
+        conn = sharding.connect_shard(app.config['DATABASE'], shard, factory=query_cache.CacheConnection)
+        conn.cache_label = f'shard{shard}'
+        conn.generations_sql = f'''
+            SELECT name, generation FROM {sharding.COMMON_SCHEMA}.table_generations
+            UNION ALL
+            SELECT name, generation FROM main.table_generations
+        '''
+        install_query_budget(conn)
+        g.shard_dbs[shard] = conn
+    return g.shard_dbs[shard]
+
+
+def install_query_budget(conn):
+    """Прерывает SQL на соединении, когда у запроса кончился бюджет времени"""
+    deadline = g.get('query_deadline')
+    if deadline is not None:
+        conn.set_progress_handler(lambda: time.monotonic() > deadline, 1000)
+
+
+def count_load(stat):
+    with _load_lock:
+        load_stats[stat] += 1
+
+
+def overloaded():
+    return ('Сервер перегружен, попробуйте позже', 503,
+            {'Retry-After': str(app.config['RETRY_AFTER'])})
+
+
+def expensive(view):
+    """Ограничивает время SQL и число одновременных запросов тяжелого маршрута.
+
+    Вместо очереди лишние запросы сразу получают 503 с Retry-After.
+    """
+    name = view.__name__
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        with _load_lock:
+            if name not in _expensive_slots:
+                _expensive_slots[name] = threading.BoundedSemaphore(app.config['EXPENSIVE_CONCURRENCY'])
+            slots = _expensive_slots[name]
+
+        if not slots.acquire(blocking=False):
+            count_load('shed')
+            return overloaded()
+
+        try:
+            g.query_deadline = time.monotonic() + app.config['QUERY_BUDGETS'].get(name, 1.0)
+            for conn in [g.get('db')] + list(g.get('shard_dbs', {}).values()):
+                if conn is not None:
+                    install_query_budget(conn)
+            return view(*args, **kwargs)
+        except sqlite3.OperationalError as e:
+            if 'interrupted' not in str(e):
+                raise
+            count_load('aborted')
+            return overloaded()
+        finally:
+            g.pop('query_deadline', None)
+            slots.release()
+
+    return wrapper
+
+
+def rate_limited(*methods):
+    """Ограничивает частоту запросов маршрута (RATE_LIMITS) для перечисленных методов.
+
+    Сверх лимита запрос получает 429 с Retry-After и не доходит до базы.
+    """
+    def decorator(view):
+        name = view.__name__
+
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            limits = app.config['RATE_LIMITS'].get(name)
+            if limits and request.method in methods:
+                wait = rate_limiter.check(name, limits, session.get('user_id'), request.remote_addr)
+                if wait:
+                    return ('Слишком много запросов, попробуйте позже', 429, {'Retry-After': str(wait)})
+            return view(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def get_community_db(community_id):
+    """Соединение, в котором лежат посты сообщества"""
+    shard_count = get_shard_count()
+    if not shard_count:
+        return get_db()
+    return get_shard_db(sharding.shard_for(community_id, shard_count))
+
+
+def get_post_db(post_id):
+    """Соединение, в котором лежит пост (и его комментарии и голоса)"""
+    if not get_shard_count():
+        return get_db()
+    row = get_db().execute(
+        'SELECT community_id FROM post_shards WHERE post_id = ?', (post_id,)
+    ).fetchone()
+    return get_community_db(row['community_id'] if row else None)
+
+
+def main_schema():
+    """Имя основной базы в соединении с постами: при шардировании она подключена через ATTACH"""
+    return sharding.COMMON_SCHEMA if get_shard_count() else 'main'
+
+
+def get_post_dbs():
+    """Все соединения, в которых лежат посты"""
+    shard_count = get_shard_count()
+    if not shard_count:
+        return [get_db()]
+    return [get_shard_db(shard) for shard in range(shard_count)]
+
+
+def query_posts(fetch, key=None, limit=None):
+    """Вызывает fetch(db) для каждого шарда и сливает отсортированные результаты.
+
+    fetch должен возвращать строки, отсортированные по key (по убыванию) и ограниченные limit.
+    """
+    dbs = get_post_dbs()
+    if len(dbs) == 1:
+        return fetch(dbs[0])
+    return sharding.merge_sorted([fetch(db) for db in dbs], key=key, limit=limit)
+
+
+def get_user_votes(user_id):
+    """Голоса пользователя во всех шардах: {post_id: vote_type}"""
+    user_votes = {}
+    for db in get_post_dbs():
+        for vote in db.execute('SELECT post_id, vote_type FROM votes WHERE user_id = ?', (user_id,)):
+            user_votes[vote['post_id']] = vote['vote_type']
+    return user_votes
+
+
+def by_created_at(row):
+    return row.created_at, row.id
+
+
+def by_activity(row):
+    return row.created_at, row.kind, row.id
+
+
+def by_score(row):
+    return row.score, row.created_at, row.id
+
+
+def by_window_score(row):
+    return row.window_score, row.id
+
+
+def by_bookmarked_at(row):
+    return row.bookmarked_at, row.id
+
+
+def publish_post_counters(event, db, post_id):
+    """Отправляет подписчикам SSE актуальные счетчики поста"""
+    post = db.execute(
+        'SELECT upvotes, downvotes, comments_count FROM posts WHERE id = ?', (post_id,)
+    ).fetchone()
+    if post:
+        live_hub.publish(event, post_id, {
+            'post_id': post_id,
+            'upvotes': post['upvotes'],
+            'downvotes': post['downvotes'],
+            'score': post['upvotes'] - post['downvotes'],
+            'comments_count': post['comments_count'],
+        })
+
+
 def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
+    """Хэш пароля из пула процессов (PoolBusy, если пул переполнен)"""
+    return password_pool.hash(password)
 
 
 def validate_community_name(name):
@@ -61,48 +430,18 @@ def is_subscribed_to_community(user_id, community_id):
     return cursor.fetchone() is not None
 
 
-def check_and_create_tables():
-    """Проверяет и создает недостающие таблицы"""
-    db = get_db()
-    cursor = db.cursor()
+@app.before_request
+def start_profiling():
+    # Выключенный профилировщик стоит одной проверки
+    if route_profiler.active and request.endpoint:
+        g.profile = route_profiler.start(request.endpoint)
 
-    try:
-        # Проверяем существование таблицы bookmarks
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='bookmarks'")
-        if not cursor.fetchone():
-            cursor.execute('''
-            CREATE TABLE bookmarks (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                post_id INTEGER NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(user_id, post_id),
-                FOREIGN KEY (user_id) REFERENCES users (id),
-                FOREIGN KEY (post_id) REFERENCES posts (id)
-            )
-            ''')
-            print("Таблица bookmarks создана!")
-
-        # Проверяем существование таблицы communities
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='communities'")
-        if not cursor.fetchone():
-            cursor.execute('''
-            CREATE TABLE communities (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT UNIQUE NOT NULL,
-                display_name TEXT NOT NULL,
-                description TEXT,
-                owner_id INTEGER NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                subscribers_count INTEGER DEFAULT 0,
-                is_public BOOLEAN DEFAULT 1,
-                FOREIGN KEY (owner_id) REFERENCES users (id)
-            )
-            ''')
-            print("Таблица communities создана!")
 
-    except Exception as e:
-        print(f"Ошибка при проверке таблиц: {e}")
+@app.teardown_request
+def stop_profiling(error):
+    profile = g.pop('profile', None)
+    if profile is not None:
+        route_profiler.stop(request.endpoint, profile)
 
 
 @app.teardown_appcontext
@@ -111,6 +450,9 @@ def close_db(error):
     if db is not None:
         db.close()
 
+    for shard_db in g.pop('shard_dbs', {}).values():
+        shard_db.close()
+
 
 @app.context_processor
 def utility_processor():
@@ -126,40 +468,49 @@ def utility_processor():
         )
         return cursor.fetchone() is not None
 
-    def get_popular_communities():
-        db = get_db()
-        cursor = db.cursor()
-        cursor.execute('''
-            SELECT c.*, COUNT(cs.id) as subscribers
-            FROM communities c
-            LEFT JOIN community_subscriptions cs ON c.id = cs.community_id
-            GROUP BY c.id
-            ORDER BY subscribers DESC, c.created_at DESC
-            LIMIT 10
-        ''')
-        return cursor.fetchall()
-
-    def get_user_subscriptions_count():
+    def get_unread_notifications():
+        # Счетчик поддерживается при записи уведомлений - здесь только чтение строки пользователя
         if 'user_id' not in session:
             return 0
-
-        db = get_db()
-        cursor = db.cursor()
-        cursor.execute(
-            'SELECT COUNT(*) as count FROM community_subscriptions WHERE user_id = ?',
-            (session['user_id'],)
-        )
-        return cursor.fetchone()['count']
+        return notifications.unread_count(get_db(), session['user_id'])
 
     return dict(
         is_bookmarked=is_bookmarked,
-        get_popular_communities=get_popular_communities,
-        get_user_subscriptions_count=get_user_subscriptions_count
+        get_unread_notifications=get_unread_notifications
     )
 
 
+# Блоки боковой панели: страница загружает их после своего контента, а браузер
+# и прокси кэшируют каждый отдельно по FRAGMENT_CACHE_CONTROL
+@app.route('/fragments/<name>')
+def sidebar_fragment(name):
+    if name == 'trending':
+        html = render_template('fragments/trending.html', communities=trending_cache.top(get_db(), 5))
+    elif name == 'popular-communities':
+        communities = repository.communities_listing(get_db(), cache=result_cache)[:10]
+        html = render_template('fragments/popular_communities.html', communities=communities)
+    elif name == 'user-stats':
+        if 'user_id' not in session:
+            return '', 204
+        subscriptions_count = get_db().execute(
+            'SELECT COUNT(*) FROM community_subscriptions WHERE user_id = ?', (session['user_id'],)
+        ).fetchone()[0]
+        # Карма - чтение по первичному ключу user_counters в каждой базе постов
+        karma = repository.user_counters(get_post_dbs(), session['user_id'], cache=result_cache).karma
+        html = render_template('fragments/user_stats.html', subscriptions_count=subscriptions_count, karma=karma)
+    else:
+        return 'Блок не найден', 404
+
+    response = app.make_response(html)
+    response.headers['Cache-Control'] = app.config['FRAGMENT_CACHE_CONTROL'][name]
+    # ETag позволяет перепроверить устаревший блок ответом 304 без тела
+    response.add_etag()
+    return response.make_conditional(request)
+
+
 # Поиск постов
 @app.route('/search')
+@expensive
 def search_posts():
     query = request.args.get('q', '').strip()
 
@@ -170,27 +521,13 @@ def search_posts():
     cursor = db.cursor()
 
     # Поиск по заголовку и содержимому
-    search_pattern = f'%{query}%'
-
-    cursor.execute('''
-        SELECT p.*, u.username, c.name as community_name, c.display_name as community_display_name,
-               (p.upvotes - p.downvotes) as score
-        FROM posts p
-        JOIN users u ON p.user_id = u.id
-        LEFT JOIN communities c ON p.community_id = c.id
-        WHERE p.title LIKE ? OR p.content LIKE ?
-        ORDER BY p.created_at DESC
-        LIMIT 50
-    ''', (search_pattern, search_pattern))
-
-    posts = cursor.fetchall()
+    posts = query_posts(lambda shard_db: repository.search_posts(shard_db, query, 50, cache=result_cache),
+                        key=by_created_at, limit=50)
 
     # Проверяем, голосовал ли пользователь
     user_votes = {}
     if 'user_id' in session:
-        cursor.execute('SELECT post_id, vote_type FROM votes WHERE user_id = ?', (session['user_id'],))
-        votes = cursor.fetchall()
-        user_votes = {vote['post_id']: vote['vote_type'] for vote in votes}
+        user_votes = get_user_votes(session['user_id'])
 
     # Проверяем закладки
     user_bookmarks = set()
@@ -212,43 +549,15 @@ def index():
     db = get_db()
     cursor = db.cursor()
 
-    # Проверяем и создаем недостающие таблицы
-    check_and_create_tables()
-
-    # Отладка
-    print(f"\n=== DEBUG INDEX PAGE ===")
-    print(f"Session user_id: {session.get('user_id')}")
-    print(f"Session username: {session.get('username')}")
-
     # Всегда показываем ВСЕ посты, отсортированные по дате
-    cursor.execute('''
-        SELECT p.*, u.username, c.name as community_name, c.display_name as community_display_name,
-               (p.upvotes - p.downvotes) as score
-        FROM posts p
-        JOIN users u ON p.user_id = u.id
-        LEFT JOIN communities c ON p.community_id = c.id
-        ORDER BY p.created_at DESC
-        LIMIT 20
-    ''')
-
-    posts = cursor.fetchall()
-    print(f"DEBUG: Found {len(posts)} posts in database")
-
-    if posts:
-        print("DEBUG: Post details:")
-        for post in posts:
-            print(
-                f"  - ID: {post['id']}, Title: '{post['title'][:30]}...', User: {post['username']}, Created: {post['created_at']}")
+    posts = query_posts(lambda shard_db: repository.latest_posts(shard_db, 20), key=by_created_at, limit=20)
 
     # Проверяем, голосовал ли текущий пользователь за посты
     user_votes = {}
     if 'user_id' in session:
-        cursor.execute('''
-            SELECT post_id, vote_type FROM votes 
-            WHERE user_id = ?
-        ''', (session['user_id'],))
-        votes = cursor.fetchall()
-        user_votes = {vote['post_id']: vote['vote_type'] for vote in votes}# Проверяем, добавлены ли посты в закладки
+        user_votes = get_user_votes(session['user_id'])
+
+    # Проверяем, добавлены ли посты в закладки
     user_bookmarks = set()
     if 'user_id' in session:
         cursor.execute('''
@@ -263,6 +572,7 @@ def index():
 
 # Регистрация
 @app.route('/register', methods=['GET', 'POST'])
+@rate_limited('POST')
 def register():
     if 'user_id' in session:
         return redirect(url_for('index'))
@@ -294,7 +604,11 @@ def register():
             return redirect(url_for('register'))
 
         # Создание пользователя
-        password_hash = hash_password(password)
+        try:
+            password_hash = hash_password(password)
+        except passwords.PoolBusy:
+            count_load('shed')
+            return overloaded()
         cursor.execute(
             'INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)',
             (username, email, password_hash)
@@ -326,7 +640,19 @@ def login():
         )
         user = cursor.fetchone()
 
-        if user and user['password_hash'] == hash_password(password):
+        try:
+            valid = password_pool.verify(password, user['password_hash'] if user else None)
+            # Хэш старой схемы или с прежними параметрами пересчитывается при входе
+            new_hash = password_pool.upgrade(password, user['password_hash']) if valid else None
+        except passwords.PoolBusy:
+            count_load('shed')
+            return overloaded()
+
+        if new_hash:
+            cursor.execute('UPDATE users SET password_hash = ? WHERE id = ?', (new_hash, user['id']))
+            db.commit()
+
+        if valid:
             session['user_id'] = user['id']
             session['username'] = user['username']
             flash('Вход выполнен успешно!', 'success')
@@ -360,6 +686,7 @@ def privacy_policy():
 
 # Создание поста
 @app.route('/create', methods=['GET', 'POST'])
+@rate_limited('POST')
 def create_post():
     if 'user_id' not in session:
         flash('Для создания поста необходимо войти в систему', 'warning')
@@ -381,34 +708,93 @@ def create_post():
         content = request.form['content'].strip()
         post_type = request.form.get('post_type', 'text')
         community_id = request.form.get('community_id', '')
+        uploads = [f for f in request.files.getlist('images') if f.filename]
 
-        if not title or not content:
+        # У поста-изображения текст - необязательная подпись
+        if not title or not (content or post_type == 'image' and uploads):
             flash('Заполните все обязательные поля', 'danger')
             return redirect(url_for('create_post'))
 
+        if uploads and post_type not in ('image', 'link'):
+            flash('Изображения можно прикладывать только к постам-изображениям и ссылкам', 'danger')
+            return redirect(url_for('create_post'))
+
+        if len(uploads) > app.config['MEDIA_MAX_FILES']:
+            flash(f"Не больше {app.config['MEDIA_MAX_FILES']} изображений на пост", 'danger')
+            return redirect(url_for('create_post'))
+
         # Проверяем, существует ли сообщество, если указано
         if community_id:
-            cursor.execute('SELECT id, name FROM communities WHERE id = ?', (community_id,))
-            community = cursor.fetchone()
+            community = community_meta.by_id(db, int(community_id)) if community_id.isdigit() else None
             if not community:
                 flash('Указанное сообщество не существует', 'danger')
                 return redirect(url_for('create_post'))
+            if moderation.is_banned(db, community.id, session['user_id']):
+                flash('Вы забанены в этом сообществе', 'danger')
+                return redirect(url_for('create_post'))
+
+        community_id = community_id if community_id else None
+
+        # Почти одинаковый пост ищется по индексу полос отпечатка в основной базе
+        fingerprint = simhash.fingerprint(title, content)
+        duplicate = None
+        if fingerprint is None:
+            simhash.count('skipped')
+        else:
+            duplicate = simhash.find_duplicate(db, fingerprint, app.config['DUPLICATE_MAX_DISTANCE'])
+            if duplicate and app.config['DUPLICATE_ACTION'] == 'reject':
+                simhash.count('rejected')
+                flash('Такой пост уже есть', 'danger')
+                return redirect(url_for('post_detail', post_id=duplicate[0]))
+
+        # Файлы уже на диске (их записал разбор запроса): переносим в хранилище до
+        # транзакции поста; если она не пройдет, файлы без ссылок удалит media.collect
+        try:
+            media_files = [media.storage.save(upload) for upload in uploads]
+        except ValueError as e:
+            flash(str(e), 'danger')
+            return redirect(url_for('create_post'))
+
+        post_db = get_community_db(community_id)
 
         try:
+            # При шардировании id выдает глобальный реестр post_shards, запись
+            # в реестр и в шард идет одной транзакцией через ATTACH
+            post_id = None
+            if get_shard_count():
+                post_id = post_db.execute(
+                    f'INSERT INTO {sharding.COMMON_SCHEMA}.post_shards (community_id) VALUES (?)',
+                    (community_id,)
+                ).lastrowid
+
             # Создание поста
-            cursor.execute(
-                'INSERT INTO posts (title, content, user_id, post_type, community_id) VALUES (?, ?, ?, ?, ?)',
-                (title, content, session['user_id'], post_type, community_id if community_id else None)
+            cursor = post_db.execute(
+                'INSERT INTO posts (id, title, content, user_id, post_type, community_id) VALUES (?, ?, ?, ?, ?, ?)',
+                (post_id, title, content, session['user_id'], post_type, community_id)
             )
             post_id = cursor.lastrowid
 
-            db.commit()
+            profiles.add(post_db, session['user_id'], posts=1)
+
+            schema = main_schema()
+
+            if fingerprint is not None:
+                simhash.record(post_db, post_id, fingerprint, duplicate, schema)
+
+            media.storage.attach(post_db, post_id, media_files, schema)
+
+            post_db.commit()
 
         except Exception as e:
-            db.rollback()
+            post_db.rollback()
             flash(f'Ошибка при создании поста: {str(e)}', 'danger')
             return redirect(url_for('create_post'))
 
+        live_hub.publish('post', post_id, {'post_id': post_id, 'title': title})
+
+        if duplicate:
+            simhash.count('flagged')
+
         flash('Пост создан успешно!', 'success')
         return redirect(url_for('index'))
 
@@ -442,8 +828,7 @@ def create_community():
         cursor = db.cursor()
 
         # Проверка существования сообщества
-        cursor.execute('SELECT id FROM communities WHERE name = ?', (name,))
-        if cursor.fetchone():
+        if community_meta.by_name(db, name):
             flash('Сообщество с таким именем уже существует', 'danger')
             return redirect(url_for('create_community'))
 
@@ -465,8 +850,12 @@ def create_community():
             'UPDATE communities SET subscribers_count = subscribers_count + 1 WHERE id = ?',
             (community_id,)
         )
+        # Подписка создателя учитывается в трендах, как и любая другая: иначе его
+        # отписка оставила бы рост сообщества отрицательным
+        trending.record(cursor, community_id, joined=True)
 
         db.commit()
+        community_meta.invalidate(name=name)
 
         flash(f'Сообщество r/{name} создано успешно!', 'success')
         return redirect(url_for('community_detail', community_name=name))
@@ -481,14 +870,7 @@ def community_detail(community_name):
     cursor = db.cursor()
 
     # Получаем информацию о сообществе
-    cursor.execute('''
-        SELECT c.*, u.username as owner_name
-        FROM communities c
-        JOIN users u ON c.owner_id = u.id
-        WHERE c.name = ?
-    ''', (community_name,))
-
-    community = cursor.fetchone()
+    community = community_meta.by_name(db, community_name)
     if not community:
         flash('Сообщество не найдено', 'danger')
         return redirect(url_for('index'))
@@ -498,32 +880,23 @@ def community_detail(community_name):
     if 'user_id' in session:
         cursor.execute(
             'SELECT id FROM community_subscriptions WHERE user_id = ? AND community_id = ?',
-            (session['user_id'], community['id'])
+            (session['user_id'], community.id)
         )
         is_subscribed = cursor.fetchone() is not None
 
-    # Получаем посты сообщества
-    cursor.execute('''
-        SELECT p.*, u.username, 
-               (p.upvotes - p.downvotes) as score
-        FROM posts p
-        JOIN users u ON p.user_id = u.id
-        WHERE p.community_id = ?
-        ORDER BY p.created_at DESC
-        LIMIT 20
-    ''', (community['id'],))
-
-    posts = cursor.fetchall()
+    # Получаем посты сообщества (все они лежат в одном шарде): свежие или лучшие за период
+    top_window = request.args.get('t')
+    if top_window in rollups.TOP_WINDOWS:
+        posts = repository.community_top_posts(get_community_db(community.id), community.id,
+                                               rollups.window_start(top_window), 20)
+    else:
+        top_window = None
+        posts = repository.community_posts(get_community_db(community.id), community.id, 20)
 
     # Проверяем, голосовал ли текущий пользователь за посты
     user_votes = {}
     if 'user_id' in session:
-        cursor.execute('''
-            SELECT post_id, vote_type FROM votes 
-            WHERE user_id = ?
-        ''', (session['user_id'],))
-        votes = cursor.fetchall()
-        user_votes = {vote['post_id']: vote['vote_type'] for vote in votes}
+        user_votes = get_user_votes(session['user_id'])
 
     # Проверяем, добавлены ли посты в закладки
     user_bookmarks = set()
@@ -538,7 +911,7 @@ def community_detail(community_name):
     # Получаем количество подписчиков
     cursor.execute(
         'SELECT COUNT(*) as count FROM community_subscriptions WHERE community_id = ?',
-        (community['id'],)
+        (community.id,)
     )
     subscribers_count = cursor.fetchone()['count']
 
@@ -548,7 +921,8 @@ def community_detail(community_name):
                            user_votes=user_votes,
                            user_bookmarks=user_bookmarks,
                            is_subscribed=is_subscribed,
-                           subscribers_count=subscribers_count)
+                           subscribers_count=subscribers_count,
+                           top_window=top_window)
 
 
 # Подписка/отписка от сообщества
@@ -562,8 +936,7 @@ def toggle_subscription(community_name):
     cursor = db.cursor()
 
     # Получаем ID сообщества
-    cursor.execute('SELECT id FROM communities WHERE name = ?', (community_name,))
-    community = cursor.fetchone()
+    community = community_meta.by_name(db, community_name)
 
     if not community:
         flash('Сообщество не найдено', 'danger')
@@ -572,52 +945,93 @@ def toggle_subscription(community_name):
     # Проверяем, подписан ли уже пользователь
     cursor.execute(
         'SELECT id FROM community_subscriptions WHERE user_id = ? AND community_id = ?',
-        (session['user_id'], community['id'])
+        (session['user_id'], community.id)
     )
     subscription = cursor.fetchone()
 
+    if not subscription and moderation.is_banned(db, community.id, session['user_id']):
+        flash('Вы забанены в этом сообществе', 'danger')
+        return redirect(url_for('community_detail', community_name=community_name))
+
     if subscription:
         # Отписываемся
         cursor.execute(
             'DELETE FROM community_subscriptions WHERE user_id = ? AND community_id = ?',
-            (session['user_id'], community['id'])
+            (session['user_id'], community.id)
         )
         cursor.execute(
             'UPDATE communities SET subscribers_count = subscribers_count - 1 WHERE id = ?',
-            (community['id'],)
+            (community.id,)
         )
+        trending.record(cursor, community.id, joined=False)
         flash('Вы отписались от сообщества', 'info')
     else:
         # Подписываемся
         cursor.execute(
             'INSERT INTO community_subscriptions (user_id, community_id) VALUES (?, ?)',
-            (session['user_id'], community['id'])
+            (session['user_id'], community.id)
         )
         cursor.execute(
             'UPDATE communities SET subscribers_count = subscribers_count + 1 WHERE id = ?',
-            (community['id'],)
+            (community.id,)
         )
+        trending.record(cursor, community.id, joined=True)
         flash('Вы подписались на сообщество!', 'success')
 
     db.commit()
     return redirect(url_for('community_detail', community_name=community_name))
 
 
+# Очередь модерации сообщества (только для владельца)
+@app.route('/r/<string:community_name>/mod', methods=['GET', 'POST'])
+def moderation_queue(community_name):
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    community = community_meta.by_name(get_db(), community_name)
+    if not community:
+        flash('Сообщество не найдено', 'danger')
+        return redirect(url_for('index'))
+
+    if community.owner_id != session['user_id']:
+        flash('Модерация доступна только владельцу сообщества', 'danger')
+        return redirect(url_for('community_detail', community_name=community_name))
+
+    # kind: post, comment или user (список банов); removed - показывать удаленное
+    kind = request.values.get('kind', 'post')
+    if kind not in ('post', 'comment', 'user'):
+        kind = 'post'
+    removed = request.values.get('removed') == '1'
+    post_db = get_community_db(community.id)
+
+    if request.method == 'POST':
+        action = request.form.get('action')
+        ids = request.form.getlist('ids', type=int)
+        allowed = ('unban',) if kind == 'user' else ('remove', 'restore', 'ban')
+        if action not in allowed or not ids:
+            flash('Выберите записи и действие', 'warning')
+        else:
+            result = moderation.apply(post_db, community, action, kind, ids, session['user_id'], main_schema())
+            flash(f'Готово: {moderation.describe(result)}', 'success')
+        return redirect(url_for('moderation_queue', community_name=community_name, kind=kind,
+                                removed='1' if removed else None))
+
+    if kind == 'user':
+        items = moderation.bans(get_db(), community.id)
+    else:
+        items = moderation.queue(post_db, community.id, kind, removed)
+
+    return render_template('moderation_queue.html', community=community, kind=kind, removed=removed,
+                           items=items)
+
+
 # Список сообществ
 @app.route('/communities')
 def communities_list():
     db = get_db()
     cursor = db.cursor()
     # Получаем все сообщества с количеством подписчиков
-    cursor.execute('''
-            SELECT c.*, COUNT(cs.id) as subscribers_count
-            FROM communities c
-            LEFT JOIN community_subscriptions cs ON c.id = cs.community_id
-            GROUP BY c.id
-            ORDER BY subscribers_count DESC, c.created_at DESC
-        ''')
-
-    communities = cursor.fetchall()
+    communities = repository.communities_listing(db, cache=result_cache)
 
     # Проверяем подписки пользователя
     user_subscriptions = set()
@@ -630,6 +1044,7 @@ def communities_list():
 
     return render_template('communities_list.html',
                            communities=communities,
+                           trending_communities=trending_cache.top(db),
                            user_subscriptions=user_subscriptions)
 
 
@@ -660,35 +1075,21 @@ def my_communities():
 # Детали поста
 @app.route('/post/<int:post_id>')
 def post_detail(post_id):
-    db = get_db()
+    db = get_post_db(post_id)
     cursor = db.cursor()
 
     # Получаем пост с информацией о сообществе
-    cursor.execute(''' 
-            SELECT p.*, u.username, c.name as community_name, c.display_name as community_display_name,
-                   (p.upvotes - p.downvotes) as score
-            FROM posts p
-            JOIN users u ON p.user_id = u.id
-            LEFT JOIN communities c ON p.community_id = c.id
-            WHERE p.id = ?
-        ''', (post_id,))
-
-    post = cursor.fetchone()
+    post = repository.post_by_id(db, post_id, cache=result_cache)
 
     if not post:
         flash('Пост не найден', 'danger')
         return redirect(url_for('index'))
 
     # Получаем комментарии
-    cursor.execute('''
-            SELECT c.*, u.username
-            FROM comments c
-            JOIN users u ON c.user_id = u.id
-            WHERE c.post_id = ?
-            ORDER BY c.created_at ASC
-        ''', (post_id,))
+    comments = repository.post_comments(db, post_id, cache=result_cache)
 
-    comments = cursor.fetchall()
+    # Похожие посты (таблица в основной базе, ее пересчитывает related.py)
+    related_posts = repository.related_posts(get_db(), post_id)
 
     # Проверяем, голосовал ли пользователь
     user_vote = None
@@ -713,12 +1114,188 @@ def post_detail(post_id):
     return render_template('post_detail.html',
                            post=post,
                            comments=comments,
+                           related_posts=related_posts,
+                           media=media.post_media(get_db(), post_id),
                            user_vote=user_vote,
                            user_bookmarked=user_bookmarked)
 
 
+# Файл из хранилища медиа: имя - SHA-256 содержимого, поэтому ответ не меняется никогда.
+# send_file отвечает 304 на If-None-Match и 206 на Range-запросы
+@app.route('/media/<sha256>')
+def media_file(sha256):
+    item = media.storage.lookup(get_db(), sha256)
+    if item is None:
+        return 'Файл не найден', 404
+    try:
+        response = send_file(os.path.abspath(media.storage.path(sha256)), mimetype=item.content_type,
+                             conditional=True, etag=sha256, max_age=app.config['MEDIA_MAX_AGE'])
+    except FileNotFoundError:
+        return 'Файл не найден', 404
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+# Редактирование поста автором. Старая версия уходит в историю (revisions.py) в той же
+# транзакции, что и сам пост, его отпечаток SimHash, заголовок в похожих постах и изображения
+@app.route('/post/<int:post_id>/edit', methods=['GET', 'POST'])
+def edit_post(post_id):
+    if 'user_id' not in session:
+        flash('Для редактирования поста необходимо войти в систему', 'warning')
+        return redirect(url_for('login'))
+
+    db = get_db()
+    post_db = get_post_db(post_id)
+    post = repository.post_by_id(post_db, post_id, cache=result_cache)
+    if not post:
+        flash('Пост не найден', 'danger')
+        return redirect(url_for('index'))
+
+    if post.user_id != session['user_id']:
+        flash('Редактировать пост может только его автор', 'danger')
+        return redirect(url_for('post_detail', post_id=post_id))
+
+    post_media = media.post_media(db, post_id)
+
+    if request.method == 'POST':
+        title = request.form.get('title', '').strip()
+        post_type = request.form.get('post_type', post.post_type)
+        if post_type not in ('text', 'link', 'image'):
+            post_type = post.post_type
+        content = request.form.get('link_url' if post_type == 'link' else 'content', '').strip()
+        delete_ids = set(request.form.getlist('delete_media', type=int)) & {item.id for item in post_media}
+        uploads = [f for f in request.files.getlist('images') if f.filename]
+        image_count = len(post_media) - len(delete_ids) + len(uploads)
+
+        if not title or not (content or post_type == 'image' and image_count):
+            flash('Заполните все обязательные поля', 'danger')
+            return redirect(url_for('edit_post', post_id=post_id))
+
+        if uploads and post_type not in ('image', 'link'):
+            flash('Изображения можно прикладывать только к постам-изображениям и ссылкам', 'danger')
+            return redirect(url_for('edit_post', post_id=post_id))
+
+        if image_count > app.config['MEDIA_MAX_FILES']:
+            flash(f"Не больше {app.config['MEDIA_MAX_FILES']} изображений на пост", 'danger')
+            return redirect(url_for('edit_post', post_id=post_id))
+
+        # Дубликатом может быть только более ранний пост
+        fingerprint = simhash.fingerprint(title, content)
+        duplicate = None
+        if fingerprint is not None:
+            duplicate = simhash.find_duplicate(db, fingerprint, app.config['DUPLICATE_MAX_DISTANCE'],
+                                               before=post_id)
+            if duplicate and app.config['DUPLICATE_ACTION'] == 'reject':
+                simhash.count('rejected')
+                flash('Такой пост уже есть', 'danger')
+                return redirect(url_for('edit_post', post_id=post_id))
+
+        try:
+            media_files = [media.storage.save(upload) for upload in uploads]
+        except ValueError as e:
+            flash(str(e), 'danger')
+            return redirect(url_for('edit_post', post_id=post_id))
+
+        old = post._asdict()
+        new = {'title': title, 'content': content, 'post_type': post_type}
+        schema = main_schema()
+
+        try:
+            revision = revisions.record(post_db, post_id, old, new, session['user_id'])
+            if revision is None and not delete_ids and not media_files:
+                post_db.rollback()
+                flash('Изменений нет', 'info')
+                return redirect(url_for('post_detail', post_id=post_id))
+
+            # Пост меняется, только если его не успели изменить с момента чтения,
+            # иначе в историю попала бы не та версия
+            updated = post_db.execute('''
+                UPDATE posts SET title = ?, content = ?, post_type = ?, edited_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND removed = 0 AND title = ? AND content = ? AND post_type = ?
+            ''', (title, content, post_type, post_id, post.title, post.content, post.post_type)).rowcount
+            if not updated:
+                post_db.rollback()
+                flash('Пост изменился, пока вы его редактировали. Проверьте изменения', 'warning')
+                return redirect(url_for('edit_post', post_id=post_id))
+
+            if fingerprint is None:
+                post_db.execute(f'DELETE FROM {schema}.post_fingerprints WHERE post_id = ?', (post_id,))
+            else:
+                simhash.record(post_db, post_id, fingerprint, duplicate, schema)
+
+            if title != post.title:
+                post_db.execute(f'UPDATE {schema}.related_posts SET title = ? WHERE related_id = ?',
+                                (title, post_id))
+
+            media.storage.detach(post_db, post_id, delete_ids, schema)
+            if media_files:
+                position = post_db.execute(
+                    f'SELECT COALESCE(MAX(position) + 1, 0) FROM {schema}.post_media WHERE post_id = ?',
+                    (post_id,)
+                ).fetchone()[0]
+                media.storage.attach(post_db, post_id, media_files, schema, first_position=position)
+
+            post_db.commit()
+
+        except Exception as e:
+            post_db.rollback()
+            flash(f'Ошибка при сохранении поста: {str(e)}', 'danger')
+            return redirect(url_for('edit_post', post_id=post_id))
+
+        if duplicate:
+            simhash.count('flagged')
+
+        flash('Пост сохранен', 'success')
+        return redirect(url_for('post_detail', post_id=post_id))
+
+    return render_template('edit_post.html', post=post, media=post_media)
+
+
+# Удаление поста автором (мягкое, как в очереди модерации)
+@app.route('/post/<int:post_id>/delete', methods=['POST'])
+def delete_post(post_id):
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    post_db = get_post_db(post_id)
+    post = repository.post_by_id(post_db, post_id, cache=result_cache)
+    if not post:
+        flash('Пост не найден', 'danger')
+        return redirect(url_for('index'))
+
+    if post.user_id != session['user_id']:
+        flash('Удалить пост может только его автор', 'danger')
+        return redirect(url_for('post_detail', post_id=post_id))
+
+    moderation.remove_post(post_db, post_id, post.community_id, main_schema())
+    flash('Пост удален', 'success')
+    return redirect(url_for('index'))
+
+
+# История правок поста; ?revision=N показывает версию до правки N
+@app.route('/post/<int:post_id>/history')
+def post_history(post_id):
+    post_db = get_post_db(post_id)
+    post = repository.post_by_id(post_db, post_id, cache=result_cache)
+    if not post:
+        flash('Пост не найден', 'danger')
+        return redirect(url_for('index'))
+
+    selected = request.args.get('revision', type=int)
+    old = None
+    if selected is not None:
+        old = revisions.version(post_db, post_id, post._asdict(), selected)
+        if old is None:
+            flash('Такой правки нет', 'warning')
+
+    return render_template('post_history.html', post=post, items=revisions.history(post_db, post_id),
+                           selected=selected, old=old)
+
+
 # Добавление комментария
 @app.route('/post/<int:post_id>/comment', methods=['POST'])
+@rate_limited('POST')
 def add_comment(post_id):
     if 'user_id' not in session:
         flash('Для комментирования необходимо войти в систему', 'warning')
@@ -729,26 +1306,56 @@ def add_comment(post_id):
         flash('Комментарий не может быть пустым', 'danger')
         return redirect(url_for('post_detail', post_id=post_id))
 
-    db = get_db()
+    db = get_post_db(post_id)
     cursor = db.cursor()
 
+    post = cursor.execute(
+        'SELECT user_id, title, community_id FROM posts WHERE id = ? AND removed = 0', (post_id,)
+    ).fetchone()
+    if not post:
+        flash('Пост не найден', 'danger')
+        return redirect(url_for('index'))
+
+    if post['community_id'] and moderation.is_banned(get_db(), post['community_id'], session['user_id']):
+        flash('Вы забанены в этом сообществе', 'danger')
+        return redirect(url_for('post_detail', post_id=post_id))
+
+    # Ответ на комментарий того же поста
+    parent = None
+    parent_id = request.form.get('parent_id', type=int)
+    if parent_id:
+        parent = cursor.execute(
+            'SELECT id, user_id FROM comments WHERE id = ? AND post_id = ? AND removed = 0', (parent_id, post_id)
+        ).fetchone()
+
     cursor.execute(
-        'INSERT INTO comments (content, user_id, post_id) VALUES (?, ?, ?)',
-        (content, session['user_id'], post_id)
-    )# Увеличиваем счетчик комментариев
+        'INSERT INTO comments (content, user_id, post_id, parent_id) VALUES (?, ?, ?, ?)',
+        (content, session['user_id'], post_id, parent['id'] if parent else None)
+    )
+    comment_id = cursor.lastrowid
+    # Увеличиваем счетчик комментариев
     cursor.execute(
         'UPDATE posts SET comments_count = comments_count + 1 WHERE id = ?',
         (post_id,)
     )
+    profiles.add(db, session['user_id'], comments=1)
 
     db.commit()
 
+    publish_post_counters('comment', db, post_id)
+
+    # Уведомления пишутся пачкой из очереди, а не в этом запросе
+    for user_id, kind in notifications.recipients(post['user_id'], parent['user_id'] if parent else None,
+                                                  session['user_id']):
+        notification_queue.add(user_id, kind, post_id, post['title'], comment_id, session['username'])
+
     flash('Комментарий добавлен', 'success')
     return redirect(url_for('post_detail', post_id=post_id))
 
 
 # Голосование за пост
 @app.route('/vote/<int:post_id>/<string:vote_type>')
+@rate_limited('GET')
 def vote_post(post_id, vote_type):
     if 'user_id' not in session:
         flash('Для голосования необходимо войти в систему', 'warning')
@@ -757,12 +1364,13 @@ def vote_post(post_id, vote_type):
     if vote_type not in ['up', 'down']:
         return redirect(url_for('index'))
 
-    db = get_db()
+    db = get_post_db(post_id)
     cursor = db.cursor()
 
     # Проверяем, существует ли пост
-    cursor.execute('SELECT id FROM posts WHERE id = ?', (post_id,))
-    if not cursor.fetchone():
+    cursor.execute('SELECT id, user_id FROM posts WHERE id = ? AND removed = 0', (post_id,))
+    post = cursor.fetchone()
+    if not post:
         flash('Пост не найден', 'danger')
         return redirect(url_for('index'))
 
@@ -788,7 +1396,7 @@ def vote_post(post_id, vote_type):
         else:
             # Если голосовал другим способом - меняем голос
             cursor.execute(
-                'UPDATE votes SET vote_type = ? WHERE user_id = ? AND post_id = ?',
+                'UPDATE votes SET vote_type = ?, created_at = CURRENT_TIMESTAMP WHERE user_id = ? AND post_id = ?',
                 (vote_type, session['user_id'], post_id)
             )
             # Обновляем счетчики
@@ -801,7 +1409,7 @@ def vote_post(post_id, vote_type):
     else:
         # Новый голос
         cursor.execute(
-            'INSERT INTO votes (user_id, post_id, vote_type) VALUES (?, ?, ?)',
+            'INSERT INTO votes (user_id, post_id, vote_type, created_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)',
             (session['user_id'], post_id, vote_type)
         )
         # Увеличиваем счетчик
@@ -810,7 +1418,15 @@ def vote_post(post_id, vote_type):
         else:
             cursor.execute('UPDATE posts SET downvotes = downvotes + 1 WHERE id = ?', (post_id,))
 
+    # Карма автора поста меняется в той же транзакции шарда, что и голос
+    old_vote = existing_vote['vote_type'] if existing_vote else None
+    new_vote = None if old_vote == vote_type else vote_type
+    profiles.add(db, post['user_id'], karma=profiles.karma_delta(old_vote, new_vote))
+
     db.commit()
+
+    publish_post_counters('vote', db, post_id)
+
     return redirect(request.referrer or url_for('index'))
 
 
@@ -820,27 +1436,12 @@ def hot_posts():
     db = get_db()
     cursor = db.cursor()
 
-    cursor.execute('''
-        SELECT p.*, u.username, c.name as community_name, c.display_name as community_display_name,
-               (p.upvotes - p.downvotes) as score
-        FROM posts p
-        JOIN users u ON p.user_id = u.id
-        LEFT JOIN communities c ON p.community_id = c.id
-        ORDER BY score DESC, p.created_at DESC
-        LIMIT 20
-    ''')
-
-    posts = cursor.fetchall()
+    posts = query_posts(lambda shard_db: repository.hot_posts(shard_db, 20), key=by_score, limit=20)
 
     # Проверяем, голосовал ли текущий пользователь за посты
     user_votes = {}
     if 'user_id' in session:
-        cursor.execute('''
-            SELECT post_id, vote_type FROM votes 
-            WHERE user_id = ?
-        ''', (session['user_id'],))
-        votes = cursor.fetchall()
-        user_votes = {vote['post_id']: vote['vote_type'] for vote in votes}
+        user_votes = get_user_votes(session['user_id'])
 
     # Проверяем, добавлены ли посты в закладки
     user_bookmarks = set()
@@ -859,6 +1460,38 @@ def hot_posts():
                            title='Горячее')
 
 
+# Лучшие посты за день/неделю/месяц (по почасовым итогам голосов)
+@app.route('/top')
+def top_posts():
+    db = get_db()
+    cursor = db.cursor()
+
+    top_window = request.args.get('t', 'day')
+    if top_window not in rollups.TOP_WINDOWS:
+        top_window = 'day'
+    since = rollups.window_start(top_window)
+
+    posts = query_posts(lambda shard_db: repository.top_posts(shard_db, since, 20), key=by_window_score, limit=20)
+
+    # Проверяем, голосовал ли текущий пользователь за посты
+    user_votes = {}
+    if 'user_id' in session:
+        user_votes = get_user_votes(session['user_id'])
+
+    # Проверяем, добавлены ли посты в закладки
+    user_bookmarks = set()
+    if 'user_id' in session:
+        cursor.execute('SELECT post_id FROM bookmarks WHERE user_id = ?', (session['user_id'],))
+        user_bookmarks = {bookmark['post_id'] for bookmark in cursor.fetchall()}
+
+    return render_template('index.html',
+                           posts=posts,
+                           user_votes=user_votes,
+                           user_bookmarks=user_bookmarks,
+                           title='Лучшее',
+                           top_window=top_window)
+
+
 # Закладки
 @app.route('/bookmarks')
 def bookmarks():
@@ -866,33 +1499,14 @@ def bookmarks():
         flash('Для просмотра закладок необходимо войти в систему', 'warning')
         return redirect(url_for('login'))
 
-    db = get_db()
-    cursor = db.cursor()
-
-    cursor.execute('''
-            SELECT p.*, u.username, c.name as community_name, c.display_name as community_display_name,
-                   (p.upvotes - p.downvotes) as score
-            FROM posts p
-            JOIN users u ON p.user_id = u.id
-            LEFT JOIN communities c ON p.community_id = c.id
-            JOIN bookmarks b ON p.id = b.post_id
-            WHERE b.user_id = ?
-            ORDER BY b.created_at DESC
-        ''', (session['user_id'],))
-
-    bookmarked_posts = cursor.fetchall()
+    bookmarked_posts = query_posts(lambda shard_db: repository.bookmarked_posts(shard_db, session['user_id']),
+                                   key=by_bookmarked_at)
 
     # Проверяем, голосовал ли текущий пользователь за посты
-    user_votes = {}
-    cursor.execute('''
-            SELECT post_id, vote_type FROM votes 
-            WHERE user_id = ?
-        ''', (session['user_id'],))
-    votes = cursor.fetchall()
-    user_votes = {vote['post_id']: vote['vote_type'] for vote in votes}
+    user_votes = get_user_votes(session['user_id'])
 
     # Все посты в закладках уже отмечены как закладки
-    user_bookmarks = {post['id'] for post in bookmarked_posts}
+    user_bookmarks = {post.id for post in bookmarked_posts}
 
     return render_template('bookmarks.html',
                            posts=bookmarked_posts,
@@ -900,8 +1514,63 @@ def bookmarks():
                            user_bookmarks=user_bookmarks)
 
 
+# Уведомления
+@app.route('/notifications')
+def notifications_inbox():
+    if 'user_id' not in session:
+        flash('Для просмотра уведомлений необходимо войти в систему', 'warning')
+        return redirect(url_for('login'))
+
+    return render_template('notifications.html',
+                           notifications=notifications.inbox(get_db(), session['user_id']))
+
+
+# Отметить все уведомления прочитанными
+@app.route('/notifications/read', methods=['POST'])
+def notifications_read():
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    notifications.mark_all_read(get_db(), session['user_id'])
+    return redirect(url_for('notifications_inbox'))
+
+
+# Профиль пользователя: шапка со счетчиками и лента его постов и комментариев
+@app.route('/u/<username>')
+def user_profile(username):
+    user = repository.user_summary(get_db(), get_post_dbs(), username, cache=result_cache)
+    if not user:
+        flash('Пользователь не найден', 'danger')
+        return redirect(url_for('index'))
+
+    try:
+        after = decode_cursor(request.args.get('cursor'), 3)
+        # Курсор - [created_at, вид, id]
+        if after is not None and (not isinstance(after[0], str) or after[1] not in ('post', 'comment')
+                                  or not isinstance(after[2], int)):
+            raise ValueError('Некорректный курсор')
+    except ValueError:
+        return redirect(url_for('user_profile', username=username))
+
+    # Каждая база отдает два диапазона индексов (user_id, created_at) - посты и
+    # комментарии; k-way слияние берет limit + 1 записей, лишняя означает, что есть еще
+    limit = app.config['USER_ACTIVITY_PAGE_SIZE']
+    streams = []
+    for post_db in get_post_dbs():
+        streams.extend(repository.user_activity(post_db, user.id, limit + 1, after))
+    activity = sharding.merge_sorted(streams, key=by_activity, limit=limit + 1)
+
+    next_cursor = None
+    if len(activity) > limit:
+        activity = activity[:limit]
+        next_cursor = encode_cursor(list(by_activity(activity[-1])))
+
+    return render_template('user_profile.html', user=user, activity=activity, next_cursor=next_cursor)
+
+
 # Добавление/удаление закладки
 @app.route('/bookmark/<int:post_id>')
+@rate_limited('GET')
 def toggle_bookmark(post_id):
     if 'user_id' not in session:
         flash('Для добавления в закладки необходимо войти в систему', 'warning')
@@ -911,8 +1580,7 @@ def toggle_bookmark(post_id):
     cursor = db.cursor()
 
     # Проверяем, существует ли пост
-    cursor.execute('SELECT id FROM posts WHERE id = ?', (post_id,))
-    if not cursor.fetchone():
+    if not get_post_db(post_id).execute('SELECT id FROM posts WHERE id = ? AND removed = 0', (post_id,)).fetchone():
         flash('Пост не найден', 'danger')
         return redirect(url_for('index'))
 
@@ -944,6 +1612,7 @@ def toggle_bookmark(post_id):
 
 # Поиск сообществ
 @app.route('/search/communities')
+@expensive
 def search_communities():
     query = request.args.get('q', '').strip()
 
@@ -953,16 +1622,9 @@ def search_communities():
     db = get_db()
     cursor = db.cursor()
 
-    cursor.execute('''
-            SELECT c.*, COUNT(cs.id) as subscribers_count
-            FROM communities c
-            LEFT JOIN community_subscriptions cs ON c.id = cs.community_id
-            WHERE c.name LIKE ? OR c.display_name LIKE ? OR c.description LIKE ?
-            GROUP BY c.id
-            ORDER BY subscribers_count DESC
-        ''', (f'%{query}%', f'%{query}%', f'%{query}%'))
+    communities = repository.search_communities(db, query)
 
-    communities = cursor.fetchall()# Проверяем подписки пользователя
+    # Проверяем подписки пользователя
     user_subscriptions = set()
     if 'user_id' in session:
         cursor.execute('SELECT community_id FROM community_subscriptions WHERE user_id = ?', (session['user_id'],))
@@ -975,51 +1637,492 @@ def search_communities():
                            search_query=query)
 
 
-# Маршрут для проверки базы данных (только для отладки)
+# Живые обновления счетчиков и новых постов (Server-Sent Events)
+@app.route('/events')
+def live_events():
+    post_ids = {int(part) for part in request.args.get('posts', '').split(',') if part.isdigit()}
+    feed = request.args.get('feed') == '1'
+
+    sub = live_hub.subscribe(post_ids, feed=feed)
+    if sub is None:
+        return overloaded()
+
+    response = Response(live.stream(live_hub, sub,
+                                    coalesce=app.config['LIVE_COALESCE'],
+                                    heartbeat=app.config['LIVE_HEARTBEAT']),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # finally генератора не выполнится, если тело так и не начали читать (HEAD,
+    # клиент ушел до первого куска) - слот освобождается и при закрытии ответа
+    response.call_on_close(lambda: live_hub.unsubscribe(sub))
+    return response
+
+
+# ===== JSON API v1 =====
+
+def api_error(message, status=400):
+    return jsonify({'error': message}), status
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+
+def decode_cursor(token, size):
+    """Значения ключей сортировки из курсора (None - первая страница)"""
+    if not token:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except ValueError:
+        values = None
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError('Некорректный курсор')
+    # В SQL уходят только скаляры: словарь или список в курсоре не должен дойти до execute
+    if not all(value is None or isinstance(value, (str, int, float)) for value in values):
+        raise ValueError('Некорректный курсор')
+    return values
+
+
+def parse_api_args(allowed_fields, default_fields, order_keys=()):
+    """Разбирает fields, limit, cursor и формат ответа из query string"""
+    fields = request.args.get('fields')
+    fields = tuple(f for f in fields.split(',') if f) if fields else default_fields
+    unknown = [f for f in fields if f not in allowed_fields]
+    if unknown:
+        raise ValueError(f"Неизвестные поля: {', '.join(unknown)}")
+
+    ndjson = (request.args.get('format') == 'ndjson' or
+              request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson'])
+              == 'application/x-ndjson')
+    max_limit = app.config['API_MAX_NDJSON_LIMIT' if ndjson else 'API_MAX_LIMIT']
+    limit = request.args.get('limit', app.config['API_DEFAULT_LIMIT'], type=int)
+    limit = max(1, min(limit, max_limit))
+
+    after = decode_cursor(request.args.get('cursor'), len(order_keys))
+    return fields, limit, after, ndjson
+
+
+def iter_posts_all_shards(make_iter, keys):
+    """Лениво сливает генераторы постов всех шардов по ключам сортировки"""
+    iters = [make_iter(db) for db in get_post_dbs()]
+    if len(iters) == 1:
+        return iters[0]
+    return heapq.merge(*iters, key=lambda row: tuple(row[k] for k in keys), reverse=True)
+
+
+def detach_db_connections():
+    """Забирает соединения запроса из g, чтобы teardown не закрыл их до конца стрима"""
+    conns = [g.pop('db', None)] + list(g.pop('shard_dbs', {}).values())
+    return [conn for conn in conns if conn is not None]
+
+
+def api_stream(rows, fields, order_keys, limit, ndjson):
+    """Стримит до limit строк как JSON или NDJSON прямо из генератора.
+
+    rows должен отдавать limit + 1 строк: по лишней строке понятно, что есть
+    следующая страница. Последняя строка NDJSON - {"next_cursor": ...}.
+    """
+    conns = detach_db_connections()
+
+    def generate():
+        try:
+            count, last, has_more = 0, None, False
+            if not ndjson:
+                yield '{"items": ['
+            for row in rows:
+                if count == limit:
+                    has_more = True
+                    break
+                item = json.dumps({f: row[f] for f in fields}, ensure_ascii=False)
+                if ndjson:
+                    yield item + '\n'
+                else:
+                    yield (',' if count else '') + item
+                last, count = row, count + 1
+
+            next_cursor = encode_cursor([last[k] for k in order_keys]) if has_more else None
+            if ndjson:
+                yield json.dumps({'next_cursor': next_cursor}) + '\n'
+            else:
+                yield '], "next_cursor": ' + json.dumps(next_cursor) + '}'
+        finally:
+            for conn in conns:
+                conn.close()
+
+    mimetype = 'application/x-ndjson' if ndjson else 'application/json'
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+
+def api_posts_response(make_iter, order='new'):
+    keys = repository.API_POST_ORDERS[order]
+    try:
+        fields, limit, after, ndjson = parse_api_args(
+            repository.API_POST_FIELDS, repository.API_POST_DEFAULT_FIELDS, keys)
+    except ValueError as e:
+        return api_error(str(e))
+
+    rows = make_iter(fields, after, limit + 1)
+    return api_stream(rows, fields, keys, limit, ndjson)
+
+
+# Лента (как / и /hot): ?sort=new|hot
+@app.route('/api/v1/posts')
+def api_posts():
+    order = request.args.get('sort', 'new')
+    if order not in repository.API_POST_ORDERS:
+        return api_error('Неизвестная сортировка')
+
+    keys = repository.API_POST_ORDERS[order]
+    return api_posts_response(
+        lambda fields, after, limit: iter_posts_all_shards(
+            lambda db: repository.iter_api_posts(db, fields, order, after=after, limit=limit), keys),
+        order)
+
+
+# Посты сообщества (как /r/<name>)
+@app.route('/api/v1/communities/<string:community_name>/posts')
+def api_community_posts(community_name):
+    community = repository.community_by_name(get_db(), community_name, cache=result_cache)
+    if not community:
+        return api_error('Сообщество не найдено', 404)
+
+    db = get_community_db(community.id)
+    return api_posts_response(
+        lambda fields, after, limit: repository.iter_api_posts(
+            db, fields, community_id=community.id, after=after, limit=limit))
+
+
+# Поиск постов (как /search)
+@app.route('/api/v1/search/posts')
+def api_search_posts():
+    query = request.args.get('q', '').strip()
+    if not query:
+        return api_error('Пустой запрос')
+
+    keys = repository.API_POST_ORDERS['new']
+    return api_posts_response(
+        lambda fields, after, limit: iter_posts_all_shards(
+            lambda db: repository.iter_api_posts(db, fields, search=query, after=after, limit=limit), keys))
+
+
+# Один пост (как /post/<id>)
+@app.route('/api/v1/posts/<int:post_id>')
+def api_post_detail(post_id):
+    try:
+        fields, _, _, _ = parse_api_args(repository.API_POST_FIELDS, repository.API_POST_DEFAULT_FIELDS)
+    except ValueError as e:
+        return api_error(str(e))
+
+    post = next(repository.iter_api_posts(get_post_db(post_id), fields, post_id=post_id, limit=1), None)
+    if post is None:
+        return api_error('Пост не найден', 404)
+    return jsonify({f: post[f] for f in fields})
+
+
+# Комментарии поста
+@app.route('/api/v1/posts/<int:post_id>/comments')
+def api_post_comments(post_id):
+    keys = repository.API_COMMENT_ORDER
+    try:
+        fields, limit, after, ndjson = parse_api_args(
+            repository.API_COMMENT_FIELDS, repository.API_COMMENT_DEFAULT_FIELDS, keys)
+    except ValueError as e:
+        return api_error(str(e))
+
+    db = get_post_db(post_id)
+    if not db.execute('SELECT id FROM posts WHERE id = ? AND removed = 0', (post_id,)).fetchone():
+        return api_error('Пост не найден', 404)
+
+    rows = repository.iter_api_comments(db, post_id, fields, after=after, limit=limit + 1)
+    return api_stream(rows, fields, keys, limit, ndjson)
+
+
+# ===== Выгрузка данных =====
+
+def export_response(plan, basename):
+    """Отдает выгрузку потоком: ?format=ndjson|csv, ?table= для CSV, ?gzip=1"""
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in ('ndjson', 'csv'):
+        flash('Неизвестный формат выгрузки', 'danger')
+        return redirect(url_for('index'))
+
+    tables = export.EXPORT_TABLES
+    if fmt == 'csv':
+        table = request.args.get('table', 'posts')
+        if table not in export.EXPORT_TABLES:
+            flash('Неизвестная таблица', 'danger')
+            return redirect(url_for('index'))
+        tables = (table,)
+        basename = f'{basename}-{table}'
+
+    compress = request.args.get('gzip') == '1'
+    filename = f"{basename}.{fmt}{'.gz' if compress else ''}"
+    if compress:
+        mimetype = 'application/gzip'
+    else:
+        mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+
+    conns = detach_db_connections()
+
+    def generate():
+        try:
+            yield from export.export_stream(plan, fmt, tables, compress, app.config['EXPORT_CHUNK_SIZE'])
+        finally:
+            for conn in conns:
+                conn.close()
+
+    return Response(generate(), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+
+# Выгрузка сообщества (только для владельца)
+@app.route('/export/r/<string:community_name>')
+def export_community(community_name):
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    community = repository.community_by_name(get_db(), community_name, cache=result_cache)
+    if not community:
+        flash('Сообщество не найдено', 'danger')
+        return redirect(url_for('index'))
+
+    if community.owner_id != session['user_id']:
+        flash('Выгрузка доступна только владельцу сообщества', 'danger')
+        return redirect(url_for('community_detail', community_name=community_name))
+
+    plan = export.community_plan(get_community_db(community.id), community.id, main_schema())
+    return export_response(plan, f'community-{community_name}')
+
+
+# Выгрузка своих данных
+@app.route('/export/me')
+def export_user():
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    plan = export.user_plan(get_db(), get_post_dbs(), session['user_id'])
+    return export_response(plan, f"user-{session['username']}")
+
+
+def is_admin(strict=False):
+    """Администратор - пользователь из ADMIN_USERNAMES (пустой список - любой вошедший).
+
+    strict - для действий, меняющих работу процесса: пустой список не пускает никого.
+    """
+    if 'user_id' not in session:
+        return False
+    admins = app.config['ADMIN_USERNAMES']
+    if not admins:
+        return not strict
+    return session.get('username') in admins
+
+
+# Статистика базы данных (только для администраторов)
 @app.route('/debug/db')
+@expensive
 def debug_database():
     if 'user_id' not in session:
         return redirect(url_for('login'))
+    if not is_admin():
+        return 'Доступ запрещен', 403
 
-    db = get_db()
-    cursor = db.cursor()
+    shard_dbs = [get_shard_db(shard) for shard in range(get_shard_count())]
+    stats = db_stats.collect(get_db(), shard_dbs, app.config['DATABASE'],
+                             app.config['DB_STATS_SIZE_TTL'])
+    stats['query_cache'] = result_cache.info()
+    stats['slow_queries'] = db_stats.slow_queries.slowest(20)
 
-    result = []
+    if request.args.get('format') == 'json':
+        return jsonify(stats)
+    return render_template('db_stats.html', stats=stats)
 
-    # Проверяем таблицы
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
-    tables = cursor.fetchall()
-    result.append(f"Tables in database: {[t[0] for t in tables]}")
 
-    # Проверяем посты
-    cursor.execute("SELECT COUNT(*) FROM posts")
-    post_count = cursor.fetchone()[0]
-    result.append(f"Total posts in database: {post_count}")
+# Профили маршрутов (только для администраторов)
+@app.route('/debug/profile', methods=['GET', 'POST'])
+def debug_profile():
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    if not is_admin():
+        return 'Доступ запрещен', 403
 
-    cursor.execute('''
-        SELECT p.id, p.title, p.user_id, u.username, p.created_at 
-        FROM posts p 
-        LEFT JOIN users u ON p.user_id = u.id 
-        ORDER BY p.created_at DESC
-    ''')
-    posts = cursor.fetchall()
-    result.append("\nAll posts:")
-    for post in posts:
-        result.append(f"ID: {post[0]}, Title: '{post[1]}', User: {post[3]} (ID:{post[2]}), Created: {post[4]}")
-
-    # Проверяем пользователей
-    cursor.execute("SELECT id, username FROM users")
-    users = cursor.fetchall()
-    result.append(f"\nUsers: {users}")
-
-    # Проверяем сообщества
-    cursor.execute("SELECT id, name, display_name FROM communities")
-    communities = cursor.fetchall()
-    result.append(f"\nCommunities: {communities}")
+    # Включить профилирование всех запросов может только явно названный администратор
+    can_configure = is_admin(strict=True)
 
+    if request.method == 'POST':
+        if not can_configure:
+            return 'Настройки профилировщика меняют только пользователи из ADMIN_USERNAMES', 403
+        if 'reset' in request.form:
+            route_profiler.reset()
+        else:
+            routes = [route.strip() for route in request.form.get('routes', '').split(',') if route.strip()]
+            unknown = [route for route in routes if route not in app.view_functions]
+            if unknown:
+                flash(f"Неизвестные маршруты: {', '.join(unknown)}", 'danger')
+            else:
+                route_profiler.configure(routes, request.form.get('sample_rate', 0.0, type=float))
+        return redirect(url_for('debug_profile'))
+
+    info = route_profiler.info()
+    result = [f"{key}: {value}" for key, value in info.items()]
+    if can_configure:
+        result.append(f'''<form method="POST">
+            routes: <input name="routes" value="{', '.join(info['routes'])}">
+            sample_rate: <input name="sample_rate" value="{info['sample_rate']}" size="4">
+            <button>Применить</button> <button name="reset">Сбросить профили</button></form>''')
+    for endpoint, requests_count in route_profiler.endpoints():
+        pstats_url = url_for('debug_profile_download', route=endpoint, fmt='pstats')
+        collapsed_url = url_for('debug_profile_download', route=endpoint, fmt='collapsed')
+        result.append(f'\n<b>{endpoint}</b>: {requests_count} requests '
+                      f'(<a href="{pstats_url}">pstats</a>, <a href="{collapsed_url}">collapsed</a>)')
+        result.extend(f"{ct * 1000:.1f} ms total, {tt * 1000:.1f} ms self, {calls} calls: {escape(func)}"
+                      for func, calls, tt, ct in route_profiler.top(endpoint, 15))
     return '<br>'.join(result)
 
 
+# Скачивание сводного профиля маршрута: pstats или свернутые стеки для flamegraph
+@app.route('/debug/profile/<route>.<fmt>')
+def debug_profile_download(route, fmt):
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    if not is_admin():
+        return 'Доступ запрещен', 403
+
+    if fmt == 'pstats':
+        data, mimetype = route_profiler.dump(route), 'application/octet-stream'
+    elif fmt == 'collapsed':
+        data, mimetype = route_profiler.collapsed(route), 'text/plain'
+    else:
+        return 'Неизвестный формат', 404
+    if data is None:
+        return 'Профиля нет', 404
+    return Response(data, mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={route}.{fmt}'})
+
+
+# Метрики резервного копирования
+@app.route('/debug/backups')
+def debug_backups():
+    if not is_admin():
+        return redirect(url_for('login'))
+
+    result = [f"{key}: {value}" for key, value in backup.backup_stats.items()]
+    result.append("\nSnapshots:")
+    result.extend(backup.list_snapshots(app.config['BACKUP_DIR']))
+    return '<br>'.join(result)
+
+
+# Метрики фонового обслуживания базы
+@app.route('/debug/maintenance')
+def debug_maintenance():
+    if not is_admin():
+        return redirect(url_for('login'))
+
+    result = [f"enabled: {app.config['MAINTENANCE_ENABLED']}"]
+    for name, values in list(maintenance.maintenance_stats.items()):
+        result.append(f"\n{name}: " + ', '.join(f"{key}={value}" for key, value in values.items()))
+    return '<br>'.join(result)
+
+
+# Счетчики сброса нагрузки
+@app.route('/debug/load')
+def debug_load():
+    if not is_admin():
+        return redirect(url_for('login'))
+
+    with _load_lock:
+        stats = dict(load_stats)
+    return '<br>'.join(f"{key}: {value}" for key, value in stats.items())
+
+
+# Статистика кэша запросов
+@app.route('/debug/cache')
+def debug_cache():
+    if not is_admin():
+        return redirect(url_for('login'))
+
+    result = [f"{key}: {value}" for key, value in result_cache.info().items()]
+    result.append("\nCommunity metadata:")
+    result.extend(f"{key}: {value}" for key, value in community_meta.info().items())
+    return '<br>'.join(result)
+
+
+# Состояние рейтинга сообществ в тренде
+@app.route('/debug/trending')
+def debug_trending():
+    if not is_admin():
+        return redirect(url_for('login'))
+
+    result = [f"{key}: {value}" for key, value in trending_cache.info().items()]
+    result.append("\nTop:")
+    result.extend(f"r/{c.name}: {c.score} ({c.growth_day:+d} day, {c.growth_week:+d} week)"
+                  for c in trending_cache.communities)
+    return '<br>'.join(result)
+
+
+# Проверки почти одинаковых постов
+@app.route('/debug/duplicates')
+def debug_duplicates():
+    if not is_admin():
+        return redirect(url_for('login'))
+
+    result = [f"{key}: {value}" for key, value in simhash.info().items()]
+    result.append(f"max_distance: {app.config['DUPLICATE_MAX_DISTANCE']}, action: {app.config['DUPLICATE_ACTION']}")
+    try:
+        flagged = get_db().execute(
+            'SELECT COUNT(*) FROM post_fingerprints WHERE duplicate_of IS NOT NULL'
+        ).fetchone()[0]
+        result.append(f"flagged posts in database: {flagged}")
+    except sqlite3.OperationalError as e:
+        result.append(f"post_fingerprints: {e}")
+    return '<br>'.join(result)
+
+
+# Очередь уведомлений
+@app.route('/debug/notifications')
+def debug_notifications():
+    if not is_admin():
+        return redirect(url_for('login'))
+
+    return '<br>'.join(f"{key}: {value}" for key, value in notification_queue.info().items())
+
+
+# Пул хэширования паролей
+@app.route('/debug/passwords')
+def debug_passwords():
+    if not is_admin():
+        return redirect(url_for('login'))
+
+    return '<br>'.join(f"{key}: {value}" for key, value in password_pool.info().items())
+
+
+# Статистика хранилища медиа
+@app.route('/debug/media')
+def debug_media():
+    if not is_admin():
+        return redirect(url_for('login'))
+
+    return '<br>'.join(f"{key}: {value}" for key, value in media.storage.info().items())
+
+
+# Счетчики ограничения частоты записи (этого процесса)
+@app.route('/debug/ratelimit')
+def debug_ratelimit():
+    if not is_admin():
+        return redirect(url_for('login'))
+
+    return '<br>'.join(f"{key}: {value}" for key, value in rate_limiter.info().items())
+
+
+# Статистика живых обновлений
+@app.route('/debug/live')
+def debug_live():
+    if not is_admin():
+        return redirect(url_for('login'))
+
+    return '<br>'.join(f"{key}: {value}" for key, value in live_hub.info().items())
+
+
 # Проверка подключения к базе данных
 @app.route('/debug/check')
 def debug_check():
@@ -1037,24 +2140,45 @@ def debug_check():
 
 
 if __name__ == '__main__':
-    # Создаем БД если её нет
-    if not os.path.exists('instance/app.db'):
-        import init_db
+    # Создаем или обновляем БД, только если ее схема устарела (init_db импортируется лишь тогда)
+    database_state = startup.prepare_database(app.config['DATABASE'])
+    if database_state != 'current':
+        print(f"=== DATABASE {database_state.upper()} ===")
 
-        init_db.init_database()
-        print("=== DATABASE CREATED ===")
-    else:
-        # Обновляем существующую базу данных
-        import init_db
+    # Шаблоны загружаются из байткод-кэша до первого запроса
+    startup.precompile_templates(app)
 
-        init_db.update_database()
-        print("=== DATABASE UPDATED ===")
+    # Метаданные самых популярных сообществ - в кэш до первого запроса
+    conn = sqlite3.connect(app.config['DATABASE'])
+    try:
+        community_meta.warm(conn, app.config['COMMUNITY_CACHE_WARM'])
+    finally:
+        conn.close()
 
     # Проверяем структуру базы данных
     print("\n=== STARTING APPLICATION ===")
     print("Debug routes available:")
-    print("  /debug/db - Show database state")
+    print("  /debug/db - Show database statistics (?format=json for polling)")
     print("  /debug/check - Check database connection")
+    print("  /debug/backups - Show backup metrics")
+    print("  /debug/load - Show shed/aborted request counters")
+    print("  /debug/ratelimit - Show rate limiter counters")
+    print("  /debug/cache - Show query cache statistics")
+    print("  /debug/live - Show live update connections")
+    print("  /debug/maintenance - Show maintenance task results")
+    print("  /debug/trending - Show trending communities ranking")
+    print("  /debug/duplicates - Show near-duplicate post checks")
+    print("  /debug/notifications - Show notification queue counters")
+    print("  /debug/passwords - Show password hashing pool counters")
+    print("  /debug/profile - Route profiles and profiler settings")
     print("=" * 30)
 
+    if app.config['BACKUP_INTERVAL']:
+        backup.start_scheduler(app.config['DATABASE'], app.config['BACKUP_DIR'],
+                               app.config['BACKUP_INTERVAL'], keep=app.config['BACKUP_KEEP'])
+
+    if app.config['MAINTENANCE_ENABLED']:
+        maintenance.start_scheduler(app.config['DATABASE'], app.config['MAINTENANCE_TASKS'],
+                                    budget=app.config['MAINTENANCE_BUDGET'])
+
     app.run(debug=True, port=5000, host='0.0.0.0')
\ No newline at end of file
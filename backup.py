@@ -0,0 +1,179 @@
+"""Онлайн-резервное копирование базы через sqlite3 backup API.
+
+Копирование идет порциями страниц с паузами между ними, поэтому писатели
+блокируются лишь на время копирования одной порции. Каждый снимок - это
+каталог instance/backups/<время>/ с app.db и файлами шардов.
+
+Запуск:
+  python backup.py              - сделать снимок сейчас
+  python backup.py list         - список снимков
+  python backup.py verify       - PRAGMA integrity_check всех снимков
+"""
+import os
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime
+
+import sharding
+
+# Метрики последнего копирования (читаются из /debug/backups)
+backup_stats = {
+    'runs': 0,
+    'failures': 0,
+    'last_snapshot': None,
+    'last_duration': None,
+    'last_bytes': None,
+    'last_throughput': None,
+    'last_error': None,
+}
+_stats_lock = threading.Lock()
+
+
+def database_files(db_path):
+    """Файлы, из которых состоит база: основной и шарды"""
+    conn = sqlite3.connect(db_path)
+    try:
+        shard_count = sharding.read_shard_count(conn)
+    finally:
+        conn.close()
+    return [db_path] + [sharding.shard_path(db_path, i) for i in range(shard_count)]
+
+
+def backup_file(src_path, dest_path, pages=256, pause=0.01):
+    """Копирует одну базу порциями по pages страниц с паузой pause секунд"""
+    tmp_path = dest_path + '.part'
+    src = sqlite3.connect(src_path)
+    dst = sqlite3.connect(tmp_path)
+    progress = {'total': 0}
+
+    def on_progress(status, remaining, total):
+        progress['total'] = total
+        if remaining and pause:
+            time.sleep(pause)
+
+    try:
+        src.backup(dst, pages=pages, progress=on_progress)
+    finally:
+        dst.close()
+        src.close()
+
+    os.replace(tmp_path, dest_path)
+    return progress['total']
+
+
+def verify_snapshot(snapshot_dir):
+    """Проверяет все файлы снимка через PRAGMA integrity_check"""
+    problems = {}
+    for name in sorted(os.listdir(snapshot_dir)):
+        if not name.endswith('.db'):
+            continue
+        conn = sqlite3.connect(os.path.join(snapshot_dir, name))
+        try:
+            result = [row[0] for row in conn.execute('PRAGMA integrity_check')]
+        finally:
+            conn.close()
+        if result != ['ok']:
+            problems[name] = result
+    return problems
+
+
+def list_snapshots(backup_dir):
+    """Снимки от старых к новым"""
+    if not os.path.isdir(backup_dir):
+        return []
+    return sorted(
+        os.path.join(backup_dir, name) for name in os.listdir(backup_dir)
+        if os.path.isdir(os.path.join(backup_dir, name)) and not name.endswith('.part')
+    )
+
+
+def apply_retention(backup_dir, keep):
+    """Удаляет старые снимки, оставляя keep последних"""
+    snapshots = list_snapshots(backup_dir)
+    removed = snapshots[:-keep] if keep > 0 else []
+    for path in removed:
+        shutil.rmtree(path)
+    return removed
+
+
+def create_snapshot(db_path, backup_dir, keep=7, verify=True, pages=256, pause=0.01):
+    """Делает снимок всех файлов базы, проверяет его и чистит старые снимки"""
+    started = time.perf_counter()
+    name = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    snapshot_dir = os.path.join(backup_dir, name)
+    tmp_dir = snapshot_dir + '.part'
+
+    try:
+        os.makedirs(tmp_dir, exist_ok=True)
+        total_bytes = 0
+        for path in database_files(db_path):
+            dest = os.path.join(tmp_dir, os.path.basename(path))
+            backup_file(path, dest, pages=pages, pause=pause)
+            total_bytes += os.path.getsize(dest)
+
+        if verify:
+            problems = verify_snapshot(tmp_dir)
+            if problems:
+                raise sqlite3.DatabaseError(f'integrity_check failed: {problems}')
+
+        os.replace(tmp_dir, snapshot_dir)
+    except Exception as e:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        with _stats_lock:
+            backup_stats['runs'] += 1
+            backup_stats['failures'] += 1
+            backup_stats['last_error'] = str(e)
+        raise
+
+    duration = time.perf_counter() - started
+    apply_retention(backup_dir, keep)
+
+    with _stats_lock:
+        backup_stats['runs'] += 1
+        backup_stats['last_snapshot'] = snapshot_dir
+        backup_stats['last_duration'] = round(duration, 3)
+        backup_stats['last_bytes'] = total_bytes
+        backup_stats['last_throughput'] = round(total_bytes / duration) if duration else None
+        backup_stats['last_error'] = None
+
+    print(f"Backup {snapshot_dir}: {total_bytes} bytes in {duration:.2f}s")
+    return snapshot_dir
+
+
+def start_scheduler(db_path, backup_dir, interval, keep=7):
+    """Запускает фоновый поток, который делает снимок каждые interval секунд"""
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                create_snapshot(db_path, backup_dir, keep=keep)
+            except Exception as e:
+                print(f"Backup failed: {e}")
+
+    thread = threading.Thread(target=run, name='backup-scheduler', daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == '__main__':
+    DATABASE = 'instance/app.db'
+    BACKUP_DIR = 'instance/backups'
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'list':
+        for snapshot in list_snapshots(BACKUP_DIR):
+            print(snapshot)
+    elif len(sys.argv) > 1 and sys.argv[1] == 'verify':
+        for snapshot in list_snapshots(BACKUP_DIR):
+            problems = verify_snapshot(snapshot)
+            print(f"{snapshot}: {'ok' if not problems else problems}")
+    elif len(sys.argv) == 1:
+        create_snapshot(DATABASE, BACKUP_DIR)
+    else:
+        print(f"Unknown command: {sys.argv[1]}")
+        print("Available commands:")
+        print("  python backup.py          - Create a snapshot now")
+        print("  python backup.py list     - List snapshots")
+        print("  python backup.py verify   - Run integrity_check on every snapshot")
@@ -0,0 +1,105 @@
+"""Кэш метаданных сообществ в памяти процесса.
+
+Маршруты ищут сообщество по имени или id почти на каждом запросе, а имя,
+название, описание, владелец и публичность меняются редко. Общий кэш
+запросов (query_cache) тут мало помогает: его запись устаревает при любой
+записи в communities, в том числе при каждой подписке (subscribers_count).
+Этот кэш хранит только метаданные (repository.Community), сбрасывается
+явно при изменении сообщества и ограничен по числу записей и по времени -
+последнее нужно, чтобы изменения из других процессов тоже доходили.
+Отсутствующие сообщества не кэшируются, поэтому перебор имен не вытесняет
+настоящие записи.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import repository
+
+
+class CommunityCache:
+    def __init__(self, max_entries=1024, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()   # id -> (Community, время загрузки)
+        self._ids = {}                  # name -> id
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0, 'expired': 0}
+
+    def _get(self, community_id):
+        entry = self._entries.get(community_id)
+        if entry is None:
+            return None
+        community, loaded_at = entry
+        if time.monotonic() - loaded_at >= self.ttl:
+            self._drop(community_id)
+            self.stats['expired'] += 1
+            return None
+        self._entries.move_to_end(community_id)
+        return community
+
+    def _drop(self, community_id):
+        community, _ = self._entries.pop(community_id)
+        if self._ids.get(community.name) == community_id:
+            del self._ids[community.name]
+
+    def _put(self, community):
+        with self._lock:
+            if community.id in self._entries:
+                self._drop(community.id)
+            self._entries[community.id] = (community, time.monotonic())
+            self._ids[community.name] = community.id
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+                self.stats['evictions'] += 1
+
+    def _lookup(self, community_id=None, name=None):
+        with self._lock:
+            if community_id is None:
+                community_id = self._ids.get(name)
+            community = self._get(community_id) if community_id is not None else None
+            self.stats['hits' if community else 'misses'] += 1
+            return community
+
+    def by_name(self, conn, name):
+        community = self._lookup(name=name)
+        if community is None:
+            community = repository.community_by_name(conn, name)
+            if community:
+                self._put(community)
+        return community
+
+    def by_id(self, conn, community_id):
+        community = self._lookup(community_id)
+        if community is None:
+            community = repository.community_by_id(conn, community_id)
+            if community:
+                self._put(community)
+        return community
+
+    def invalidate(self, community_id=None, name=None):
+        """Сбрасывает запись после изменения сообщества (по id или имени)"""
+        with self._lock:
+            if community_id is None:
+                community_id = self._ids.get(name)
+            if community_id in self._entries:
+                self._drop(community_id)
+                self.stats['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._ids.clear()
+
+    def warm(self, conn, n=100):
+        """Загружает n сообществ с наибольшим числом подписчиков"""
+        communities = repository.popular_communities(conn, n)
+        for community in communities:
+            self._put(community)
+        return len(communities)
+
+    def info(self):
+        with self._lock:
+            lookups = self.stats['hits'] + self.stats['misses']
+            return dict(self.stats, entries=len(self._entries), max_entries=self.max_entries, ttl=self.ttl,
+                        hit_ratio=round(self.stats['hits'] / lookups, 3) if lookups else None)
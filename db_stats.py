@@ -0,0 +1,215 @@
+"""Статистика базы данных для админской страницы /debug/db.
+
+Все показатели дешевы настолько, чтобы страницу можно было опрашивать:
+число строк берется из счетчиков table_rows, которые ведут триггеры,
+размеры таблиц и индексов - из виртуальной таблицы dbstat. Она читает все
+страницы файла, поэтому страница ее не ждет: устаревший результат
+пересчитывается в фоновом потоке со своим соединением (вне бюджета времени
+запроса), а страница показывает последний готовый, пока новый не посчитан.
+Остальное - PRAGMA и размер файла WAL. Медленные запросы записывает
+repository.fetch.
+
+Запуск:
+  python db_stats.py           - показать статистику instance/app.db
+"""
+import heapq
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import deque
+
+import query_cache
+import sharding
+
+# Таблицы, для которых триггеры ведут счетчик строк
+COUNTED_TABLES = query_cache.TRACKED_TABLES
+
+
+def install_row_count_triggers(conn, tables=COUNTED_TABLES):
+    """Создает table_rows и триггеры, меняющие счетчик при вставке и удалении"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS table_rows (
+            name TEXT PRIMARY KEY,
+            row_count INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    for table in tables:
+        for event, delta in (('INSERT', 1), ('DELETE', -1)):
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS rows_{table}_{event.lower()}
+                AFTER {event} ON {table}
+                BEGIN
+                    INSERT INTO table_rows (name, row_count) VALUES ('{table}', {delta})
+                    ON CONFLICT(name) DO UPDATE SET row_count = row_count + {delta};
+                END
+            ''')
+    seed_row_counts(conn, tables)
+
+
+def seed_row_counts(conn, tables):
+    """Один раз считает COUNT(*) для таблиц без счетчика, дальше его ведут триггеры"""
+    for table in tables:
+        conn.execute(f'''
+            INSERT OR IGNORE INTO table_rows (name, row_count)
+            SELECT '{table}', COUNT(*) FROM {table}
+        ''')
+
+
+def seed_shard_row_counts(db_path):
+    """Заполняет счетчики в шардах, созданных до появления table_rows"""
+    conn = sqlite3.connect(db_path)
+    try:
+        count = sharding.read_shard_count(conn)
+    finally:
+        conn.close()
+    for shard in range(count):
+        shard_conn = sqlite3.connect(sharding.shard_path(db_path, shard))
+        try:
+            seed_row_counts(shard_conn, sharding.SHARDED_TABLES)
+            shard_conn.commit()
+        finally:
+            shard_conn.close()
+
+
+class SlowQueryLog:
+    """Последние запросы дольше порога (очередь ограниченной длины)"""
+
+    def __init__(self, threshold=0.05, size=200):
+        self.threshold = threshold
+        self._entries = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, sql, seconds):
+        if seconds < self.threshold:
+            return
+        with self._lock:
+            self._entries.append((seconds, time.time(), sql))
+
+    def slowest(self, n=10):
+        """n самых долгих из последних записанных: (секунды, время, запрос)"""
+        with self._lock:
+            entries = list(self._entries)
+        return [(round(seconds, 4), at, ' '.join(sql.split())[:300])
+                for seconds, at, sql in heapq.nlargest(n, entries, key=lambda entry: entry[0])]
+
+
+slow_queries = SlowQueryLog()
+
+_sizes = {}
+_sizes_lock = threading.Lock()
+_scanning = set()
+
+
+def row_counts(conns):
+    """Сумма счетчиков строк по основной базе и шардам"""
+    counts = {}
+    for conn in conns:
+        try:
+            rows = conn.execute('SELECT name, row_count FROM main.table_rows').fetchall()
+        except sqlite3.OperationalError:
+            # База еще не обновлена через init_db.py update
+            continue
+        for name, row_count in rows:
+            counts[name] = counts.get(name, 0) + row_count
+    return counts
+
+
+def file_stats(conn, path):
+    """Страницы, свободный список и размер WAL одного файла"""
+    page_size = conn.execute('PRAGMA main.page_size').fetchone()[0]
+    page_count = conn.execute('PRAGMA main.page_count').fetchone()[0]
+    wal_path = path + '-wal'
+    return {
+        'file': os.path.basename(path),
+        'journal_mode': conn.execute('PRAGMA main.journal_mode').fetchone()[0],
+        'page_size': page_size,
+        'page_count': page_count,
+        'freelist_pages': conn.execute('PRAGMA main.freelist_count').fetchone()[0],
+        'file_bytes': page_size * page_count,
+        'wal_bytes': os.path.getsize(wal_path) if os.path.exists(wal_path) else 0,
+    }
+
+
+def scan_sizes(path):
+    """Проходит файл через dbstat своим соединением и кладет размеры в кэш"""
+    conn = sqlite3.connect(path)
+    try:
+        rows = conn.execute('''
+            SELECT s.name, coalesce(m.type, 'table'), coalesce(m.tbl_name, s.name), s.pgsize
+            FROM dbstat AS s
+            LEFT JOIN main.sqlite_master AS m ON m.name = s.name
+            WHERE s.aggregate = TRUE
+            ORDER BY s.pgsize DESC
+        ''').fetchall()
+    finally:
+        conn.close()
+    sizes = [{'name': row[0], 'type': row[1], 'table': row[2], 'bytes': row[3]} for row in rows]
+    with _sizes_lock:
+        _sizes[path] = (time.monotonic(), sizes)
+    return sizes
+
+
+def _scan_in_background(path):
+    try:
+        scan_sizes(path)
+    except sqlite3.Error as e:
+        print(f"dbstat scan of {path} failed: {e}")
+    finally:
+        with _sizes_lock:
+            _scanning.discard(path)
+
+
+def object_sizes(path, ttl=60.0, wait=False):
+    """Размер каждой таблицы и индекса на диске или None, если он еще не посчитан.
+
+    Результат старше ttl секунд пересчитывается в фоне (wait=True - сразу, для консоли).
+    """
+    with _sizes_lock:
+        cached = _sizes.get(path)
+        if cached is not None and time.monotonic() - cached[0] < ttl:
+            return cached[1]
+        if not wait:
+            if path not in _scanning:
+                _scanning.add(path)
+                threading.Thread(target=_scan_in_background, args=(path,), daemon=True).start()
+            return cached[1] if cached else None
+    return scan_sizes(path)
+
+
+def collect(main, shard_conns, db_path, size_ttl=60.0, wait=False):
+    """Статистика основной базы и шардов (shard_conns - по порядку номеров)"""
+    files = [(main, db_path)]
+    files.extend((conn, sharding.shard_path(db_path, shard)) for shard, conn in enumerate(shard_conns))
+
+    stats = {'row_counts': row_counts(conn for conn, _ in files), 'files': []}
+    for conn, path in files:
+        info = file_stats(conn, path)
+        info['objects'] = object_sizes(path, size_ttl, wait)
+        stats['files'].append(info)
+    return stats
+
+
+if __name__ == '__main__':
+    db_path = 'instance/app.db'
+    if not os.path.exists(db_path):
+        print("Database does not exist!")
+        sys.exit(1)
+
+    main = sqlite3.connect(db_path)
+    shard_conns = [sharding.connect_shard(db_path, i) for i in range(sharding.read_shard_count(main))]
+    stats = collect(main, shard_conns, db_path, wait=True)
+
+    print("Row counts:")
+    for name, row_count in sorted(stats['row_counts'].items()):
+        print(f"  {name}: {row_count}")
+    for info in stats['files']:
+        print(f"\n{info['file']}: {info['page_count']} pages x {info['page_size']} B, "
+              f"{info['freelist_pages']} free, WAL {info['wal_bytes']} B ({info['journal_mode']})")
+        for obj in info['objects']:
+            print(f"  {obj['type']:<6} {obj['name']:<40} {obj['bytes']:>12}")
+
+    for conn in shard_conns:
+        conn.close()
+    main.close()
@@ -0,0 +1,218 @@
+"""Потоковая выгрузка данных сообщества или пользователя в NDJSON или CSV.
+
+Строки читаются порциями фиксированного размера по ключу индекса
+(WHERE key > последний ключ ORDER BY key LIMIT n), поэтому расход памяти
+не зависит от объема данных, а каждая порция - отдельное короткое чтение,
+не мешающее писателям. Сжатие gzip выполняется на лету.
+
+Запуск:
+  python export.py community <name> [ndjson|csv] [--gzip] [--out DIR]
+  python export.py user <username> [ndjson|csv] [--gzip] [--out DIR]
+"""
+import csv
+import io
+import json
+import os
+import sqlite3
+import sys
+import zlib
+
+import sharding
+
+EXPORT_TABLES = ('posts', 'comments', 'votes', 'bookmarks')
+
+
+def community_plan(community_db, community_id, schema='main'):
+    """Запросы выгрузки сообщества: (таблица, соединение, sql, параметры, ключ).
+
+    Все читается из базы постов сообщества; закладки лежат в основной базе -
+    при шардировании она подключена к шарду под именем schema.
+    CROSS JOIN фиксирует порядок обхода: таблица сканируется по своему ключу,
+    а сообщество проверяется по посту.
+    """
+    return [
+        ('posts', community_db, '''
+            SELECT * FROM posts
+            WHERE community_id = ? AND id > ?
+            ORDER BY id LIMIT ?
+        ''', (community_id,), 'id'),
+        ('comments', community_db, '''
+            SELECT c.* FROM comments c CROSS JOIN posts p ON p.id = c.post_id
+            WHERE p.community_id = ? AND c.id > ?
+            ORDER BY c.id LIMIT ?
+        ''', (community_id,), 'id'),
+        ('votes', community_db, '''
+            SELECT v.* FROM votes v CROSS JOIN posts p ON p.id = v.post_id
+            WHERE p.community_id = ? AND v.id > ?
+            ORDER BY v.id LIMIT ?
+        ''', (community_id,), 'id'),
+        ('bookmarks', community_db, f'''
+            SELECT b.* FROM {schema}.bookmarks b CROSS JOIN posts p ON p.id = b.post_id
+            WHERE p.community_id = ? AND b.id > ?
+            ORDER BY b.id LIMIT ?
+        ''', (community_id,), 'id'),
+    ]
+
+
+def user_plan(main, post_dbs, user_id):
+    """Запросы выгрузки пользователя. Посты, комментарии и голоса читаются
+    из каждого шарда, закладки - из основной базы"""
+    plan = []
+    for db in post_dbs:
+        plan.append(('posts', db, '''
+            SELECT * FROM posts
+            WHERE user_id = ? AND id > ?
+            ORDER BY id LIMIT ?
+        ''', (user_id,), 'id'))
+    for db in post_dbs:
+        plan.append(('comments', db, '''
+            SELECT * FROM comments
+            WHERE user_id = ? AND id > ?
+            ORDER BY id LIMIT ?
+        ''', (user_id,), 'id'))
+    for db in post_dbs:
+        # Ключ - post_id: его обходит индекс UNIQUE(user_id, post_id)
+        plan.append(('votes', db, '''
+            SELECT * FROM votes
+            WHERE user_id = ? AND post_id > ?
+            ORDER BY post_id LIMIT ?
+        ''', (user_id,), 'post_id'))
+    plan.append(('bookmarks', main, '''
+        SELECT * FROM bookmarks
+        WHERE user_id = ? AND post_id > ?
+        ORDER BY post_id LIMIT ?
+    ''', (user_id,), 'post_id'))
+    return plan
+
+
+def iter_chunks(conn, sql, params, key, chunk_size):
+    """Обходит результат запроса порциями по ключу индекса"""
+    last = 0
+    while True:
+        cursor = conn.execute(sql, (*params, last, chunk_size))
+        columns = [d[0] for d in cursor.description]
+        rows = cursor.fetchall()
+        if not rows:
+            return
+        for row in rows:
+            yield dict(zip(columns, row))
+        last = rows[-1][columns.index(key)]
+        if len(rows) < chunk_size:
+            return
+
+
+def iter_ndjson(plan, tables, chunk_size):
+    for table, conn, sql, params, key in plan:
+        if table not in tables:
+            continue
+        for row in iter_chunks(conn, sql, params, key, chunk_size):
+            yield json.dumps({'type': table, **row}, ensure_ascii=False) + '\n'
+
+
+def iter_csv(plan, table, chunk_size):
+    """CSV одной таблицы (у таблиц разные колонки)"""
+    buffer = io.StringIO()
+    writer = None
+    for plan_table, conn, sql, params, key in plan:
+        if plan_table != table:
+            continue
+        for row in iter_chunks(conn, sql, params, key, chunk_size):
+            if writer is None:
+                writer = csv.DictWriter(buffer, fieldnames=list(row))
+                writer.writeheader()
+            writer.writerow(row)
+            if buffer.tell() > 64 * 1024:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def encode(chunks, compress=False):
+    """Кодирует текстовые порции в UTF-8 и при необходимости сжимает gzip на лету"""
+    if not compress:
+        for chunk in chunks:
+            yield chunk.encode()
+        return
+
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_stream(plan, fmt='ndjson', tables=EXPORT_TABLES, compress=False, chunk_size=500):
+    """Байтовый поток выгрузки"""
+    if fmt == 'csv':
+        chunks = iter_csv(plan, tables[0], chunk_size)
+    else:
+        chunks = iter_ndjson(plan, tables, chunk_size)
+    return encode(chunks, compress)
+
+
+def _connect(db_path):
+    main = sqlite3.connect(db_path)
+    shard_count = sharding.read_shard_count(main)
+    post_dbs = [sharding.connect_shard(db_path, i) for i in range(shard_count)] or [main]
+    return main, shard_count, post_dbs
+
+
+def _write(stream, path):
+    with open(path, 'wb') as f:
+        for chunk in stream:
+            f.write(chunk)
+    print(f"Written {path}")
+
+
+def export_to_files(db_path, kind, name, fmt='ndjson', compress=False, out_dir='.'):
+    """Выгрузка в файлы: один NDJSON или по CSV на таблицу"""
+    main, shard_count, post_dbs = _connect(db_path)
+    try:
+        if kind == 'community':
+            row = main.execute('SELECT id FROM communities WHERE name = ?', (name,)).fetchone()
+            if not row:
+                print(f"Community not found: {name}")
+                return
+            community_db = post_dbs[sharding.shard_for(row[0], shard_count)] if shard_count else main
+            schema = sharding.COMMON_SCHEMA if shard_count else 'main'
+            plan = community_plan(community_db, row[0], schema)
+        else:
+            row = main.execute('SELECT id FROM users WHERE username = ?', (name,)).fetchone()
+            if not row:
+                print(f"User not found: {name}")
+                return
+            plan = user_plan(main, post_dbs, row[0])
+
+        os.makedirs(out_dir, exist_ok=True)
+        suffix = '.gz' if compress else ''
+        if fmt == 'csv':
+            for table in EXPORT_TABLES:
+                path = os.path.join(out_dir, f'{kind}-{name}-{table}.csv{suffix}')
+                _write(export_stream(plan, 'csv', (table,), compress), path)
+        else:
+            path = os.path.join(out_dir, f'{kind}-{name}.ndjson{suffix}')
+            _write(export_stream(plan, 'ndjson', EXPORT_TABLES, compress), path)
+    finally:
+        for db in post_dbs:
+            if db is not main:
+                db.close()
+        main.close()
+
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    out_dir = '.'
+    if '--out' in sys.argv:
+        out_dir = sys.argv[sys.argv.index('--out') + 1]
+        args.remove(out_dir)
+
+    if len(args) >= 2 and args[0] in ('community', 'user'):
+        fmt = args[2] if len(args) > 2 else 'ndjson'
+        export_to_files('instance/app.db', args[0], args[1], fmt, '--gzip' in sys.argv, out_dir)
+    else:
+        print("Available commands:")
+        print("  python export.py community <name> [ndjson|csv] [--gzip] [--out DIR]")
+        print("  python export.py user <username> [ndjson|csv] [--gzip] [--out DIR]")
@@ -1,9 +1,44 @@
 import sqlite3
-import hashlib
 import os
 import re
 import sys
 
+import db_stats
+import media
+import moderation
+import notifications
+import passwords
+import profiles
+import query_cache
+import related
+import revisions
+import rollups
+import sharding
+import simhash
+import startup
+import trending
+
+
+def create_indexes(cursor):
+    """Создает индексы (id входит в каждый индекс как rowid, поэтому
+    WHERE community_id = ? AND id > ? ORDER BY id обходит индекс по порядку)"""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_posts_community ON posts (community_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_posts_user ON posts (user_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_comments_post ON comments (post_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_comments_user ON comments (user_id)")
+    # Ленты активности пользователя: диапазон по времени от курсора
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_posts_user_created ON posts (user_id, created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_comments_user_created ON comments (user_id, created_at)")
+    # Частичные индексы лент: в них только неудаленные строки, а условие removed = 0
+    # в запросах repository.py совпадает с условием индекса
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_posts_live_created ON posts (created_at) WHERE removed = 0")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_posts_live_community "
+                   "ON posts (community_id, created_at) WHERE removed = 0")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_posts_live_hot "
+                   "ON posts ((upvotes - downvotes), created_at) WHERE removed = 0")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_comments_live_post "
+                   "ON comments (post_id, created_at) WHERE removed = 0")
+
 
 def init_database():
     # Создаем папку если её нет
@@ -16,6 +51,10 @@ def init_database():
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
 
+    # Режим задается до создания первой таблицы: освободившиеся страницы
+    # возвращает фоновая задача maintenance.py (PRAGMA incremental_vacuum)
+    cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+
     # Таблица пользователей
     print("Creating users table...")
     cursor.execute('''
@@ -25,7 +64,8 @@ def init_database():
         email TEXT UNIQUE NOT NULL,
         password_hash TEXT NOT NULL,
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        karma INTEGER DEFAULT 0
+        karma INTEGER DEFAULT 0,
+        unread_notifications INTEGER DEFAULT 0
     )
     ''')
 
@@ -59,6 +99,9 @@ def init_database():
     )
     ''')
 
+    # Почасовые счетчики подписок для сообществ в тренде
+    trending.install_subscription_buckets(conn)
+
     # Таблица постов
     print("Creating posts table...")
     cursor.execute('''
@@ -73,6 +116,8 @@ def init_database():
         downvotes INTEGER DEFAULT 0,
         comments_count INTEGER DEFAULT 0,
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        removed INTEGER DEFAULT 0, -- 1 - удален модератором
+        edited_at TIMESTAMP,       -- время последней правки (история в post_revisions)
         FOREIGN KEY (user_id) REFERENCES users (id),
         FOREIGN KEY (community_id) REFERENCES communities (id)
     )
@@ -88,6 +133,7 @@ def init_database():
         post_id INTEGER NOT NULL,
         parent_id INTEGER,
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        removed INTEGER DEFAULT 0,
         FOREIGN KEY (user_id) REFERENCES users (id),
         FOREIGN KEY (post_id) REFERENCES posts (id),
         FOREIGN KEY (parent_id) REFERENCES comments (id)
@@ -102,12 +148,17 @@ def init_database():
         user_id INTEGER NOT NULL,
         post_id INTEGER NOT NULL,
         vote_type TEXT NOT NULL, -- 'up' or 'down'
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         UNIQUE(user_id, post_id),
         FOREIGN KEY (user_id) REFERENCES users (id),
         FOREIGN KEY (post_id) REFERENCES posts (id)
     )
     ''')
 
+    # Почасовые итоги голосов для списков "лучшее за период"
+    print("Creating vote rollups...")
+    rollups.install_vote_rollups(conn)
+
     # Таблица закладок
     print("Creating bookmarks table...")
     cursor.execute('''
@@ -122,6 +173,39 @@ def init_database():
     )
     ''')
 
+    # Похожие посты (заполняет python related.py)
+    related.install_related_posts(conn)
+
+    # Отпечатки SimHash для поиска почти одинаковых постов
+    simhash.install_post_fingerprints(conn)
+
+    # Уведомления о комментариях и ответах
+    notifications.install_notifications(conn)
+
+    # Баны в сообществах
+    moderation.install_community_bans(conn)
+
+    # Изображения постов
+    media.install_media(conn)
+
+    # История правок постов
+    revisions.install_post_revisions(conn)
+
+    # Счетчики для шапки профиля
+    profiles.install_user_counters(conn)
+
+    # Индексы для выборок по сообществу, автору и посту
+    print("Creating indexes...")
+    create_indexes(cursor)
+
+    # Счетчики поколений таблиц для кэша запросов
+    print("Creating table generation triggers...")
+    query_cache.install_generation_triggers(conn)
+
+    # Счетчики строк для статистики базы
+    print("Creating row count triggers...")
+    db_stats.install_row_count_triggers(conn)
+
     # Проверяем, есть ли тестовый пользователь
     cursor.execute("SELECT COUNT(*) FROM users")
     user_count = cursor.fetchone()[0]
@@ -129,7 +213,7 @@ def init_database():
     if user_count == 0:
         print("Creating test user...")
         # Создаем тестового пользователя (пароль: test123)
-        password_hash = hashlib.sha256('test123'.encode()).hexdigest()
+        password_hash = passwords.make_hash('test123')
         try:
             cursor.execute(
                 "INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)",
@@ -177,6 +261,7 @@ def init_database():
                 "UPDATE posts SET comments_count = 1 WHERE id = ?",
                 (post_id,)
             )
+            profiles.add(conn, user_id, posts=1, comments=1)
 
         except sqlite3.IntegrityError as e:
             print(f"Error creating test data: {e}")
@@ -206,6 +291,10 @@ def init_database():
     comments = cursor.fetchone()[0]
     print(f"Comments in database: {comments}")
 
+    # Версия схемы: при следующем старте приложение не будет проверять таблицы
+    startup.mark_schema_current(conn)
+    conn.commit()
+
     conn.close()
     print("=== DATABASE INITIALIZATION COMPLETE ===")
 
@@ -228,7 +317,8 @@ def update_database():
                     email TEXT UNIQUE NOT NULL,
                     password_hash TEXT NOT NULL,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    karma INTEGER DEFAULT 0
+                    karma INTEGER DEFAULT 0,
+                    unread_notifications INTEGER DEFAULT 0
                 )
             '''),
             ('communities', '''
@@ -267,6 +357,8 @@ def update_database():
                     downvotes INTEGER DEFAULT 0,
                     comments_count INTEGER DEFAULT 0,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    removed INTEGER DEFAULT 0, -- 1 - удален модератором
+                    edited_at TIMESTAMP,       -- время последней правки (история в post_revisions)
                     FOREIGN KEY (user_id) REFERENCES users (id),
                     FOREIGN KEY (community_id) REFERENCES communities (id)
                 )
@@ -279,6 +371,7 @@ def update_database():
                     post_id INTEGER NOT NULL,
                     parent_id INTEGER,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    removed INTEGER DEFAULT 0,
                     FOREIGN KEY (user_id) REFERENCES users (id),
                     FOREIGN KEY (post_id) REFERENCES posts (id),
                     FOREIGN KEY (parent_id) REFERENCES comments (id)
@@ -290,6 +383,7 @@ def update_database():
                     user_id INTEGER NOT NULL,
                     post_id INTEGER NOT NULL,
                     vote_type TEXT NOT NULL, -- 'up' or 'down'
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     UNIQUE(user_id, post_id),
                     FOREIGN KEY (user_id) REFERENCES users (id),
                     FOREIGN KEY (post_id) REFERENCES posts (id)
@@ -325,7 +419,7 @@ def update_database():
 
         # Добавляем недостающие колонки в posts
         required_columns = ['id', 'title', 'content', 'user_id', 'community_id',
-                            'post_type', 'upvotes', 'downvotes', 'comments_count', 'created_at']
+                            'post_type', 'upvotes', 'downvotes', 'comments_count', 'created_at', 'removed', 'edited_at']
 
         for column in required_columns:
             if column not in columns:
@@ -338,6 +432,12 @@ def update_database():
                 elif column == 'post_type':
                     cursor.execute("ALTER TABLE posts ADD COLUMN post_type TEXT DEFAULT 'text'")
                     print(f"Added column {column} to posts table")
+                elif column == 'removed':
+                    cursor.execute("ALTER TABLE posts ADD COLUMN removed INTEGER DEFAULT 0")
+                    print(f"Added column {column} to posts table")
+                elif column == 'edited_at':
+                    cursor.execute("ALTER TABLE posts ADD COLUMN edited_at TIMESTAMP")
+                    print(f"Added column {column} to posts table")
 
         # Проверяем структуру таблицы comments
         print("\nChecking comments table structure...")
@@ -349,6 +449,10 @@ def update_database():
             cursor.execute("ALTER TABLE comments ADD COLUMN parent_id INTEGER REFERENCES comments(id)")
             print("Added column parent_id to comments table")
 
+        if 'removed' not in comment_columns:
+            cursor.execute("ALTER TABLE comments ADD COLUMN removed INTEGER DEFAULT 0")
+            print("Added column removed to comments table")
+
         # Проверяем структуру таблицы users
         print("\nChecking users table structure...")
         cursor.execute("PRAGMA table_info(users)")
@@ -359,6 +463,63 @@ def update_database():
             cursor.execute("ALTER TABLE users ADD COLUMN karma INTEGER DEFAULT 0")
             print("Added column karma to users table")
 
+        # Счетчик непрочитанных уведомлений (поддерживается notifications.py)
+        if 'unread_notifications' not in user_columns:
+            cursor.execute("ALTER TABLE users ADD COLUMN unread_notifications INTEGER DEFAULT 0")
+            print("Added column unread_notifications to users table")
+
+        # Время голоса (у старых голосов его нет, в итоги они не попадают)
+        cursor.execute("PRAGMA table_info(votes)")
+        vote_columns = [column[1] for column in cursor.fetchall()]
+        if 'created_at' not in vote_columns:
+            cursor.execute("ALTER TABLE votes ADD COLUMN created_at TIMESTAMP")
+            print("Added column created_at to votes table")
+
+        # Почасовые итоги голосов для списков "лучшее за период"
+        rollups.install_vote_rollups(conn)
+
+        # Почасовые счетчики подписок для сообществ в тренде
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='subscription_buckets'")
+        if not cursor.fetchone():
+            trending.install_subscription_buckets(conn)
+            trending.backfill(conn)
+            print("Created subscription_buckets from last week's subscriptions")
+
+        # Похожие посты (заполняет python related.py)
+        related.install_related_posts(conn)
+
+        # Отпечатки SimHash для поиска почти одинаковых постов
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='post_fingerprints'")
+        if not cursor.fetchone():
+            simhash.install_post_fingerprints(conn)
+            print("Created post_fingerprints; run python simhash.py backfill for existing posts")
+
+        # Уведомления о комментариях и ответах
+        notifications.install_notifications(conn)
+
+        # Баны в сообществах
+        moderation.install_community_bans(conn)
+
+        # Изображения постов
+        media.install_media(conn)
+
+        # История правок постов
+        revisions.install_post_revisions(conn)
+
+        # Счетчики для шапки профиля (поддерживаются приложением, см. profiles.py)
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='user_counters'")
+        recount_profiles = not cursor.fetchone()
+        profiles.install_user_counters(conn)
+
+        # Индексы для выборок по сообществу, автору и посту
+        create_indexes(cursor)
+
+        # Счетчики поколений таблиц для кэша запросов
+        query_cache.install_generation_triggers(conn)
+
+        # Счетчики строк для статистики базы
+        db_stats.install_row_count_triggers(conn)
+
         # Проверяем существование тестовых данных
         print("\nChecking test data...")
         cursor.execute("SELECT COUNT(*) FROM users WHERE username = 'testuser'")
@@ -366,7 +527,7 @@ def update_database():
 
         if not test_user_exists:
             print("Creating test user...")
-            password_hash = hashlib.sha256('test123'.encode()).hexdigest()
+            password_hash = passwords.make_hash('test123')
             cursor.execute(
                 "INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)",
                 ('testuser', 'test@example.com', password_hash)
@@ -420,6 +581,23 @@ def update_database():
 
         conn.commit()
 
+        cursor.execute("PRAGMA auto_vacuum")
+        if cursor.fetchone()[0] != 2:
+            print("auto_vacuum is not INCREMENTAL: run 'python maintenance.py enable-incremental' "
+                  "while the app is stopped to let maintenance shrink the file")
+
+        # Переносим новые колонки и индексы в шарды, если они есть
+        shard_count = sharding.sync_shard_schema('instance/app.db')
+        if shard_count:
+            print(f"Synced schema of {shard_count} shard(s)")
+            db_stats.seed_shard_row_counts('instance/app.db')
+
+        if recount_profiles:
+            profiles.recount('instance/app.db')
+
+        startup.mark_schema_current(conn)
+        conn.commit()
+
         # Выводим итоговую статистику
         print("\n=== DATABASE STATUS ===")
         cursor.execute("SELECT COUNT(*) FROM users")
@@ -0,0 +1,126 @@
+"""Внутрипроцессный pub/sub для живых обновлений через Server-Sent Events.
+
+Маршруты записи публикуют события (голос, комментарий, новый пост), а каждое
+SSE-соединение подписано только на посты, которые есть у клиента на экране.
+Незабранные события по одному посту схлопываются в последнее значение,
+поэтому память на соединение ограничена числом отслеживаемых постов, а
+медленный клиент просто получает реже, но свежие данные.
+"""
+import json
+import threading
+import time
+from collections import deque
+
+
+class Subscription:
+    """Подписка одного SSE-соединения"""
+
+    def __init__(self, post_ids, feed, max_new_posts):
+        self.post_ids = frozenset(post_ids)
+        self.feed = feed
+        self.ready = threading.Event()
+        self.closed = False
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._new_posts = deque(maxlen=max_new_posts)
+
+    def push(self, event, post_id, data):
+        with self._lock:
+            if event == 'post':
+                self._new_posts.append(data)
+            else:
+                # Следующее обновление того же поста заменяет предыдущее
+                self._pending[(event, post_id)] = data
+        self.ready.set()
+
+    def drain(self):
+        with self._lock:
+            events = [(event, data) for (event, _), data in self._pending.items()]
+            events.extend(('post', data) for data in self._new_posts)
+            self._pending.clear()
+            self._new_posts.clear()
+            self.ready.clear()
+        return events
+
+
+class Hub:
+    """Раздает события подписчикам, заинтересованным в конкретных постах"""
+
+    def __init__(self, max_connections=500, max_posts=100, max_new_posts=20):
+        self.max_connections = max_connections
+        self.max_posts = max_posts
+        self.max_new_posts = max_new_posts
+        self._lock = threading.Lock()
+        self._by_post = {}
+        self._feed = set()
+        self._count = 0
+        self.stats = {'published': 0, 'delivered': 0, 'rejected': 0}
+
+    def subscribe(self, post_ids, feed=False):
+        """Новая подписка или None, если соединений уже слишком много"""
+        sub = Subscription(list(post_ids)[:self.max_posts], feed, self.max_new_posts)
+        with self._lock:
+            if self._count >= self.max_connections:
+                self.stats['rejected'] += 1
+                return None
+            self._count += 1
+            for post_id in sub.post_ids:
+                self._by_post.setdefault(post_id, set()).add(sub)
+            if feed:
+                self._feed.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            if sub.closed:
+                return
+            sub.closed = True
+            self._count -= 1
+            for post_id in sub.post_ids:
+                subs = self._by_post.get(post_id)
+                if subs is not None:
+                    subs.discard(sub)
+                    if not subs:
+                        del self._by_post[post_id]
+            self._feed.discard(sub)
+        sub.ready.set()
+
+    def publish(self, event, post_id, data):
+        """Отправляет событие всем, кто следит за постом (новые посты - подписчикам ленты)"""
+        with self._lock:
+            self.stats['published'] += 1
+            if event == 'post':
+                subs = list(self._feed)
+            else:
+                subs = list(self._by_post.get(post_id, ()))
+            self.stats['delivered'] += len(subs)
+        for sub in subs:
+            sub.push(event, post_id, data)
+
+    def info(self):
+        with self._lock:
+            return dict(self.stats, connections=self._count, watched_posts=len(self._by_post))
+
+
+def format_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def stream(hub, sub, coalesce=0.3, heartbeat=15.0):
+    """Генератор SSE-потока для подписки.
+
+    После первого события ждет coalesce секунд, чтобы собрать пачку обновлений,
+    и раз в heartbeat секунд шлет комментарий, чтобы прокси не закрыли соединение.
+    """
+    try:
+        yield 'retry: 3000\n\n'
+        while not sub.closed:
+            if not sub.ready.wait(heartbeat):
+                yield ': ping\n\n'
+                continue
+            time.sleep(coalesce)
+            events = sub.drain()
+            if events:
+                yield ''.join(format_event(event, data) for event, data in events)
+    finally:
+        hub.unsubscribe(sub)
@@ -0,0 +1,241 @@
+"""Фоновое обслуживание базы: статистика планировщика, возврат места, checkpoint WAL.
+
+Каждая задача проходит по основному файлу и шардам и работает в рамках
+бюджета времени: соединение ждет блокировку не дольше бюджета, а SQL
+прерывается обработчиком прогресса, когда бюджет кончился. Поэтому задача
+может не успеть все, но никогда не задерживает запросы надолго -
+недоделанное продолжит следующий запуск.
+
+Задачи:
+  optimize    - PRAGMA optimize (ANALYZE только устаревших таблиц, с analysis_limit)
+  vacuum      - PRAGMA incremental_vacuum порциями, пока есть свободные страницы
+  checkpoint  - PRAGMA wal_checkpoint: PASSIVE, а TRUNCATE, если WAL разросся
+                (только для баз в режиме WAL; по умолчанию не запускается - app.db и
+                шарды пишутся с журналом отката: транзакция шарда вместе с
+                подключенной основной базой атомарна только в этом режиме)
+  rollups     - свернуть старые часовые итоги голосов в дневные (rollups.py)
+  trending    - удалить корзины подписок старше недели (trending.py)
+  notifications - удалить старые прочитанные уведомления (notifications.py)
+  media       - удалить файлы медиа без ссылок и брошенные загрузки (media.py)
+
+Запуск:
+  python maintenance.py [задача ...]       - выполнить задачи сейчас (по умолчанию все)
+  python maintenance.py enable-incremental - включить auto_vacuum=INCREMENTAL (VACUUM, при остановленном приложении)
+"""
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime
+
+import backup
+import media
+import notifications
+import rollups
+import trending
+
+# Сколько страниц освобождать за один PRAGMA incremental_vacuum
+VACUUM_STEP_PAGES = 256
+
+# Сколько строк индекса читать при ANALYZE (0 - без ограничения)
+ANALYSIS_LIMIT = 400
+
+# Размер WAL, после которого checkpoint обрезает файл
+WAL_TRUNCATE_BYTES = 64 * 1024 * 1024
+
+# Расписание по умолчанию: период в секундах и окно (None - в любое время)
+DEFAULT_TASKS = {
+    'vacuum': {'every': 600, 'window': None},
+    'optimize': {'every': 3600, 'window': None},
+    'rollups': {'every': 3600, 'window': None},
+    'trending': {'every': 3600, 'window': None},
+    'notifications': {'every': 86400, 'window': None},
+    'media': {'every': 3600, 'window': None},
+}
+
+# Метрики задач (читаются из /debug/maintenance)
+maintenance_stats = {}
+_stats_lock = threading.Lock()
+
+
+def optimize(conn, deadline):
+    conn.execute(f'PRAGMA analysis_limit = {ANALYSIS_LIMIT}')
+    conn.execute('PRAGMA optimize').fetchall()
+    return 'optimized'
+
+
+def incremental_vacuum(conn, deadline):
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        return 'skipped: auto_vacuum is not INCREMENTAL'
+    freed = 0
+    while time.monotonic() < deadline:
+        free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if not free:
+            break
+        step = min(free, VACUUM_STEP_PAGES)
+        # Каждый шаг оператора освобождает одну страницу, а execute() делает только
+        # первый шаг; executescript выполняет оператор до конца
+        conn.executescript(f'PRAGMA incremental_vacuum({step})')
+        freed += step
+    return f'freed {freed} pages'
+
+
+def checkpoint(conn, deadline):
+    journal_mode = conn.execute('PRAGMA journal_mode').fetchone()[0]
+    if journal_mode != 'wal':
+        return f'skipped: journal_mode={journal_mode}'
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    mode = 'PASSIVE'
+    # Размер WAL в страницах известен только после checkpoint, поэтому
+    # TRUNCATE выбирается по результату предыдущего PASSIVE
+    busy, wal_pages, done = conn.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+    if wal_pages * page_size > WAL_TRUNCATE_BYTES and time.monotonic() < deadline:
+        mode = 'TRUNCATE'
+        busy, wal_pages, done = conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+    return f'{mode}: {done}/{wal_pages} pages{" (busy)" if busy else ""}'
+
+
+def compact_rollups(conn, deadline):
+    return f'compacted {rollups.compact(conn)} hourly rows'
+
+
+def prune_trending(conn, deadline):
+    # Корзины подписок есть только в основной базе
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'subscription_buckets'").fetchone():
+        return 'skipped'
+    return f'pruned {trending.prune(conn)} buckets'
+
+
+def prune_notifications(conn, deadline):
+    # Уведомления есть только в основной базе
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'notifications'").fetchone():
+        return 'skipped'
+    return f'pruned {notifications.prune(conn)} read notifications'
+
+
+def collect_media(conn, deadline):
+    # Учет файлов медиа есть только в основной базе
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'media_files'").fetchone():
+        return 'skipped'
+    collected, swept = media.storage.collect(conn, deadline)
+    return f'deleted {collected} unreferenced and {swept} untracked media files'
+
+
+TASKS = {
+    'optimize': optimize,
+    'vacuum': incremental_vacuum,
+    'checkpoint': checkpoint,
+    'rollups': compact_rollups,
+    'trending': prune_trending,
+    'notifications': prune_notifications,
+    'media': collect_media,
+}
+
+
+def _record(name, **values):
+    with _stats_lock:
+        stats = maintenance_stats.setdefault(name, {
+            'runs': 0, 'failures': 0, 'interrupted': 0,
+            'last_run': None, 'last_duration': None, 'last_result': None,
+        })
+        stats['runs'] += 1
+        for key in ('failures', 'interrupted'):
+            stats[key] += values.pop(key, 0)
+        stats.update(values)
+
+
+def run_task(db_path, name, budget=0.2):
+    """Выполняет задачу для всех файлов базы, каждому файлу - свой бюджет в секундах"""
+    task = TASKS[name]
+    started = time.perf_counter()
+    results = []
+    failures = interrupted = 0
+
+    for path in backup.database_files(db_path):
+        deadline = time.monotonic() + budget
+        conn = sqlite3.connect(path, timeout=budget)
+        conn.set_progress_handler(lambda: time.monotonic() > deadline, 1000)
+        try:
+            results.append(task(conn, deadline))
+        except sqlite3.OperationalError as e:
+            # Бюджет кончился или файл занят дольше бюджета - продолжим в следующий раз
+            if 'interrupted' in str(e) or 'locked' in str(e) or 'busy' in str(e):
+                interrupted += 1
+            else:
+                failures += 1
+            results.append(f'error: {e}')
+        finally:
+            conn.close()
+
+    duration = time.perf_counter() - started
+    _record(name, failures=failures, interrupted=interrupted,
+            last_run=datetime.now().isoformat(timespec='seconds'),
+            last_duration=round(duration, 3), last_result='; '.join(results))
+    return results
+
+
+def in_window(window, now=None):
+    """Попадает ли время в окно ('HH:MM', 'HH:MM'); окно может переходить через полночь"""
+    if window is None:
+        return True
+    now = (now or datetime.now()).strftime('%H:%M')
+    start, end = window
+    if start <= end:
+        return start <= now < end
+    return now >= start or now < end
+
+
+def start_scheduler(db_path, tasks=None, budget=0.2, tick=10):
+    """Запускает фоновый поток, который раз в tick секунд выполняет задачи, чей срок
+    подошел и чье окно открыто. tasks - {имя: {'every': секунды, 'window': окно}}"""
+    tasks = tasks or DEFAULT_TASKS
+    last_run = {name: time.monotonic() for name in tasks}
+
+    def run():
+        while True:
+            time.sleep(tick)
+            for name, schedule in tasks.items():
+                if time.monotonic() - last_run[name] < schedule['every']:
+                    continue
+                if not in_window(schedule.get('window')):
+                    continue
+                last_run[name] = time.monotonic()
+                try:
+                    run_task(db_path, name, budget)
+                except Exception as e:
+                    print(f"Maintenance task {name} failed: {e}")
+
+    thread = threading.Thread(target=run, name='maintenance-scheduler', daemon=True)
+    thread.start()
+    return thread
+
+
+def enable_incremental_vacuum(db_path):
+    """Включает auto_vacuum=INCREMENTAL в существующих файлах (нужен полный VACUUM)"""
+    for path in backup.database_files(db_path):
+        conn = sqlite3.connect(path)
+        try:
+            if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+                print(f"{path}: already INCREMENTAL")
+                continue
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('VACUUM')
+            print(f"{path}: auto_vacuum=INCREMENTAL")
+        finally:
+            conn.close()
+
+
+if __name__ == '__main__':
+    DATABASE = 'instance/app.db'
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'enable-incremental':
+        enable_incremental_vacuum(DATABASE)
+    elif all(arg in TASKS for arg in sys.argv[1:]):
+        for name in sys.argv[1:] or TASKS:
+            # Из консоли приложение может быть остановлено, поэтому бюджет щедрее
+            for result in run_task(DATABASE, name, budget=5.0):
+                print(f"{name}: {result}")
+    else:
+        print("Available commands:")
+        print("  python maintenance.py [optimize|vacuum|checkpoint|rollups|trending|notifications ...]  - Run tasks now")
+        print("  python maintenance.py enable-incremental                                               - Switch files to auto_vacuum=INCREMENTAL")
@@ -0,0 +1,356 @@
+"""Хранилище изображений постов, адресуемое по содержимому.
+
+Файл хранится под своим SHA-256 в каталоге root/ab/cd/<sha256>, поэтому
+одинаковые загрузки занимают место один раз, а имя файла никогда не
+меняет содержимое - его можно отдавать с Cache-Control: immutable.
+
+Загрузка не буферизуется в памяти: приложение подменяет поток файла
+multipart (Request._get_file_stream) на UploadFile, и werkzeug пишет
+части запроса прямо во временный файл в root/tmp, а SHA-256 и размер
+считаются на лету. После разбора запроса файл переименовывается в
+итоговый путь (или удаляется, если такой уже есть) - второй раз его не
+читают. Формат определяется по первым байтам, а не по имени и заголовкам.
+
+В основной базе media_files хранит размер, тип и число ссылок (refcount),
+а post_media - какие файлы у какого поста. refcount ведут триггеры на
+post_media. Файлы без ссылок удаляет задача обслуживания media (collect)
+не раньше чем через ORPHAN_GRACE секунд: за это время загрузка успевает
+сослаться на файл. Она же удаляет брошенные временные файлы и по одному
+каталогу за запуск сверяет диск с базой (файл, записанный до отката
+транзакции поста, остается на диске без строки в media_files).
+
+Запуск:
+  python media.py gc   - удалить все файлы без ссылок и проверить весь каталог
+"""
+import hashlib
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+from werkzeug.exceptions import RequestEntityTooLarge
+
+DEFAULT_DIR = 'instance/media'
+
+# Размер одного файла и сколько файлов можно приложить к посту
+MAX_BYTES = 16 * 1024 * 1024
+MAX_FILES = 4
+
+# Сколько секунд файл без ссылок (и временный файл) живет до удаления
+ORPHAN_GRACE = 3600
+
+# Сигнатуры поддерживаемых форматов: (смещение, байты, тип)
+SIGNATURES = [
+    (0, b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (0, b'\xff\xd8\xff', 'image/jpeg'),
+    (0, b'GIF87a', 'image/gif'),
+    (0, b'GIF89a', 'image/gif'),
+    (8, b'WEBP', 'image/webp'),
+]
+HEAD_BYTES = 16
+
+MediaFile = namedtuple('MediaFile', ['sha256', 'size', 'content_type'])
+
+PostMedia = namedtuple('PostMedia', ['id', 'sha256', 'media_type', 'content_type', 'size'])
+
+POST_MEDIA_SQL = '''
+    SELECT pm.id, pm.sha256, pm.media_type, f.content_type, f.size
+    FROM post_media pm
+    JOIN media_files f ON f.sha256 = pm.sha256
+    WHERE pm.post_id = ?
+    ORDER BY pm.position, pm.id
+'''
+
+
+def install_media(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS media_files (
+            sha256 TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            content_type TEXT NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            unreferenced_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP  -- когда refcount стал 0
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_media_files_orphans
+        ON media_files (unreferenced_at) WHERE refcount = 0
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS post_media (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            post_id INTEGER NOT NULL,
+            sha256 TEXT NOT NULL REFERENCES media_files (sha256),
+            media_type TEXT NOT NULL DEFAULT 'image',
+            position INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_post_media_post ON post_media (post_id)')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS post_media_ref AFTER INSERT ON post_media
+        BEGIN
+            UPDATE media_files SET refcount = refcount + 1, unreferenced_at = NULL
+            WHERE sha256 = NEW.sha256;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS post_media_unref AFTER DELETE ON post_media
+        BEGIN
+            UPDATE media_files
+            SET refcount = refcount - 1,
+                unreferenced_at = CASE WHEN refcount = 1 THEN CURRENT_TIMESTAMP END
+            WHERE sha256 = OLD.sha256;
+        END
+    ''')
+
+
+def sniff(head):
+    """Тип изображения по первым байтам или None"""
+    for offset, signature, content_type in SIGNATURES:
+        if head[offset:offset + len(signature)] == signature:
+            return content_type
+    return None
+
+
+def is_sha256(value):
+    return len(value) == 64 and all(ch in '0123456789abcdef' for ch in value)
+
+
+class UploadFile:
+    """Временный файл загрузки, который считает SHA-256 и размер по мере записи"""
+
+    def __init__(self, directory, max_bytes=MAX_BYTES):
+        os.makedirs(directory, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(dir=directory, prefix='upload-')
+        self._file = os.fdopen(fd, 'w+b')
+        self._hash = hashlib.sha256()
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.head = b''
+        self.committed = False
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise RequestEntityTooLarge()
+        if len(self.head) < HEAD_BYTES:
+            self.head += data[:HEAD_BYTES - len(self.head)]
+        self._hash.update(data)
+        return self._file.write(data)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    def read(self, *args):
+        return self._file.read(*args)
+
+    def readline(self, *args):
+        return self._file.readline(*args)
+
+    def seek(self, *args):
+        return self._file.seek(*args)
+
+    def tell(self):
+        return self._file.tell()
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        """Закрывает файл; не перенесенный в хранилище временный файл удаляется"""
+        if not self._file.closed:
+            self._file.close()
+        if not self.committed:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+
+class MediaStore:
+    def __init__(self, root=DEFAULT_DIR, max_bytes=MAX_BYTES, grace=ORPHAN_GRACE):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.grace = grace
+        self._sweep_next = 0
+        self._lock = threading.Lock()
+        self.stats = {'stored': 0, 'deduplicated': 0, 'rejected': 0, 'collected': 0, 'swept': 0}
+
+    @property
+    def tmp_dir(self):
+        return os.path.join(self.root, 'tmp')
+
+    def path(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256[2:4], sha256)
+
+    def upload_file(self):
+        """Поток для файла multipart (см. Request._get_file_stream)"""
+        return UploadFile(self.tmp_dir, self.max_bytes)
+
+    def save(self, file_storage):
+        """Переносит загруженный файл в хранилище; возвращает MediaFile.
+
+        ValueError - пустой файл или не изображение.
+        """
+        upload = file_storage.stream
+        if not isinstance(upload, UploadFile):
+            # Поток создан не нашим Request (например, файл из кода) - копируем порциями
+            upload = self.upload_file()
+            while True:
+                chunk = file_storage.stream.read(64 * 1024)
+                if not chunk:
+                    break
+                upload.write(chunk)
+        try:
+            content_type = sniff(upload.head)
+            if not upload.size or content_type is None:
+                self._count('rejected')
+                raise ValueError('Можно загружать только изображения PNG, JPEG, GIF или WebP')
+            sha256 = upload.hexdigest()
+            path = self.path(sha256)
+            if os.path.exists(path):
+                # Обновляем время файла: сборщик не удаляет недавно тронутые файлы
+                os.utime(path)
+                self._count('deduplicated')
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                upload.flush()
+                os.fsync(upload._file.fileno())
+                os.replace(upload.path, path)
+                upload.committed = True
+                self._count('stored')
+            return MediaFile(sha256, upload.size, content_type)
+        finally:
+            upload.close()
+
+    def attach(self, conn, post_id, files, schema='main', media_type='image', first_position=0):
+        """Привязывает сохраненные файлы к посту (в транзакции conn)"""
+        for position, item in enumerate(files, first_position):
+            conn.execute(f'''
+                INSERT INTO {schema}.media_files (sha256, size, content_type) VALUES (?, ?, ?)
+                ON CONFLICT (sha256) DO NOTHING
+            ''', item)
+            conn.execute(f'''
+                INSERT INTO {schema}.post_media (post_id, sha256, media_type, position) VALUES (?, ?, ?, ?)
+            ''', (post_id, item.sha256, media_type, position))
+
+    def detach(self, conn, post_id, ids, schema='main'):
+        """Отвязывает файлы post_media.id от поста; файлы без ссылок потом удалит collect"""
+        ids = [int(i) for i in ids]
+        if not ids:
+            return 0
+        placeholders = ','.join('?' * len(ids))
+        return conn.execute(f'''
+            DELETE FROM {schema}.post_media WHERE post_id = ? AND id IN ({placeholders})
+        ''', [post_id] + ids).rowcount
+
+    def lookup(self, conn, sha256):
+        if not is_sha256(sha256):
+            return None
+        row = conn.execute(
+            'SELECT sha256, size, content_type FROM media_files WHERE sha256 = ?', (sha256,)
+        ).fetchone()
+        return MediaFile(*row) if row else None
+
+    def _unlink_stale(self, path, cutoff):
+        """Удаляет файл, если его не трогали с cutoff; возвращает, удален ли он"""
+        try:
+            if os.stat(path).st_mtime > cutoff:
+                return False
+            os.unlink(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def collect(self, conn, deadline=None):
+        """Удаляет файлы без ссылок, брошенные временные файлы и проверяет один каталог.
+
+        conn - основная база. Возвращает (удалено по refcount, удалено при проверке каталога).
+        """
+        cutoff = time.time() - self.grace
+        collected = 0
+        rows = conn.execute(f'''
+            SELECT sha256 FROM media_files
+            WHERE refcount = 0 AND unreferenced_at < datetime('now', '-{int(self.grace)} seconds')
+        ''').fetchall()
+        for (sha256,) in rows:
+            if deadline is not None and time.monotonic() > deadline:
+                break
+            with conn:
+                deleted = conn.execute(
+                    'DELETE FROM media_files WHERE sha256 = ? AND refcount = 0', (sha256,)
+                ).rowcount
+            if deleted:
+                self._unlink_stale(self.path(sha256), cutoff)
+                collected += 1
+
+        if os.path.isdir(self.tmp_dir):
+            for name in os.listdir(self.tmp_dir):
+                self._unlink_stale(os.path.join(self.tmp_dir, name), cutoff)
+
+        # Проверка диска: по одному каталогу первого уровня (00..ff) за запуск
+        with self._lock:
+            prefix = f'{self._sweep_next:02x}'
+            self._sweep_next = (self._sweep_next + 1) % 256
+        swept = self._sweep(conn, prefix, cutoff)
+
+        with self._lock:
+            self.stats['collected'] += collected
+            self.stats['swept'] += swept
+        return collected, swept
+
+    def _sweep(self, conn, prefix, cutoff):
+        directory = os.path.join(self.root, prefix)
+        if not os.path.isdir(directory):
+            return 0
+        known = {row[0] for row in conn.execute(
+            'SELECT sha256 FROM media_files WHERE sha256 >= ? AND sha256 < ?', (prefix, prefix + 'g')
+        )}
+        swept = 0
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for name in filenames:
+                if name not in known and self._unlink_stale(os.path.join(dirpath, name), cutoff):
+                    swept += 1
+        return swept
+
+    def gc(self, conn):
+        """Полная сборка: файлы без ссылок и проверка всех каталогов за один проход"""
+        collected, swept = self.collect(conn)
+        cutoff = time.time() - self.grace
+        for n in range(256):
+            swept += self._sweep(conn, f'{n:02x}', cutoff)
+        return collected, swept
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def info(self):
+        with self._lock:
+            return dict(self.stats, root=self.root, max_bytes=self.max_bytes, grace=self.grace)
+
+
+def post_media(conn, post_id):
+    return [PostMedia(*row) for row in conn.execute(POST_MEDIA_SQL, (post_id,))]
+
+
+# Хранилище процесса; приложение задает root из MEDIA_DIR
+storage = MediaStore()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 2 and sys.argv[1] == 'gc':
+        conn = sqlite3.connect('instance/app.db')
+        try:
+            collected, swept = storage.gc(conn)
+            print(f"Deleted {collected} unreferenced files and {swept} files missing from media_files")
+        finally:
+            conn.close()
+    else:
+        print("Available commands:")
+        print("  python media.py gc   - Delete unreferenced media files and sweep the whole store")
@@ -0,0 +1,244 @@
+"""Модерация сообществ: мягкое удаление постов и комментариев и баны.
+
+Пост или комментарий не удаляется, а получает removed = 1. Ленты, поиск,
+страница поста и API читают только строки с removed = 0 - это же условие
+стоит у частичных индексов (init_db.create_indexes), поэтому ленты
+по-прежнему идут по индексу в нужном порядке. Владелец сообщества видит
+удаленное в очереди модерации и может вернуть его.
+
+Массовое действие выполняется одной транзакцией в базе постов сообщества:
+id загружаются во временную таблицу порциями по CHUNK_SIZE, а дальше каждое
+изменение - один запрос по всему множеству строк. Счетчики тоже меняются
+одним UPDATE ... FROM по сгруппированным строкам:
+- posts.comments_count - при удалении и возврате комментариев;
+- karma, post_count и comment_count авторов в user_counters шарда (см. profiles.py);
+- communities.subscribers_count и отписки в subscription_buckets (trending.py) -
+  бан отписывает пользователя.
+Строки, уже находящиеся в нужном состоянии, не учитываются, поэтому
+повторное действие ничего не меняет.
+
+При шардировании users, communities, подписки и баны лежат в основной базе,
+подключенной к шарду под именем sharding.COMMON_SCHEMA, - запись в них идет
+в той же транзакции.
+"""
+from collections import namedtuple
+
+import repository
+import trending
+
+# Сколько id загружается во временную таблицу одним executemany
+CHUNK_SIZE = 500
+
+# Сколько записей показывает очередь модерации
+QUEUE_SIZE = 100
+
+ACTIONS = ('remove', 'restore', 'ban', 'unban')
+
+RESULT_LABELS = {
+    'posts': 'постов',
+    'comments': 'комментариев',
+    'banned': 'забанено',
+    'unsubscribed': 'отписано',
+    'unbanned': 'разбанено',
+}
+
+QueueItem = namedtuple('QueueItem', [
+    'kind', 'id', 'post_id', 'title', 'preview', 'user_id', 'username', 'created_at', 'removed',
+])
+
+Ban = namedtuple('Ban', ['user_id', 'username', 'banned_by', 'created_at'])
+
+# removed подставляется в текст запроса: с литералом 0 запрос идет по частичному индексу
+QUEUE_POSTS_SQL = f'''
+    SELECT 'post', p.id, p.id, p.title, substr(p.content, 1, {repository.PREVIEW_CHARS + 1}),
+           p.user_id, u.username, p.created_at, p.removed
+    FROM posts p
+    JOIN users u ON u.id = p.user_id
+    WHERE p.community_id = ? AND p.removed = {{removed}}
+    ORDER BY p.created_at DESC, p.id DESC
+    LIMIT ?
+'''
+
+QUEUE_COMMENTS_SQL = f'''
+    SELECT 'comment', cm.id, cm.post_id, p.title, substr(cm.content, 1, {repository.PREVIEW_CHARS + 1}),
+           cm.user_id, u.username, cm.created_at, cm.removed
+    FROM comments cm
+    JOIN posts p ON p.id = cm.post_id
+    JOIN users u ON u.id = cm.user_id
+    WHERE p.community_id = ? AND cm.removed = {{removed}}
+    ORDER BY cm.created_at DESC, cm.id DESC
+    LIMIT ?
+'''
+
+BANS_SQL = '''
+    SELECT b.user_id, u.username, m.username, b.created_at
+    FROM community_bans b
+    JOIN users u ON u.id = b.user_id
+    LEFT JOIN users m ON m.id = b.banned_by
+    WHERE b.community_id = ?
+    ORDER BY b.created_at DESC
+'''
+
+
+def install_community_bans(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS community_bans (
+            community_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            banned_by INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (community_id, user_id),
+            FOREIGN KEY (community_id) REFERENCES communities (id),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        ) WITHOUT ROWID
+    ''')
+
+
+def is_banned(conn, community_id, user_id):
+    return conn.execute(
+        'SELECT 1 FROM community_bans WHERE community_id = ? AND user_id = ?', (community_id, user_id)
+    ).fetchone() is not None
+
+
+def queue(conn, community_id, kind, removed=False, limit=QUEUE_SIZE):
+    """Последние посты или комментарии сообщества: видимые или удаленные"""
+    sql = QUEUE_POSTS_SQL if kind == 'post' else QUEUE_COMMENTS_SQL
+    return repository.fetch(conn, QueueItem, sql.format(removed=int(removed)), (community_id, limit))
+
+
+def bans(conn, community_id):
+    return repository.fetch(conn, Ban, BANS_SQL, (community_id,))
+
+
+def describe(result):
+    """Итог действия для сообщения, например "постов: 3, комментариев: 12" """
+    return ', '.join(f'{RESULT_LABELS[name]}: {count}' for name, count in result.items())
+
+
+def _load(conn, table, ids):
+    """Заполняет временную таблицу id порциями по CHUNK_SIZE"""
+    conn.execute(f'CREATE TEMP TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY)')
+    conn.execute(f'DELETE FROM temp.{table}')
+    ids = list(ids)
+    for start in range(0, len(ids), CHUNK_SIZE):
+        conn.executemany(f'INSERT OR IGNORE INTO temp.{table} (id) VALUES (?)',
+                         [(int(i),) for i in ids[start:start + CHUNK_SIZE]])
+
+
+def _set_posts(conn, community_id, removed, schema, by):
+    """Меняет флаг постов сообщества, у которых by (id или user_id) есть в temp.mod_ids"""
+    conn.execute('DROP TABLE IF EXISTS temp.mod_posts')
+    conn.execute(f'''
+        CREATE TEMP TABLE mod_posts AS
+        SELECT id, user_id, upvotes - downvotes AS score FROM posts
+        WHERE {by} IN (SELECT id FROM temp.mod_ids) AND community_id IS ? AND removed = ?
+    ''', (community_id, int(not removed)))
+    sign = -1 if removed else 1
+    changed = conn.execute(
+        'UPDATE posts SET removed = ? WHERE id IN (SELECT id FROM temp.mod_posts)', (int(removed),)
+    ).rowcount
+    conn.execute('''
+        INSERT INTO user_counters (user_id, karma, post_count)
+        SELECT user_id, ? * SUM(score), ? * COUNT(*) FROM temp.mod_posts GROUP BY user_id
+        ON CONFLICT (user_id) DO UPDATE SET
+            karma = karma + excluded.karma, post_count = post_count + excluded.post_count
+    ''', (sign, sign))
+    if removed:
+        # Удаленный пост не должен попадать в "похожие посты" до следующего пересчета
+        conn.execute(f'DELETE FROM {schema}.related_posts WHERE related_id IN (SELECT id FROM temp.mod_posts)')
+    return changed
+
+
+def _set_comments(conn, community_id, removed, schema, by):
+    """Меняет флаг комментариев к постам сообщества, у которых by есть в temp.mod_ids"""
+    conn.execute('DROP TABLE IF EXISTS temp.mod_comments')
+    conn.execute(f'''
+        CREATE TEMP TABLE mod_comments AS
+        SELECT cm.id, cm.user_id, cm.post_id FROM comments cm
+        JOIN posts p ON p.id = cm.post_id
+        WHERE cm.{by} IN (SELECT id FROM temp.mod_ids) AND p.community_id IS ? AND cm.removed = ?
+    ''', (community_id, int(not removed)))
+    sign = -1 if removed else 1
+    changed = conn.execute(
+        'UPDATE comments SET removed = ? WHERE id IN (SELECT id FROM temp.mod_comments)', (int(removed),)
+    ).rowcount
+    conn.execute('''
+        UPDATE posts SET comments_count = comments_count + ? * a.comments
+        FROM (SELECT post_id, COUNT(*) AS comments FROM temp.mod_comments GROUP BY post_id) a
+        WHERE posts.id = a.post_id
+    ''', (sign,))
+    conn.execute('''
+        INSERT INTO user_counters (user_id, comment_count)
+        SELECT user_id, ? * COUNT(*) FROM temp.mod_comments GROUP BY user_id
+        ON CONFLICT (user_id) DO UPDATE SET comment_count = comment_count + excluded.comment_count
+    ''', (sign,))
+    return changed
+
+
+def _ban(conn, community, moderator_id, schema):
+    """Банит пользователей из temp.mod_ids: запись в баны, отписка и удаление их постов
+    и комментариев в сообществе"""
+    conn.execute('DELETE FROM temp.mod_ids WHERE id = ?', (community.owner_id,))
+    banned = conn.execute(f'''
+        INSERT OR IGNORE INTO {schema}.community_bans (community_id, user_id, banned_by)
+        SELECT ?, id, ? FROM temp.mod_ids
+    ''', (community.id, moderator_id)).rowcount
+    unsubscribed = conn.execute(f'''
+        DELETE FROM {schema}.community_subscriptions
+        WHERE community_id = ? AND user_id IN (SELECT id FROM temp.mod_ids)
+    ''', (community.id,)).rowcount
+    conn.execute(f'UPDATE {schema}.communities SET subscribers_count = subscribers_count - ? WHERE id = ?',
+                 (unsubscribed, community.id))
+    # Отписки попадают в корзины трендов одной строкой, как и обычная отписка
+    if unsubscribed:
+        trending.record(conn, community.id, joined=False, count=unsubscribed, schema=schema)
+    return {
+        'banned': banned,
+        'unsubscribed': unsubscribed,
+        'posts': _set_posts(conn, community.id, True, schema, 'user_id'),
+        'comments': _set_comments(conn, community.id, True, schema, 'user_id'),
+    }
+
+
+def remove_post(conn, post_id, community_id, schema='main'):
+    """Удаление поста его автором: то же мягкое удаление со счетчиками, что и в очереди
+    модерации. community_id - None для поста без сообщества"""
+    with conn:
+        _load(conn, 'mod_ids', [post_id])
+        return _set_posts(conn, community_id, True, schema, 'id')
+
+
+def apply(conn, community, action, kind, ids, moderator_id=None, schema='main'):
+    """Выполняет массовое действие одной транзакцией; возвращает {что: сколько строк}.
+
+    remove/restore - ids постов или комментариев (kind); ban - ids постов или
+    комментариев, чьи авторы банятся; unban - ids пользователей.
+    conn - база постов сообщества, schema - имя основной базы в этом соединении.
+    """
+    if action not in ACTIONS:
+        raise ValueError(f'Неизвестное действие: {action}')
+    with conn:
+        _load(conn, 'mod_ids', ids)
+        if action in ('remove', 'restore'):
+            set_rows = _set_posts if kind == 'post' else _set_comments
+            return {kind + 's': set_rows(conn, community.id, action == 'remove', schema, 'id')}
+        if action == 'unban':
+            return {'unbanned': conn.execute(f'''
+                DELETE FROM {schema}.community_bans
+                WHERE community_id = ? AND user_id IN (SELECT id FROM temp.mod_ids)
+            ''', (community.id,)).rowcount}
+
+        # Бан по выбранным записям: авторы постов или комментариев сообщества
+        if kind == 'post':
+            authors = conn.execute('''
+                SELECT DISTINCT user_id FROM posts
+                WHERE id IN (SELECT id FROM temp.mod_ids) AND community_id = ?
+            ''', (community.id,)).fetchall()
+        else:
+            authors = conn.execute('''
+                SELECT DISTINCT cm.user_id FROM comments cm
+                JOIN posts p ON p.id = cm.post_id
+                WHERE cm.id IN (SELECT id FROM temp.mod_ids) AND p.community_id = ?
+            ''', (community.id,)).fetchall()
+        _load(conn, 'mod_ids', [row[0] for row in authors])
+        return _ban(conn, community, moderator_id, schema)
@@ -0,0 +1,206 @@
+"""Уведомления о комментариях к постам и ответах на комментарии.
+
+add_comment не пишет уведомления сам, а кладет событие в очередь процесса.
+Очередь сбрасывается пачкой - когда набралось batch_size событий или через
+delay секунд после первого - одной транзакцией: события для одного
+получателя и поста сливаются в дайджест ("3 новых комментария"), пока он не
+прочитан, а счетчик users.unread_notifications увеличивается на число
+событий. Шапка страницы читает этот счетчик по первичному ключу, без COUNT
+по уведомлениям; "прочитать все" - один UPDATE по индексу непрочитанных.
+
+Запуск:
+  python notifications.py prune [дни]  - удалить прочитанные уведомления старше N дней
+"""
+import atexit
+import sqlite3
+import sys
+import threading
+from collections import namedtuple
+
+# Сколько дней хранить прочитанные уведомления
+KEEP_READ_DAYS = 30
+
+Notification = namedtuple('Notification', [
+    'id', 'kind', 'post_id', 'post_title', 'comment_id', 'actor_name', 'count', 'is_read', 'updated_at',
+])
+
+INBOX_SQL = '''
+    SELECT id, kind, post_id, post_title, comment_id, actor_name, count, is_read, updated_at
+    FROM notifications
+    WHERE user_id = ?
+    ORDER BY is_read, updated_at DESC, id DESC
+    LIMIT ?
+'''
+
+
+def install_notifications(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS notifications (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,             -- comment (к посту) или reply (на комментарий)
+            post_id INTEGER NOT NULL,
+            post_title TEXT,
+            comment_id INTEGER,             -- последний комментарий дайджеста
+            actor_name TEXT,                -- автор последнего комментария
+            count INTEGER NOT NULL DEFAULT 1,
+            is_read INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    # Один непрочитанный дайджест на получателя, пост и вид уведомления
+    conn.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_notifications_unread
+        ON notifications (user_id, post_id, kind) WHERE is_read = 0
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_notifications_user
+        ON notifications (user_id, updated_at)
+    ''')
+
+
+def recipients(post_author_id, parent_author_id, actor_id):
+    """[(user_id, kind)]: автор родительского комментария получает reply, автор
+    поста - comment, если он не тот же человек; о своих комментариях не уведомляем"""
+    result = []
+    if parent_author_id and parent_author_id != actor_id:
+        result.append((parent_author_id, 'reply'))
+    if post_author_id and post_author_id != actor_id and post_author_id != parent_author_id:
+        result.append((post_author_id, 'comment'))
+    return result
+
+
+def write_batch(conn, events):
+    """Записывает события [(user_id, kind, post_id, post_title, comment_id, actor_name)]
+    одной транзакцией, сливая их в непрочитанные дайджесты"""
+    digests = {}
+    unread = {}
+    for user_id, kind, post_id, post_title, comment_id, actor_name in events:
+        key = (user_id, post_id, kind)
+        count = digests[key][-1] + 1 if key in digests else 1
+        digests[key] = (user_id, kind, post_id, post_title, comment_id, actor_name, count)
+        unread[user_id] = unread.get(user_id, 0) + 1
+
+    with conn:
+        conn.executemany('''
+            INSERT INTO notifications (user_id, kind, post_id, post_title, comment_id, actor_name, count)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, post_id, kind) WHERE is_read = 0 DO UPDATE SET
+                count = count + excluded.count,
+                comment_id = excluded.comment_id,
+                actor_name = excluded.actor_name,
+                post_title = excluded.post_title,
+                updated_at = CURRENT_TIMESTAMP
+        ''', digests.values())
+        conn.executemany(
+            'UPDATE users SET unread_notifications = unread_notifications + ? WHERE id = ?',
+            [(count, user_id) for user_id, count in unread.items()]
+        )
+    return len(digests)
+
+
+def mark_all_read(conn, user_id):
+    """Помечает все уведомления прочитанными и обнуляет счетчик в одной транзакции"""
+    with conn:
+        marked = conn.execute(
+            'UPDATE notifications SET is_read = 1 WHERE user_id = ? AND is_read = 0', (user_id,)
+        ).rowcount
+        conn.execute('UPDATE users SET unread_notifications = 0 WHERE id = ?', (user_id,))
+    return marked
+
+
+def inbox(conn, user_id, limit=50):
+    return [Notification(*row) for row in conn.execute(INBOX_SQL, (user_id, limit))]
+
+
+def unread_count(conn, user_id):
+    row = conn.execute('SELECT unread_notifications FROM users WHERE id = ?', (user_id,)).fetchone()
+    return row[0] if row and row[0] else 0
+
+
+def prune(conn, days=KEEP_READ_DAYS):
+    deleted = conn.execute(
+        "DELETE FROM notifications WHERE is_read = 1 AND updated_at < datetime('now', ?)",
+        (f'-{days} days',)
+    ).rowcount
+    conn.commit()
+    return deleted
+
+
+class NotificationQueue:
+    """Очередь событий процесса со сбросом пачками.
+
+    connect - функция, открывающая соединение с основной базой (сброс идет
+    из фонового потока, где нет контекста запроса).
+    """
+
+    def __init__(self, connect, batch_size=100, delay=1.0):
+        self.connect = connect
+        self.batch_size = batch_size
+        self.delay = delay
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._timer = None
+        self.stats = {'queued': 0, 'batches': 0, 'rows': 0, 'failures': 0, 'last_batch': None}
+        atexit.register(self.flush)
+
+    def add(self, user_id, kind, post_id, post_title, comment_id, actor_name):
+        with self._lock:
+            self._pending.append((user_id, kind, post_id, post_title, comment_id, actor_name))
+            self.stats['queued'] += 1
+            full = len(self._pending) >= self.batch_size
+            if not full and self._timer is None:
+                self._timer = threading.Timer(self.delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Записывает накопленные события; возвращает число записанных дайджестов"""
+        with self._flush_lock:
+            with self._lock:
+                events, self._pending = self._pending, []
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+            if not events:
+                return 0
+            conn = self.connect()
+            try:
+                rows = write_batch(conn, events)
+            except sqlite3.Error as e:
+                # События возвращаются в очередь и попадут в следующую пачку
+                print(f"Notification flush failed: {e}")
+                with self._lock:
+                    self._pending[:0] = events
+                    self.stats['failures'] += 1
+                return 0
+            finally:
+                conn.close()
+            with self._lock:
+                self.stats['batches'] += 1
+                self.stats['rows'] += rows
+                self.stats['last_batch'] = len(events)
+            return rows
+
+    def info(self):
+        with self._lock:
+            return dict(self.stats, pending=len(self._pending),
+                        batch_size=self.batch_size, delay=self.delay)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) in (2, 3) and sys.argv[1] == 'prune':
+        conn = sqlite3.connect('instance/app.db')
+        try:
+            days = int(sys.argv[2]) if len(sys.argv) == 3 else KEEP_READ_DAYS
+            print(f"Deleted {prune(conn, days)} read notifications older than {days} days")
+        finally:
+            conn.close()
+    else:
+        print("Available commands:")
+        print("  python notifications.py prune [days]  - Delete read notifications older than N days")
@@ -0,0 +1,271 @@
+"""Хэширование паролей медленной функцией (scrypt или PBKDF2) в пуле процессов.
+
+Хэш хранит схему и параметры, с которыми он получен:
+  scrypt$n=16384,r=8,p=1$<соль>$<хэш>
+  pbkdf2_sha256$i=600000$<соль>$<хэш>
+поэтому параметры можно менять без миграции: старые хэши проверяются со
+своими параметрами и пересчитываются с текущими при следующем входе. Так же
+при входе заменяются старые несоленые SHA-256 (64 шестнадцатеричных символа).
+
+Хэширование занимает десятки миллисекунд процессора и идет в отдельных
+процессах, чтобы потоки запросов не стояли на GIL. Пул ограничен: если в
+работе и в очереди уже workers + max_queue паролей, новый вход сразу
+получает PoolBusy (в приложении - 503 с Retry-After), а не ждет.
+
+Запуск:
+  python passwords.py bench [секунды]  - входов в секунду при разных параметрах
+"""
+import base64
+import concurrent.futures
+import hashlib
+import hmac
+import os
+import sys
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+DEFAULT_SCHEME = 'scrypt'
+
+# Параметры по умолчанию: scrypt с n=2^14 - 16 МБ памяти и около 50 мс процессора на пароль
+DEFAULT_PARAMS = {
+    'scrypt': {'n': 2 ** 14, 'r': 8, 'p': 1},
+    'pbkdf2_sha256': {'i': 600000},
+}
+
+SALT_BYTES = 16
+HASH_BYTES = 32
+
+
+class PoolBusy(Exception):
+    """Пул хэширования переполнен или не ответил вовремя"""
+
+
+def _b64(data):
+    return base64.b64encode(data).decode().rstrip('=')
+
+
+def _unb64(text):
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+
+def _scrypt(password, salt, params):
+    n, r, p = params['n'], params['r'], params['p']
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                          maxmem=2 * 128 * n * r + 1024 * 1024, dklen=HASH_BYTES)
+
+
+def _pbkdf2_sha256(password, salt, params):
+    return hashlib.pbkdf2_hmac('sha256', password.encode(), salt, params['i'], dklen=HASH_BYTES)
+
+
+HASHERS = {
+    'scrypt': _scrypt,
+    'pbkdf2_sha256': _pbkdf2_sha256,
+}
+
+
+def _format_params(params):
+    return ','.join(f'{key}={value}' for key, value in sorted(params.items()))
+
+
+def _parse(stored):
+    """(схема, параметры, соль, хэш) или None для несоленого SHA-256.
+
+    ValueError - хэш поврежден (не четыре части, параметры или base64 не читаются).
+    """
+    if '$' not in stored:
+        return None
+    scheme, params, salt, digest = stored.split('$')
+    params = {key: int(value) for key, value in (item.split('=') for item in params.split(','))}
+    return scheme, params, _unb64(salt), _unb64(digest)
+
+
+def is_legacy(stored):
+    return '$' not in stored
+
+
+def make_hash(password, scheme=DEFAULT_SCHEME, params=None):
+    params = params or DEFAULT_PARAMS[scheme]
+    salt = os.urandom(SALT_BYTES)
+    digest = HASHERS[scheme](password, salt, params)
+    return f'{scheme}${_format_params(params)}${_b64(salt)}${_b64(digest)}'
+
+
+def verify(password, stored):
+    """Совпадает ли пароль с хэшем (любой поддерживаемой схемы).
+
+    Поврежденный хэш не совпадает ни с каким паролем.
+    """
+    try:
+        parsed = _parse(stored)
+    except ValueError:
+        return False
+    if parsed is None:
+        return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored)
+    scheme, params, salt, digest = parsed
+    if scheme not in HASHERS:
+        return False
+    try:
+        computed = HASHERS[scheme](password, salt, params)
+    except (KeyError, ValueError):
+        # Параметров схемы нет или они недопустимы
+        return False
+    return hmac.compare_digest(computed, digest)
+
+
+def needs_upgrade(stored, scheme=DEFAULT_SCHEME, params=None):
+    """Получен ли хэш не той схемой или не с теми параметрами, что сейчас"""
+    try:
+        parsed = _parse(stored)
+    except ValueError:
+        return True
+    return parsed is None or (parsed[0], parsed[1]) != (scheme, params or DEFAULT_PARAMS[scheme])
+
+
+class HashPool:
+    """Ограниченный пул процессов для хэширования.
+
+    workers=0 - хэшировать в вызывающем потоке (тесты, однопроцессные утилиты).
+    """
+
+    def __init__(self, scheme=DEFAULT_SCHEME, params=None, workers=2, max_queue=32, timeout=10.0):
+        self.scheme = scheme
+        self.params = params or DEFAULT_PARAMS[scheme]
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._executor = None
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self.stats = {'hashed': 0, 'verified': 0, 'upgraded': 0, 'rejected': 0, 'timeouts': 0,
+                      'max_in_flight': 0}
+        # Хэш для несуществующих пользователей: вход с чужим именем стоит столько же
+        self._dummy = None
+
+    def _run(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+        with self._lock:
+            if self._in_flight >= self.workers + self.max_queue:
+                self.stats['rejected'] += 1
+                raise PoolBusy()
+            self._in_flight += 1
+            self.stats['max_in_flight'] = max(self.stats['max_in_flight'], self._in_flight)
+            if self._executor is None:
+                self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+            executor = self._executor
+        try:
+            future = executor.submit(fn, *args)
+        except BrokenProcessPool:
+            self._release()
+            self._reset(executor)
+            raise PoolBusy()
+        # Место в очереди освобождается, когда задача завершена или отменена, а не когда
+        # вызывающий перестал ждать: иначе при таймаутах пул принимал бы больше max_queue
+        future.add_done_callback(lambda _: self._release())
+        try:
+            return future.result(timeout=self.timeout)
+        except concurrent.futures.TimeoutError:
+            # Задача из очереди отменяется, уже выполняемая досчитается и освободит место
+            future.cancel()
+            with self._lock:
+                self.stats['timeouts'] += 1
+            raise PoolBusy()
+        except BrokenProcessPool:
+            self._reset(executor)
+            raise PoolBusy()
+
+    def _release(self):
+        with self._lock:
+            self._in_flight -= 1
+
+    def _reset(self, executor):
+        # Рабочий процесс упал - следующий вызов создаст пул заново
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+
+    def hash(self, password):
+        result = self._run(make_hash, password, self.scheme, self.params)
+        self._count('hashed')
+        return result
+
+    def verify(self, password, stored):
+        """Проверяет пароль; stored=None (нет пользователя) проверяется с фиктивным хэшем"""
+        if stored is None:
+            if self._dummy is None:
+                self._dummy = make_hash('', self.scheme, self.params)
+            self._run(verify, password, self._dummy)
+            return False
+        # Несоленый SHA-256 дешев, его незачем отправлять в пул
+        result = verify(password, stored) if is_legacy(stored) else self._run(verify, password, stored)
+        self._count('verified')
+        return result
+
+    def upgrade(self, password, stored):
+        """Новый хэш с текущими параметрами или None, если обновлять не нужно"""
+        if not needs_upgrade(stored, self.scheme, self.params):
+            return None
+        self._count('upgraded')
+        return self.hash(password)
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def info(self):
+        with self._lock:
+            return dict(self.stats, in_flight=self._in_flight, workers=self.workers,
+                        max_queue=self.max_queue, scheme=self.scheme, params=_format_params(self.params))
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            # cancel_futures есть только с Python 3.9; очередь не длиннее max_queue коротких задач
+            executor.shutdown(wait=False)
+
+
+BENCH_SETTINGS = [
+    ('scrypt', {'n': 2 ** 12, 'r': 8, 'p': 1}),
+    ('scrypt', {'n': 2 ** 14, 'r': 8, 'p': 1}),
+    ('scrypt', {'n': 2 ** 15, 'r': 8, 'p': 1}),
+    ('pbkdf2_sha256', {'i': 100000}),
+    ('pbkdf2_sha256', {'i': 300000}),
+    ('pbkdf2_sha256', {'i': 600000}),
+]
+
+
+def bench(seconds=3.0, workers=None):
+    """Входов в секунду для каждой настройки: пул из workers процессов, очередь всегда занята"""
+    workers = workers or os.cpu_count() or 1
+    print(f"{workers} workers, {seconds:.0f}s per setting")
+    for scheme, params in BENCH_SETTINGS:
+        stored = make_hash('password', scheme, params)
+        single = time.perf_counter()
+        verify('password', stored)
+        single = time.perf_counter() - single
+
+        pool = HashPool(scheme, params, workers=workers, max_queue=workers * 2, timeout=60)
+        done = 0
+        started = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers * 2) as threads:
+            pending = set()
+            while time.perf_counter() - started < seconds or pending:
+                while len(pending) < workers * 2 and time.perf_counter() - started < seconds:
+                    pending.add(threads.submit(pool.verify, 'password', stored))
+                finished, pending = concurrent.futures.wait(pending, return_when='FIRST_COMPLETED')
+                done += len(finished)
+        elapsed = time.perf_counter() - started
+        pool.shutdown()
+        print(f"  {scheme:14} {_format_params(params):18} {single * 1000:7.1f} ms/hash  "
+              f"{done / elapsed:8.1f} logins/s")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) in (2, 3) and sys.argv[1] == 'bench':
+        bench(float(sys.argv[2]) if len(sys.argv) == 3 else 3.0)
+    else:
+        print("Available commands:")
+        print("  python passwords.py bench [seconds]  - Logins per second at each cost setting")
@@ -0,0 +1,97 @@
+"""Счетчики для шапки профиля пользователя.
+
+Шапка /u/<имя> показывает карму, число постов и число комментариев. Считать
+их на каждый просмотр - это COUNT по постам и комментариям автора во всех
+шардах, поэтому они хранятся в user_counters и меняются в той же транзакции,
+что и сам пост, комментарий или голос. Карма - сумма (upvotes - downvotes) по
+постам пользователя. Удаленные модератором посты и комментарии не считаются
+(см. moderation.py).
+
+user_counters есть в каждой базе постов и считает только ее посты и
+комментарии: запись в шард не трогает основную базу и не ждет ее писателя.
+Шапка профиля складывает строки пользователя из всех шардов.
+
+recount пересчитывает счетчики с нуля: после создания таблицы, после
+перешардирования и если счетчики разошлись с данными (например, после ручной
+правки базы).
+
+Запуск:
+  python profiles.py recount   - пересчитать карму и счетчики всех пользователей
+"""
+import sqlite3
+import sys
+import time
+
+import sharding
+
+
+ADD_SQL = '''
+    INSERT INTO user_counters (user_id, karma, post_count, comment_count) VALUES (?, ?, ?, ?)
+    ON CONFLICT (user_id) DO UPDATE SET
+        karma = karma + excluded.karma,
+        post_count = post_count + excluded.post_count,
+        comment_count = comment_count + excluded.comment_count
+'''
+
+RECOUNT_SQL = '''
+    INSERT INTO user_counters (user_id, karma, post_count, comment_count)
+    SELECT user_id, SUM(karma), SUM(posts), SUM(comments) FROM (
+        SELECT user_id, upvotes - downvotes AS karma, 1 AS posts, 0 AS comments FROM posts WHERE removed = 0
+        UNION ALL
+        SELECT user_id, 0, 0, 1 FROM comments WHERE removed = 0
+    )
+    GROUP BY user_id
+'''
+
+
+def install_user_counters(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_counters (
+            user_id INTEGER PRIMARY KEY,
+            karma INTEGER NOT NULL DEFAULT 0,
+            post_count INTEGER NOT NULL DEFAULT 0,
+            comment_count INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+
+
+def add(conn, user_id, karma=0, posts=0, comments=0):
+    """Меняет счетчики пользователя в базе постов conn (в ее текущей транзакции)"""
+    conn.execute(ADD_SQL, (user_id, karma, posts, comments))
+
+
+def karma_delta(old_vote, new_vote):
+    """Изменение кармы автора при смене голоса (None - голоса нет)"""
+    value = {'up': 1, 'down': -1, None: 0}
+    return value[new_vote] - value[old_vote]
+
+
+def recount(db_path):
+    """Пересчитывает user_counters основной базы и всех шардов; возвращает число строк.
+
+    При шардировании в основной базе постов нет, и ее таблица просто очищается.
+    """
+    started = time.perf_counter()
+    main = sqlite3.connect(db_path)
+    shard_count = sharding.read_shard_count(main)
+    conns = [main] + [sqlite3.connect(sharding.shard_path(db_path, shard)) for shard in range(shard_count)]
+    rows = 0
+    for conn in conns:
+        try:
+            with conn:
+                install_user_counters(conn)
+                conn.execute('DELETE FROM user_counters')
+                rows += conn.execute(RECOUNT_SQL).rowcount
+        finally:
+            conn.close()
+    print(f"Recounted karma and activity counters ({rows} rows in {len(conns)} database(s)) "
+          f"in {time.perf_counter() - started:.2f}s")
+    return rows
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 2 and sys.argv[1] == 'recount':
+        recount('instance/app.db')
+    else:
+        print("Available commands:")
+        print("  python profiles.py recount   - Recount karma and activity counters of all users")
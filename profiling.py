@@ -0,0 +1,167 @@
+"""Профилирование отдельных маршрутов через cProfile.
+
+Профилируются запросы к маршрутам из routes и случайная доля sample_rate
+остальных. Профили запросов складываются в один pstats.Stats на маршрут,
+который можно скачать целиком (для pstats, snakeviz) или в виде свернутых
+стеков для flamegraph.pl / speedscope. Пока профилирование выключено,
+запрос платит только за проверку флага в before_request.
+
+cProfile меряет время по часам, а не процессора: ожидание базы и
+блокировок тоже попадает в профиль.
+
+С Python 3.12 cProfile работает через sys.monitoring, а там профилировщик
+может быть только один на процесс: второй enable() падает с ValueError.
+Поэтому одновременно профилируется один запрос, остальные в это время
+пропускаются (их число - skipped_requests).
+"""
+import cProfile
+import marshal
+import os
+import pstats
+import random
+import threading
+
+# Глубина свернутых стеков и минимальное время строки (микросекунды)
+MAX_STACK_DEPTH = 64
+MIN_COLLAPSED_US = 1
+
+
+class RouteProfiler:
+    def __init__(self, routes=(), sample_rate=0.0):
+        self.routes = set(routes)
+        self.sample_rate = sample_rate
+        self._stats = {}
+        self._requests = {}
+        self._skipped = 0
+        self._lock = threading.Lock()
+        # Занят, пока идет профилируемый запрос
+        self._running = threading.Lock()
+
+    @property
+    def active(self):
+        return bool(self.routes) or self.sample_rate > 0
+
+    def configure(self, routes=None, sample_rate=None):
+        with self._lock:
+            if routes is not None:
+                self.routes = set(routes)
+            if sample_rate is not None:
+                self.sample_rate = max(0.0, min(1.0, sample_rate))
+
+    def start(self, endpoint):
+        """Профиль для запроса к endpoint или None, если запрос не профилируется"""
+        if endpoint not in self.routes and random.random() >= self.sample_rate:
+            return None
+        if not self._running.acquire(blocking=False):
+            self._skip()
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # sys.monitoring занят другим инструментом (отладчиком, coverage)
+            self._running.release()
+            self._skip()
+            return None
+        return profile
+
+    def _skip(self):
+        with self._lock:
+            self._skipped += 1
+
+    def stop(self, endpoint, profile):
+        profile.disable()
+        self._running.release()
+        profile.create_stats()
+        with self._lock:
+            if endpoint in self._stats:
+                self._stats[endpoint].add(profile)
+            else:
+                self._stats[endpoint] = pstats.Stats(profile)
+            self._requests[endpoint] = self._requests.get(endpoint, 0) + 1
+
+    def endpoints(self):
+        with self._lock:
+            return sorted(self._requests.items(), key=lambda item: item[1], reverse=True)
+
+    def reset(self, endpoint=None):
+        with self._lock:
+            if endpoint is None:
+                self._stats.clear()
+                self._requests.clear()
+            else:
+                self._stats.pop(endpoint, None)
+                self._requests.pop(endpoint, None)
+
+    def _raw(self, endpoint):
+        with self._lock:
+            stats = self._stats.get(endpoint)
+            return None if stats is None else dict(stats.stats)
+
+    def dump(self, endpoint):
+        """Сводный профиль в формате файла pstats (pstats.Stats(path) его прочитает)"""
+        raw = self._raw(endpoint)
+        return None if raw is None else marshal.dumps(raw)
+
+    def top(self, endpoint, n=20):
+        """[(функция, вызовов, собственное время, общее время)] по общему времени"""
+        raw = self._raw(endpoint) or {}
+        rows = [(_label(func), nc, tt, ct) for func, (cc, nc, tt, ct, callers) in raw.items()]
+        rows.sort(key=lambda row: row[3], reverse=True)
+        return rows[:n]
+
+    def collapsed(self, endpoint):
+        raw = self._raw(endpoint)
+        return None if raw is None else collapse(raw)
+
+    def info(self):
+        with self._lock:
+            return {'active': self.active, 'routes': sorted(self.routes), 'sample_rate': self.sample_rate,
+                    'profiled_requests': sum(self._requests.values()), 'skipped_requests': self._skipped}
+
+
+def _label(func):
+    filename, line, name = func
+    if filename == '~':
+        return name
+    return f'{name} ({os.path.basename(filename)}:{line})'
+
+
+def collapse(raw):
+    """Свернутые стеки "a;b;c микросекунды" из графа вызовов pstats.
+
+    cProfile хранит только пары вызывающий-вызываемый, поэтому время функции
+    делится между путями к ней пропорционально времени вызовов по каждому
+    ребру - это приближение, точное для функций с одним вызывающим.
+    """
+    children = {}
+    for func, (cc, nc, tt, ct, callers) in raw.items():
+        for caller, edge in callers.items():
+            edge_ct = edge[3] if isinstance(edge, tuple) else 0
+            children.setdefault(caller, []).append((func, edge_ct))
+
+    totals = {}
+
+    def visit(func, path, share):
+        cc, nc, tt, ct, callers = raw[func]
+        path = path + [_label(func).replace(';', ',')]
+        self_us = tt * share * 1e6
+        if self_us >= MIN_COLLAPSED_US:
+            key = ';'.join(path)
+            totals[key] = totals.get(key, 0) + self_us
+        if len(path) >= MAX_STACK_DEPTH:
+            return
+        for child, edge_ct in children.get(func, ()):
+            child_ct = raw[child][3]
+            if child in on_path or not child_ct or edge_ct * share * 1e6 < MIN_COLLAPSED_US:
+                continue
+            on_path.add(child)
+            visit(child, path, edge_ct * share / child_ct)
+            on_path.discard(child)
+
+    for func, (cc, nc, tt, ct, callers) in raw.items():
+        if not callers:
+            on_path = {func}
+            visit(func, [], 1.0)
+
+    return ''.join(f'{stack} {round(us)}\n' for stack, us in sorted(totals.items()))
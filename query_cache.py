@@ -0,0 +1,150 @@
+"""Кэш результатов SQL-запросов с инвалидацией по поколениям таблиц.
+
+Каждая запись в таблицу увеличивает ее счетчик в table_generations (это
+делают триггеры, поэтому отдельная инвалидация в маршрутах не нужна).
+Запись кэша хранит номера поколений всех таблиц запроса на момент чтения
+и считается устаревшей, как только хотя бы один из них изменился.
+Счетчики лежат в самой базе, так что изменения из других процессов тоже видны.
+"""
+import functools
+import re
+import sqlite3
+import sys
+import threading
+from collections import OrderedDict
+
+# Таблицы, изменения которых отслеживаются триггерами
+TRACKED_TABLES = ('users', 'communities', 'community_subscriptions',
+                  'posts', 'comments', 'votes', 'bookmarks', 'user_counters')
+
+_TABLE_RE = re.compile(r'\b(?:FROM|JOIN)\s+(?:\w+\.)?(\w+)', re.IGNORECASE)
+
+
+def install_generation_triggers(conn, tables=TRACKED_TABLES):
+    """Создает table_generations и триггеры, увеличивающие счетчик при каждой записи"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS table_generations (
+            name TEXT PRIMARY KEY,
+            generation INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    for table in tables:
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS gen_{table}_{event.lower()}
+                AFTER {event} ON {table}
+                BEGIN
+                    INSERT INTO table_generations (name, generation) VALUES ('{table}', 1)
+                    ON CONFLICT(name) DO UPDATE SET generation = generation + 1;
+                END
+            ''')
+
+
+@functools.lru_cache(maxsize=512)
+def tables_for(sql):
+    """Таблицы, из которых читает запрос"""
+    return tuple(sorted({name.lower() for name in _TABLE_RE.findall(sql)}))
+
+
+def _execute(conn, sql, params, row_type):
+    if row_type is None:
+        return conn.execute(sql, params).fetchall()
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    cursor.execute(sql, params)
+    return list(map(row_type._make, cursor))
+
+
+def _estimate_size(rows):
+    size = sys.getsizeof(rows)
+    for row in rows:
+        size += sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row)
+    return size
+
+
+class CacheConnection(sqlite3.Connection):
+    """Соединение с именем для ключей кэша.
+
+    Один и тот же запрос к разным шардам возвращает разные строки, поэтому
+    имя соединения входит в ключ. Для шардов поколения читаются и из шарда,
+    и из подключенной основной базы (значения шарда важнее).
+    """
+    cache_label = 'main'
+    generations_sql = 'SELECT name, generation FROM table_generations'
+
+
+class QueryCache:
+    """LRU-кэш результатов запросов с ограничением размера в байтах"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'bypassed': 0}
+
+    def query(self, conn, sql, params=(), row_type=None):
+        """Возвращает строки запроса из кэша или из базы.
+
+        row_type - namedtuple, в который собираются строки (иначе row_factory соединения).
+        """
+        params = tuple(params)
+        tables = tables_for(sql)
+
+        # Внутри незавершенной транзакции строки могут откатиться вместе со счетчиками
+        if not self.max_bytes or conn.in_transaction:
+            return self._bypass(conn, sql, params, row_type)
+
+        try:
+            generations = dict(tuple(row) for row in conn.execute(conn.generations_sql))
+        except (sqlite3.OperationalError, AttributeError):
+            # База еще не обновлена через init_db.py update
+            return self._bypass(conn, sql, params, row_type)
+
+        snapshot = tuple(generations.get(table, 0) for table in tables)
+        key = (conn.cache_label, sql, params, row_type)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == snapshot:
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry[1]
+            self.stats['misses'] += 1
+
+        # Поколения прочитаны до запроса: если запись успеет пройти между ними,
+        # запись кэша получит старый снимок и будет перечитана при следующем обращении
+        rows = _execute(conn, sql, params, row_type)
+        self._store(key, snapshot, rows)
+        return rows
+
+    def _bypass(self, conn, sql, params, row_type):
+        with self._lock:
+            self.stats['bypassed'] += 1
+        return _execute(conn, sql, params, row_type)
+
+    def _store(self, key, snapshot, rows):
+        size = _estimate_size(rows)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._entries[key] = (snapshot, rows, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted[2]
+                self.stats['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def info(self):
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries), bytes=self._bytes,
+                        max_bytes=self.max_bytes)
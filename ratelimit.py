@@ -0,0 +1,129 @@
+"""Ограничение частоты записи: token bucket на пользователя и на IP.
+
+У каждого ключа (маршрут + пользователь или IP) есть ведро на count
+жетонов, которое наполняется со скоростью count / period в секунду. Запрос
+забирает жетон; если жетона нет, он получает 429 с Retry-After - временем
+до появления следующего.
+
+Ведра лежат в отдельном файле SQLite, поэтому лимит общий для всех
+процессов приложения. Проверка - один INSERT ... ON CONFLICT DO UPDATE ...
+RETURNING по первичному ключу: долить жетоны за прошедшее время, забрать
+один и вернуть результат атомарно, без чтения перед записью. Файл
+отдельный, чтобы проверки не занимали писателя основной базы (именно его
+лимиты и защищают), и пишется с synchronous = OFF: при сбое теряются только
+счетчики. Если файл занят дольше timeout, запрос пропускается.
+
+Ведро, которое не трогали дольше своего period, полное - то же самое, что
+его отсутствие, поэтому такие строки время от времени удаляются.
+"""
+import math
+import sqlite3
+import threading
+import time
+
+DEFAULT_PATH = 'instance/ratelimit.db'
+
+# Раз в сколько проверок процесс удаляет полные ведра
+PRUNE_EVERY = 1000
+
+TAKE_SQL = '''
+    INSERT INTO buckets (key, tokens, updated, allowed) VALUES (:key, :count - 1, :now, 1)
+    ON CONFLICT (key) DO UPDATE SET
+        tokens = min(:count, tokens + (:now - updated) * :rate)
+                 - (min(:count, tokens + (:now - updated) * :rate) >= 1),
+        allowed = min(:count, tokens + (:now - updated) * :rate) >= 1,
+        updated = :now
+    RETURNING tokens, allowed
+'''
+
+
+class RateLimiter:
+    def __init__(self, path=DEFAULT_PATH, timeout=0.25):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._max_period = 0
+        self._takes = 0
+        self.stats = {'allowed': 0, 'limited': 0, 'errors': 0, 'pruned': 0}
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = OFF')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS buckets (
+                    key TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated REAL NOT NULL,      -- time.time() последней проверки
+                    allowed INTEGER NOT NULL    -- забрала ли последняя проверка жетон
+                ) WITHOUT ROWID
+            ''')
+            self._local.conn = conn
+        return conn
+
+    def take(self, key, count, period):
+        """Забирает жетон из ведра key (count жетонов за period секунд).
+
+        Возвращает 0, если жетон был, иначе сколько секунд ждать следующего.
+        """
+        rate = count / period
+        now = time.time()
+        try:
+            conn = self._connect()
+            tokens, allowed = conn.execute(
+                TAKE_SQL, {'key': key, 'count': count, 'rate': rate, 'now': now}
+            ).fetchone()
+        except sqlite3.OperationalError:
+            self._count('errors')
+            return 0
+
+        with self._lock:
+            self._max_period = max(self._max_period, period)
+            self._takes += 1
+            prune = self._takes % PRUNE_EVERY == 0
+            self.stats['allowed' if allowed else 'limited'] += 1
+        if prune:
+            self.prune()
+
+        if allowed:
+            return 0
+        return max(1, math.ceil((1 - tokens) / rate))
+
+    def check(self, endpoint, limits, user_id=None, ip=None):
+        """Проверяет лимиты маршрута {'user': (count, period), 'ip': (count, period)}.
+
+        Возвращает 0 или сколько секунд ждать. Ведро пользователя проверяется первым:
+        отклоненные запросы пользователя, исчерпавшего свой лимит, не тратят жетоны
+        общего IP, за которым могут быть и другие пользователи.
+        """
+        for kind, value in (('user', user_id), ('ip', ip)):
+            limit = limits.get(kind)
+            if limit is None or value is None:
+                continue
+            wait = self.take(f'{endpoint}:{kind}:{value}', *limit)
+            if wait:
+                return wait
+        return 0
+
+    def prune(self):
+        """Удаляет ведра, которые успели наполниться; возвращает их число"""
+        with self._lock:
+            cutoff = time.time() - self._max_period
+        try:
+            deleted = self._connect().execute('DELETE FROM buckets WHERE updated < ?', (cutoff,)).rowcount
+        except sqlite3.OperationalError:
+            self._count('errors')
+            return 0
+        self._count('pruned', deleted)
+        return deleted
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self.stats[name] += n
+
+    def info(self):
+        with self._lock:
+            return dict(self.stats, path=self.path, timeout=self.timeout)
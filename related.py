@@ -0,0 +1,196 @@
+"""Похожие посты по совместным голосам и закладкам.
+
+Пакетная задача строит разреженную матрицу пользователь x пост (голос "за"
+или закладка = 1) в виде двух индексов - посты пользователя и пользователи
+поста, - считает косинусную близость постов через общие строки матрицы и
+сохраняет k ближайших соседей каждого поста в related_posts основной базы
+вместе с заголовком и сообществом соседа. Страница поста делает один
+поиск по первичному ключу и не ходит в шарды.
+
+Инкрементальный запуск пересчитывает только посты, у которых после
+прошлого запуска появились голоса или закладки (по их created_at); полный
+пересчет учитывает и отмененные голоса.
+
+Запуск:
+  python related.py          - пересчитать посты с новыми голосами
+  python related.py full     - пересчитать самые популярные посты целиком
+"""
+import heapq
+import math
+import sqlite3
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+
+import sharding
+
+# Сколько соседей хранить для поста
+TOP_K = 5
+
+# Для скольких самых популярных постов считать соседей при полном пересчете
+TOP_POSTS = 5000
+
+# Пользователи с большим числом оценок почти ничего не говорят о сходстве,
+# а стоят квадрат своей активности - их строки пропускаются
+MAX_USER_ITEMS = 500
+
+
+def install_related_posts(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS related_posts (
+            post_id INTEGER NOT NULL,
+            rank INTEGER NOT NULL,
+            related_id INTEGER NOT NULL,
+            score REAL NOT NULL,
+            title TEXT NOT NULL,
+            community_name TEXT,
+            PRIMARY KEY (post_id, rank)
+        ) WITHOUT ROWID
+    ''')
+    # Правка заголовка и удаление поста меняют строки, где он указан соседом
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_related_posts_related ON related_posts (related_id)')
+
+
+def _post_dbs(db_path):
+    """Соединения со всеми файлами, где лежат посты (к шардам подключена основная база)"""
+    main = sqlite3.connect(db_path)
+    shard_count = sharding.read_shard_count(main)
+    if not shard_count:
+        return [main]
+    main.close()
+    return [sharding.connect_shard(db_path, shard) for shard in range(shard_count)]
+
+
+def _read(conn, sql):
+    cursor = conn.execute(sql)
+    while True:
+        rows = cursor.fetchmany(5000)
+        if not rows:
+            break
+        yield from rows
+
+
+def load_matrix(db_path, since=None):
+    """Читает голоса "за" из всех шардов и закладки из основной базы.
+
+    Возвращает (посты пользователя, пользователи поста, посты с оценками новее since).
+    """
+    user_items = defaultdict(set)
+    item_users = defaultdict(set)
+    changed = set()
+
+    def add(rows):
+        for user_id, post_id, created_at in rows:
+            user_items[user_id].add(post_id)
+            item_users[post_id].add(user_id)
+            if since and created_at and created_at >= since:
+                changed.add(post_id)
+
+    for conn in _post_dbs(db_path):
+        try:
+            add(_read(conn, "SELECT user_id, post_id, created_at FROM votes WHERE vote_type = 'up'"))
+        finally:
+            conn.close()
+
+    main = sqlite3.connect(db_path)
+    try:
+        add(_read(main, 'SELECT user_id, post_id, created_at FROM bookmarks'))
+    finally:
+        main.close()
+    return user_items, item_users, changed
+
+
+def neighbors(post_id, user_items, item_users, k=TOP_K):
+    """k постов с наибольшей косинусной близостью к post_id"""
+    users = item_users.get(post_id, ())
+    common = defaultdict(int)
+    for user_id in users:
+        items = user_items[user_id]
+        if len(items) > MAX_USER_ITEMS:
+            continue
+        for other in items:
+            common[other] += 1
+    common.pop(post_id, None)
+
+    norm = math.sqrt(len(users))
+    scored = ((count / (norm * math.sqrt(len(item_users[other]))), other)
+              for other, count in common.items())
+    return heapq.nlargest(k, scored)
+
+
+def _post_titles(db_path, post_ids):
+    """{post_id: (title, community_name)} для постов из всех шардов"""
+    titles = {}
+    post_ids = list(post_ids)
+    for conn in _post_dbs(db_path):
+        try:
+            for start in range(0, len(post_ids), 500):
+                chunk = post_ids[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                for row in conn.execute(f'''
+                    SELECT p.id, p.title, c.name FROM posts p
+                    LEFT JOIN communities c ON c.id = p.community_id
+                    WHERE p.id IN ({placeholders}) AND p.removed = 0
+                ''', chunk):
+                    titles[row[0]] = (row[1], row[2])
+        finally:
+            conn.close()
+    return titles
+
+
+def refresh(db_path, full=False, k=TOP_K, top_posts=TOP_POSTS):
+    """Пересчитывает соседей и записывает их в related_posts"""
+    started = time.perf_counter()
+    main = sqlite3.connect(db_path)
+    sharding.ensure_meta_tables(main)
+    install_related_posts(main)
+    row = main.execute("SELECT value FROM app_meta WHERE key = 'related_refreshed_at'").fetchone()
+    since = None if full or not row else row[0]
+    # Время в формате CURRENT_TIMESTAMP, чтобы сравнивать с created_at строкой
+    run_at = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+    user_items, item_users, changed = load_matrix(db_path, since)
+    if since is None:
+        targets = heapq.nlargest(top_posts, item_users, key=lambda post_id: len(item_users[post_id]))
+    else:
+        targets = list(changed)
+
+    results = {post_id: neighbors(post_id, user_items, item_users, k) for post_id in targets}
+    titles = _post_titles(db_path, {other for found in results.values() for _, other in found})
+
+    with main:
+        if since is None:
+            main.execute('DELETE FROM related_posts')
+        for post_id, found in results.items():
+            main.execute('DELETE FROM related_posts WHERE post_id = ?', (post_id,))
+            rank = 0
+            for score, other in found:
+                if other not in titles:
+                    continue
+                title, community_name = titles[other]
+                main.execute('''
+                    INSERT INTO related_posts (post_id, rank, related_id, score, title, community_name)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (post_id, rank, other, round(score, 4), title, community_name))
+                rank += 1
+        main.execute(
+            "INSERT OR REPLACE INTO app_meta (key, value) VALUES ('related_refreshed_at', ?)", (run_at,)
+        )
+    main.close()
+
+    duration = time.perf_counter() - started
+    print(f"Related posts: {len(results)} posts refreshed "
+          f"({len(user_items)} users x {len(item_users)} posts) in {duration:.2f}s")
+    return len(results)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 1:
+        refresh('instance/app.db')
+    elif sys.argv[1] == 'full':
+        refresh('instance/app.db', full=True)
+    else:
+        print("Available commands:")
+        print("  python related.py        - Refresh posts with new votes or bookmarks")
+        print("  python related.py full   - Rebuild neighbours of the most popular posts")
@@ -0,0 +1,521 @@
+"""Запросы чтения постов, комментариев и сообществ.
+
+Каждый запрос перечисляет нужные колонки явно и возвращает компактные
+namedtuple-строки (у namedtuple пустые __slots__, поэтому на строку не
+заводится словарь). Ленты вместо полного content получают preview -
+первые PREVIEW_CHARS + 1 символов: по лишнему символу шаблон понимает,
+что текст обрезан. Удаленные модератором строки (removed = 1) запросы
+пропускают, см. moderation.py.
+
+Запуск:
+  python repository.py bench    - сравнить память и время разбора строк с p.* / sqlite3.Row
+"""
+import sys
+import time
+from collections import namedtuple
+
+import db_stats
+
+PREVIEW_CHARS = 250
+
+FeedPost = namedtuple('FeedPost', [
+    'id', 'title', 'preview', 'user_id', 'community_id', 'post_type', 'upvotes', 'downvotes',
+    'comments_count', 'created_at', 'username', 'community_name', 'community_display_name', 'score',
+])
+
+BookmarkedPost = namedtuple('BookmarkedPost', FeedPost._fields + ('bookmarked_at',))
+
+TopPost = namedtuple('TopPost', FeedPost._fields + ('window_score',))
+
+Post = namedtuple('Post', [
+    'id', 'title', 'content', 'user_id', 'community_id', 'post_type', 'upvotes', 'downvotes',
+    'comments_count', 'created_at', 'username', 'community_name', 'community_display_name', 'score',
+    'edited_at',
+])
+
+Comment = namedtuple('Comment', ['id', 'content', 'user_id', 'post_id', 'parent_id', 'created_at', 'username'])
+
+Community = namedtuple('Community', [
+    'id', 'name', 'display_name', 'description', 'owner_id', 'created_at', 'is_public', 'owner_name',
+])
+
+RelatedPost = namedtuple('RelatedPost', ['related_id', 'title', 'community_name', 'score'])
+
+UserSummary = namedtuple('UserSummary', ['id', 'username', 'created_at', 'karma', 'post_count', 'comment_count'])
+
+User = namedtuple('User', ['id', 'username', 'created_at'])
+
+UserCounters = namedtuple('UserCounters', ['karma', 'post_count', 'comment_count'])
+
+# Запись ленты активности: пост или комментарий (post_id и title - пост комментария)
+Activity = namedtuple('Activity', ['created_at', 'kind', 'id', 'post_id', 'title', 'preview', 'community_name'])
+
+CommunityListing = namedtuple('CommunityListing', [
+    'id', 'name', 'display_name', 'description', 'created_at', 'is_public', 'subscribers_count',
+])
+
+_FEED_COLUMNS = f'''
+    p.id, p.title, substr(p.content, 1, {PREVIEW_CHARS + 1}) AS preview, p.user_id, p.community_id,
+    p.post_type, p.upvotes, p.downvotes, p.comments_count, p.created_at,
+    u.username, c.name AS community_name, c.display_name AS community_display_name,
+    (p.upvotes - p.downvotes) AS score
+'''
+
+_FEED_FROM = '''
+    FROM posts p
+    JOIN users u ON p.user_id = u.id
+    LEFT JOIN communities c ON p.community_id = c.id
+'''
+
+LATEST_POSTS_SQL = f'''
+    SELECT {_FEED_COLUMNS} {_FEED_FROM}
+    WHERE p.removed = 0
+    ORDER BY p.created_at DESC, p.id DESC
+    LIMIT ?
+'''
+
+HOT_POSTS_SQL = f'''
+    SELECT {_FEED_COLUMNS} {_FEED_FROM}
+    WHERE p.removed = 0
+    ORDER BY score DESC, p.created_at DESC, p.id DESC
+    LIMIT ?
+'''
+
+COMMUNITY_POSTS_SQL = f'''
+    SELECT {_FEED_COLUMNS} {_FEED_FROM}
+    WHERE p.community_id = ? AND p.removed = 0
+    ORDER BY p.created_at DESC, p.id DESC
+    LIMIT ?
+'''
+
+SEARCH_POSTS_SQL = f'''
+    SELECT {_FEED_COLUMNS} {_FEED_FROM}
+    WHERE p.removed = 0 AND (p.title LIKE ? OR p.content LIKE ?)
+    ORDER BY p.created_at DESC, p.id DESC
+    LIMIT ?
+'''
+
+BOOKMARKED_POSTS_SQL = f'''
+    SELECT {_FEED_COLUMNS}, b.created_at AS bookmarked_at {_FEED_FROM}
+    JOIN bookmarks b ON p.id = b.post_id
+    WHERE b.user_id = ? AND p.removed = 0
+    ORDER BY b.created_at DESC, p.id DESC
+'''
+
+# Лучшее за период: читаются только корзины vote_rollups начиная с since
+# (корзины старше двух суток свернуты в дневные, у них точность - день).
+# Удаленные посты отсеиваются до LIMIT, иначе они занимали бы места в топе
+_TOP_SQL = '''
+    SELECT {columns}, r.window_score
+    FROM (
+        SELECT post_id, SUM(score) AS window_score
+        FROM vote_rollups
+        WHERE {where} bucket >= ?
+        GROUP BY post_id
+        HAVING window_score > 0
+           AND NOT EXISTS (SELECT 1 FROM posts WHERE id = post_id AND removed = 1)
+        ORDER BY window_score DESC, post_id DESC
+        LIMIT ?
+    ) r
+    JOIN posts p ON p.id = r.post_id
+    JOIN users u ON p.user_id = u.id
+    LEFT JOIN communities c ON p.community_id = c.id
+    ORDER BY r.window_score DESC, p.id DESC
+'''
+
+TOP_POSTS_SQL = _TOP_SQL.format(columns=_FEED_COLUMNS, where='')
+
+COMMUNITY_TOP_POSTS_SQL = _TOP_SQL.format(columns=_FEED_COLUMNS, where='community_id = ? AND')
+
+POST_SQL = f'''
+    SELECT p.id, p.title, p.content, p.user_id, p.community_id, p.post_type, p.upvotes, p.downvotes,
+           p.comments_count, p.created_at, u.username, c.name AS community_name,
+           c.display_name AS community_display_name, (p.upvotes - p.downvotes) AS score, p.edited_at
+    {_FEED_FROM}
+    WHERE p.id = ? AND p.removed = 0
+'''
+
+# Соседи поста, посчитанные related.py (лежат в основной базе вместе с заголовками)
+RELATED_POSTS_SQL = '''
+    SELECT related_id, title, community_name, score
+    FROM related_posts
+    WHERE post_id = ?
+    ORDER BY rank
+'''
+
+COMMENTS_SQL = '''
+    SELECT c.id, c.content, c.user_id, c.post_id, c.parent_id, c.created_at, u.username
+    FROM comments c
+    JOIN users u ON c.user_id = u.id
+    WHERE c.post_id = ? AND c.removed = 0
+    ORDER BY c.created_at ASC
+'''
+
+_COMMUNITY_SELECT = '''
+    SELECT c.id, c.name, c.display_name, c.description, c.owner_id, c.created_at, c.is_public,
+           u.username AS owner_name
+    FROM communities c
+    JOIN users u ON c.owner_id = u.id
+'''
+
+COMMUNITY_BY_NAME_SQL = _COMMUNITY_SELECT + 'WHERE c.name = ?'
+
+COMMUNITY_BY_ID_SQL = _COMMUNITY_SELECT + 'WHERE c.id = ?'
+
+POPULAR_COMMUNITIES_SQL = _COMMUNITY_SELECT + 'ORDER BY c.subscribers_count DESC LIMIT ?'
+
+USER_SQL = 'SELECT id, username, created_at FROM users WHERE username = ?'
+
+# Счетчики пользователя в одной базе постов (см. profiles.py)
+USER_COUNTERS_SQL = 'SELECT karma, post_count, comment_count FROM user_counters WHERE user_id = ?'
+
+# Ленты активности: диапазон индекса (user_id, created_at) от курсора {bound} вниз
+USER_POSTS_SQL = f'''
+    SELECT p.created_at, 'post', p.id, p.id, p.title, substr(p.content, 1, {PREVIEW_CHARS + 1}), c.name
+    FROM posts p
+    LEFT JOIN communities c ON p.community_id = c.id
+    WHERE p.user_id = ? AND p.removed = 0 {{bound}}
+    ORDER BY p.created_at DESC, p.id DESC
+    LIMIT ?
+'''
+
+USER_COMMENTS_SQL = f'''
+    SELECT cm.created_at, 'comment', cm.id, cm.post_id, p.title, substr(cm.content, 1, {PREVIEW_CHARS + 1}), c.name
+    FROM comments cm
+    JOIN posts p ON p.id = cm.post_id
+    LEFT JOIN communities c ON p.community_id = c.id
+    WHERE cm.user_id = ? AND cm.removed = 0 AND p.removed = 0 {{bound}}
+    ORDER BY cm.created_at DESC, cm.id DESC
+    LIMIT ?
+'''
+
+COMMUNITY_LISTING_SQL = '''
+    SELECT c.id, c.name, c.display_name, c.description, c.created_at, c.is_public,
+           COUNT(cs.id) AS subscribers_count
+    FROM communities c
+    LEFT JOIN community_subscriptions cs ON c.id = cs.community_id
+    GROUP BY c.id
+    ORDER BY subscribers_count DESC, c.created_at DESC
+'''
+
+SEARCH_COMMUNITIES_SQL = '''
+    SELECT c.id, c.name, c.display_name, c.description, c.created_at, c.is_public,
+           COUNT(cs.id) AS subscribers_count
+    FROM communities c
+    LEFT JOIN community_subscriptions cs ON c.id = cs.community_id
+    WHERE c.name LIKE ? OR c.display_name LIKE ? OR c.description LIKE ?
+    GROUP BY c.id
+    ORDER BY subscribers_count DESC
+'''
+
+
+def fetch(conn, row_type, sql, params=(), cache=None):
+    """Выполняет запрос и собирает строки в row_type (через кэш, если он передан)"""
+    started = time.perf_counter()
+    if cache is not None:
+        rows = cache.query(conn, sql, params, row_type=row_type)
+    else:
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        cursor.execute(sql, params)
+        rows = list(map(row_type._make, cursor))
+    db_stats.slow_queries.record(sql, time.perf_counter() - started)
+    return rows
+
+
+def fetch_one(conn, row_type, sql, params=(), cache=None):
+    rows = fetch(conn, row_type, sql, params, cache)
+    return rows[0] if rows else None
+
+
+def latest_posts(conn, limit=20):
+    return fetch(conn, FeedPost, LATEST_POSTS_SQL, (limit,))
+
+
+def hot_posts(conn, limit=20):
+    return fetch(conn, FeedPost, HOT_POSTS_SQL, (limit,))
+
+
+def community_posts(conn, community_id, limit=20):
+    return fetch(conn, FeedPost, COMMUNITY_POSTS_SQL, (community_id, limit))
+
+
+def search_posts(conn, query, limit=50, cache=None):
+    pattern = f'%{query}%'
+    return fetch(conn, FeedPost, SEARCH_POSTS_SQL, (pattern, pattern, limit), cache)
+
+
+def top_posts(conn, since, limit=20):
+    return fetch(conn, TopPost, TOP_POSTS_SQL, (since, limit))
+
+
+def community_top_posts(conn, community_id, since, limit=20):
+    return fetch(conn, TopPost, COMMUNITY_TOP_POSTS_SQL, (community_id, since, limit))
+
+
+def bookmarked_posts(conn, user_id):
+    return fetch(conn, BookmarkedPost, BOOKMARKED_POSTS_SQL, (user_id,))
+
+
+def post_by_id(conn, post_id, cache=None):
+    return fetch_one(conn, Post, POST_SQL, (post_id,), cache)
+
+
+def post_comments(conn, post_id, cache=None):
+    return fetch(conn, Comment, COMMENTS_SQL, (post_id,), cache)
+
+
+def related_posts(conn, post_id):
+    return fetch(conn, RelatedPost, RELATED_POSTS_SQL, (post_id,))
+
+
+def community_by_name(conn, name, cache=None):
+    return fetch_one(conn, Community, COMMUNITY_BY_NAME_SQL, (name,), cache)
+
+
+def community_by_id(conn, community_id, cache=None):
+    return fetch_one(conn, Community, COMMUNITY_BY_ID_SQL, (community_id,), cache)
+
+
+def popular_communities(conn, limit):
+    """Сообщества с наибольшим числом подписчиков (по счетчику в communities)"""
+    return fetch(conn, Community, POPULAR_COMMUNITIES_SQL, (limit,))
+
+
+def user_counters(post_dbs, user_id, cache=None):
+    """Счетчики пользователя, сложенные по всем базам постов"""
+    totals = UserCounters(0, 0, 0)
+    for conn in post_dbs:
+        row = fetch_one(conn, UserCounters, USER_COUNTERS_SQL, (user_id,), cache)
+        if row:
+            totals = UserCounters(*(total + value for total, value in zip(totals, row)))
+    return totals
+
+
+def user_summary(conn, post_dbs, username, cache=None):
+    """Шапка профиля: пользователь из основной базы и его счетчики из баз постов"""
+    user = fetch_one(conn, User, USER_SQL, (username,), cache)
+    if user is None:
+        return None
+    return UserSummary(*user, *user_counters(post_dbs, user.id, cache))
+
+
+def _activity_bound(alias, kind, cursor):
+    """Условие "строго после курсора" в порядке (created_at, kind, id) по убыванию"""
+    if cursor is None:
+        return '', ()
+    created_at, cursor_kind, cursor_id = cursor
+    if kind == cursor_kind:
+        return f'AND ({alias}.created_at, {alias}.id) < (?, ?)', (created_at, cursor_id)
+    # При равном времени посты идут раньше комментариев ('post' > 'comment')
+    if kind < cursor_kind:
+        return f'AND {alias}.created_at <= ?', (created_at,)
+    return f'AND {alias}.created_at < ?', (created_at,)
+
+
+def user_activity(conn, user_id, limit, cursor=None):
+    """Посты и комментарии пользователя после курсора (created_at, kind, id): два списка,
+    каждый отсортирован по убыванию, - их остается слить"""
+    streams = []
+    for sql, alias, kind in ((USER_POSTS_SQL, 'p', 'post'), (USER_COMMENTS_SQL, 'cm', 'comment')):
+        bound, params = _activity_bound(alias, kind, cursor)
+        streams.append(fetch(conn, Activity, sql.format(bound=bound), (user_id, *params, limit)))
+    return streams
+
+
+def communities_listing(conn, cache=None):
+    return fetch(conn, CommunityListing, COMMUNITY_LISTING_SQL, (), cache)
+
+
+def search_communities(conn, query, cache=None):
+    pattern = f'%{query}%'
+    return fetch(conn, CommunityListing, SEARCH_COMMUNITIES_SQL, (pattern, pattern, pattern), cache)
+
+
+# Поля, которые клиент API может запросить через ?fields=
+API_POST_FIELDS = {
+    'id': 'p.id',
+    'title': 'p.title',
+    'content': 'p.content',
+    'preview': f'substr(p.content, 1, {PREVIEW_CHARS})',
+    'user_id': 'p.user_id',
+    'username': 'u.username',
+    'community_id': 'p.community_id',
+    'community_name': 'c.name',
+    'post_type': 'p.post_type',
+    'upvotes': 'p.upvotes',
+    'downvotes': 'p.downvotes',
+    'score': '(p.upvotes - p.downvotes)',
+    'comments_count': 'p.comments_count',
+    'created_at': 'p.created_at',
+}
+API_POST_DEFAULT_FIELDS = ('id', 'title', 'preview', 'username', 'community_name', 'post_type',
+                           'score', 'comments_count', 'created_at')
+
+API_COMMENT_FIELDS = {
+    'id': 'c.id',
+    'content': 'c.content',
+    'user_id': 'c.user_id',
+    'username': 'u.username',
+    'post_id': 'c.post_id',
+    'parent_id': 'c.parent_id',
+    'created_at': 'c.created_at',
+}
+API_COMMENT_DEFAULT_FIELDS = ('id', 'content', 'username', 'parent_id', 'created_at')
+
+# Ключи keyset-пагинации для каждой сортировки (по убыванию)
+API_POST_ORDERS = {
+    'new': ('created_at', 'id'),
+    'hot': ('score', 'created_at', 'id'),
+}
+API_COMMENT_ORDER = ('created_at', 'id')
+
+
+def _iter_dicts(conn, sql, params, chunk_size):
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    cursor.execute(sql, params)
+    columns = [d[0] for d in cursor.description]
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        for row in rows:
+            yield dict(zip(columns, row))
+
+
+def iter_api_posts(conn, fields, order='new', community_id=None, search=None, post_id=None,
+                   after=None, limit=25, chunk_size=100):
+    """Генератор постов для API: только запрошенные поля плюс ключи сортировки.
+
+    after - значения ключей сортировки последнего поста предыдущей страницы.
+    Строки читаются порциями по chunk_size, без fetchall().
+    """
+    keys = API_POST_ORDERS[order]
+    columns = list(dict.fromkeys(tuple(fields) + keys))
+    select = ', '.join(f'{API_POST_FIELDS[name]} AS {name}' for name in columns)
+
+    where, params = ['p.removed = 0'], []
+    if community_id is not None:
+        where.append('p.community_id = ?')
+        params.append(community_id)
+    if search is not None:
+        where.append('(p.title LIKE ? OR p.content LIKE ?)')
+        params.extend([f'%{search}%', f'%{search}%'])
+    if post_id is not None:
+        where.append('p.id = ?')
+        params.append(post_id)
+    if after is not None:
+        where.append(f"({', '.join(API_POST_FIELDS[k] for k in keys)}) < ({', '.join('?' * len(keys))})")
+        params.extend(after)
+
+    sql = f"""
+        SELECT {select} {_FEED_FROM}
+        WHERE {' AND '.join(where)}
+        ORDER BY {', '.join(API_POST_FIELDS[k] + ' DESC' for k in keys)}
+        LIMIT ?
+    """
+    params.append(limit)
+    return _iter_dicts(conn, sql, params, chunk_size)
+
+
+def iter_api_comments(conn, post_id, fields, after=None, limit=100, chunk_size=100):
+    """Генератор комментариев поста для API (по возрастанию времени)"""
+    keys = API_COMMENT_ORDER
+    columns = list(dict.fromkeys(tuple(fields) + keys))
+    select = ', '.join(f'{API_COMMENT_FIELDS[name]} AS {name}' for name in columns)
+
+    where, params = ['c.post_id = ?', 'c.removed = 0'], [post_id]
+    if after is not None:
+        where.append('(c.created_at, c.id) > (?, ?)')
+        params.extend(after)
+
+    sql = f"""
+        SELECT {select}
+        FROM comments c
+        JOIN users u ON c.user_id = u.id
+        WHERE {' AND '.join(where)}
+        ORDER BY c.created_at ASC, c.id ASC
+        LIMIT ?
+    """
+    params.append(limit)
+    return _iter_dicts(conn, sql, params, chunk_size)
+
+
+def benchmark(posts=2000, content_chars=2000, rounds=20):
+    """Сравнивает ленту из 20 постов: p.* + sqlite3.Row против FeedPost с preview.
+
+    Меряет время разбора одной строки и пиковую память на отрисовку index.html.
+    """
+    import contextlib
+    import os
+    import shutil
+    import sqlite3
+    import tempfile
+    import time
+    import tracemalloc
+
+    import init_db
+
+    legacy_sql = '''
+        SELECT p.*, u.username, c.name as community_name, c.display_name as community_display_name,
+               (p.upvotes - p.downvotes) as score
+        FROM posts p
+        JOIN users u ON p.user_id = u.id
+        LEFT JOIN communities c ON p.community_id = c.id
+        ORDER BY p.created_at DESC, p.id DESC
+        LIMIT ?
+    '''
+
+    tmp = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(tmp)
+    try:
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            init_db.init_database()
+        conn = sqlite3.connect('instance/app.db')
+        conn.executemany(
+            'INSERT INTO posts (title, content, user_id, community_id) VALUES (?, ?, 1, 1)',
+            [(f'Post {i}', 'x' * content_chars) for i in range(posts)]
+        )
+        conn.commit()
+
+        def legacy(limit):
+            conn.row_factory = sqlite3.Row
+            return conn.execute(legacy_sql, (limit,)).fetchall()
+
+        def compact(limit):
+            conn.row_factory = None
+            return latest_posts(conn, limit)
+
+        print(f'{posts} posts, {content_chars} chars of content each')
+        for name, load in (('p.* + sqlite3.Row', legacy), ('FeedPost + preview', compact)):
+            started = time.perf_counter()
+            for _ in range(rounds):
+                load(posts)
+            per_row = (time.perf_counter() - started) / (rounds * posts)
+
+            from app import app
+            with app.test_request_context('/'):
+                from flask import render_template
+                rows = None
+                tracemalloc.start()
+                for _ in range(rounds):
+                    rows = load(20)
+                    render_template('index.html', posts=rows, user_votes={}, user_bookmarks=set())
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+
+            print(f'  {name:20} decode {per_row * 1e6:7.2f} us/row, page peak {peak / 1024:8.1f} KiB')
+        conn.close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        benchmark()
+    else:
+        print("Available commands:")
+        print("  python repository.py bench   - Compare compact rows with p.* / sqlite3.Row")
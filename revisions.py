@@ -0,0 +1,178 @@
+"""История правок постов в виде сжатых обратных дельт.
+
+Текущая версия поста всегда целиком лежит в posts, поэтому страница поста,
+ленты и поиск читают ее как раньше - одной строкой. Старые версии хранятся
+в post_revisions рядом с постом (в том же шарде) так же, как в RCS: правка
+номер N сохраняет дельту, которая превращает версию N + 1 обратно в версию N.
+Дельта - измененные заголовок и тип и построчный diff текста (только
+отличающиеся куски), сжатая zlib. Часто правленый длинный пост поэтому
+растет на размер правок, а не на размер копии.
+
+Чтобы восстановление старой версии не проходило всю цепочку, каждая
+SNAPSHOT_EVERY-я правка хранит версию целиком: восстановление начинается с
+ближайшей такой правки не раньше нужной.
+
+Запуск:
+  python revisions.py stats   - число правок и сколько места они занимают
+"""
+import difflib
+import json
+import sqlite3
+import sys
+import zlib
+from collections import namedtuple
+
+import sharding
+
+# Каждая какая правка хранит версию целиком
+SNAPSHOT_EVERY = 50
+
+# Поля поста, которые попадают в историю
+FIELDS = ('title', 'content', 'post_type')
+
+Revision = namedtuple('Revision', ['revision', 'user_id', 'username', 'created_at', 'size', 'snapshot'])
+
+HISTORY_SQL = '''
+    SELECT r.revision, r.user_id, u.username, r.created_at, length(r.delta), r.snapshot
+    FROM post_revisions r
+    LEFT JOIN users u ON u.id = r.user_id
+    WHERE r.post_id = ?
+    ORDER BY r.revision DESC
+'''
+
+# Дельты от ближайшего снимка не раньше revision (или от текущей версии) вниз до revision
+CHAIN_SQL = '''
+    SELECT revision, snapshot, delta FROM post_revisions
+    WHERE post_id = ? AND revision >= ? AND revision <= COALESCE(
+        (SELECT MIN(revision) FROM post_revisions WHERE post_id = ? AND revision >= ? AND snapshot = 1),
+        (SELECT MAX(revision) FROM post_revisions WHERE post_id = ?))
+    ORDER BY revision DESC
+'''
+
+
+def install_post_revisions(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS post_revisions (
+            post_id INTEGER NOT NULL,
+            revision INTEGER NOT NULL,      -- версия, которую восстанавливает delta
+            user_id INTEGER,                -- кто сделал правку
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            snapshot INTEGER NOT NULL DEFAULT 0,  -- 1 - в delta версия целиком
+            delta BLOB NOT NULL,
+            PRIMARY KEY (post_id, revision)
+        ) WITHOUT ROWID
+    ''')
+
+
+def line_diff(new, old):
+    """[[начало, конец, текст]]: замены строк new, после которых получается old"""
+    new_lines = new.splitlines(keepends=True)
+    old_lines = old.splitlines(keepends=True)
+    matcher = difflib.SequenceMatcher(None, new_lines, old_lines, autojunk=False)
+    return [[i1, i2, ''.join(old_lines[j1:j2])]
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != 'equal']
+
+
+def line_patch(text, ops):
+    lines = text.splitlines(keepends=True)
+    # Номера строк в ops относятся к исходному тексту - применяем с конца
+    for start, end, replacement in reversed(ops):
+        lines[start:end] = [replacement]
+    return ''.join(lines)
+
+
+def encode(delta):
+    return zlib.compress(json.dumps(delta, ensure_ascii=False, separators=(',', ':')).encode('utf-8'), 9)
+
+
+def decode(blob):
+    return json.loads(zlib.decompress(blob).decode('utf-8'))
+
+
+def make_delta(new, old):
+    """Обратная дельта: что нужно изменить в версии new ({поле: значение}), чтобы получить old"""
+    delta = {field: old[field] for field in ('title', 'post_type') if new[field] != old[field]}
+    if new['content'] != old['content']:
+        delta['content'] = line_diff(new['content'], old['content'])
+    return delta
+
+
+def apply_delta(version, delta):
+    version = dict(version)
+    for field in ('title', 'post_type'):
+        if field in delta:
+            version[field] = delta[field]
+    if 'content' in delta:
+        version['content'] = line_patch(version['content'], delta['content'])
+    return version
+
+
+def record(conn, post_id, old, new, user_id):
+    """Сохраняет версию old перед заменой на new (в транзакции conn); возвращает номер правки.
+
+    old и new - {поле: значение} по FIELDS. Если ничего не изменилось, возвращает None.
+    """
+    old = {field: old[field] for field in FIELDS}
+    new = {field: new[field] for field in FIELDS}
+    if old == new:
+        return None
+    revision = conn.execute(
+        'SELECT COALESCE(MAX(revision), 0) + 1 FROM post_revisions WHERE post_id = ?', (post_id,)
+    ).fetchone()[0]
+    snapshot = revision % SNAPSHOT_EVERY == 0
+    delta = old if snapshot else make_delta(new, old)
+    conn.execute('''
+        INSERT INTO post_revisions (post_id, revision, user_id, snapshot, delta) VALUES (?, ?, ?, ?, ?)
+    ''', (post_id, revision, user_id, int(snapshot), encode(delta)))
+    return revision
+
+
+def history(conn, post_id):
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    return [Revision(*row) for row in cursor.execute(HISTORY_SQL, (post_id,))]
+
+
+def version(conn, post_id, current, revision):
+    """Версия поста до правки revision ({поле: значение}) или None, если такой правки нет.
+
+    current - текущая версия поста.
+    """
+    rows = conn.execute(CHAIN_SQL, (post_id, revision, post_id, revision, post_id)).fetchall()
+    if not rows or rows[-1][0] != revision:
+        return None
+    result = {field: current[field] for field in FIELDS}
+    for number, snapshot, blob in rows:
+        delta = decode(blob)
+        result = delta if snapshot else apply_delta(result, delta)
+    return result
+
+
+def stats(db_path):
+    """(правок, постов с правками, байт в дельтах)"""
+    main = sqlite3.connect(db_path)
+    shard_count = sharding.read_shard_count(main)
+    if shard_count:
+        main.close()
+        conns = [sharding.connect_shard(db_path, shard) for shard in range(shard_count)]
+    else:
+        conns = [main]
+    totals = [0, 0, 0]
+    for conn in conns:
+        try:
+            row = conn.execute(
+                'SELECT COUNT(*), COUNT(DISTINCT post_id), COALESCE(SUM(length(delta)), 0) FROM post_revisions'
+            ).fetchone()
+            totals = [total + value for total, value in zip(totals, row)]
+        finally:
+            conn.close()
+    return tuple(totals)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 2 and sys.argv[1] == 'stats':
+        count, posts, size = stats('instance/app.db')
+        print(f"{count} revisions of {posts} posts, {size} bytes of deltas")
+    else:
+        print("Available commands:")
+        print("  python revisions.py stats   - Show how many revisions are stored and their size")
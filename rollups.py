@@ -0,0 +1,135 @@
+"""Почасовые итоги голосов для списков "лучшее за день/неделю/месяц".
+
+Триггеры на votes пишут в vote_rollups изменение рейтинга поста в часовой
+корзине времени голоса (в той же транзакции, что и сам голос), поэтому
+запрос "лучшее за период" читает только корзины периода, а не все голоса.
+Часовые корзины старше KEEP_HOURLY_HOURS сворачиваются в дневные задачей
+обслуживания (maintenance.py rollups).
+
+Итоги выводятся из текущих голосов: отмена голоса вычитает его из корзины,
+в которой он был поставлен, так что при перешардировании (копирование
+голосов) итоги в новых шардах получаются такими же.
+
+Запуск:
+  python rollups.py compact    - свернуть старые часовые корзины
+  python rollups.py rebuild    - пересчитать итоги по голосам
+"""
+import sqlite3
+import sys
+import time
+
+import backup
+
+HOUR = 3600
+DAY = 86400
+
+# Периоды списков "лучшее" в секундах
+TOP_WINDOWS = {
+    'day': DAY,
+    'week': 7 * DAY,
+    'month': 30 * DAY,
+}
+
+# Сколько часов хранить часовые корзины до сворачивания в дневные
+KEEP_HOURLY_HOURS = 48
+
+_BUCKET = "CAST(strftime('%s', {0}.created_at) AS INTEGER) / 3600 * 3600"
+_SCORE = "CASE {0}.vote_type WHEN 'up' THEN 1 ELSE -1 END"
+
+
+def _apply(row, sign):
+    """INSERT изменения рейтинга в корзину голоса row (NEW или OLD)"""
+    return f'''
+        INSERT INTO vote_rollups (bucket, span, post_id, community_id, score)
+        SELECT {_BUCKET.format(row)}, {HOUR}, {row}.post_id,
+               (SELECT community_id FROM posts WHERE id = {row}.post_id),
+               {sign} * {_SCORE.format(row)}
+        WHERE {row}.created_at IS NOT NULL
+        ON CONFLICT(bucket, span, post_id) DO UPDATE SET score = score + excluded.score;
+    '''
+
+
+def install_vote_rollups(conn):
+    """Создает vote_rollups и триггеры на votes"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS vote_rollups (
+            bucket INTEGER NOT NULL,   -- начало корзины, unix time
+            span INTEGER NOT NULL,     -- 3600 или 86400
+            post_id INTEGER NOT NULL,
+            community_id INTEGER,
+            score INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (bucket, span, post_id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_vote_rollups_community
+        ON vote_rollups (community_id, bucket)
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS rollup_votes_insert AFTER INSERT ON votes
+        BEGIN {_apply('NEW', 1)} END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS rollup_votes_delete AFTER DELETE ON votes
+        BEGIN {_apply('OLD', -1)} END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS rollup_votes_update
+        AFTER UPDATE OF vote_type, created_at ON votes
+        BEGIN {_apply('OLD', -1)} {_apply('NEW', 1)} END
+    ''')
+
+
+def compact(conn, now=None, keep_hours=KEEP_HOURLY_HOURS):
+    """Сворачивает часовые корзины целых дней старше keep_hours в дневные"""
+    now = now or time.time()
+    cutoff = int(now - keep_hours * HOUR) // DAY * DAY
+    conn.execute(f'''
+        INSERT INTO vote_rollups (bucket, span, post_id, community_id, score)
+        SELECT bucket / {DAY} * {DAY}, {DAY}, post_id, community_id, SUM(score)
+        FROM vote_rollups
+        WHERE bucket < ? AND span = {HOUR}
+        GROUP BY bucket / {DAY}, post_id
+        ON CONFLICT(bucket, span, post_id) DO UPDATE SET score = score + excluded.score
+    ''', (cutoff,))
+    moved = conn.execute(f'DELETE FROM vote_rollups WHERE bucket < ? AND span = {HOUR}', (cutoff,)).rowcount
+    conn.execute('DELETE FROM vote_rollups WHERE bucket < ? AND score = 0', (cutoff,))
+    conn.commit()
+    return moved
+
+
+def rebuild(conn):
+    """Пересчитывает итоги по текущим голосам (после ручных правок votes)"""
+    conn.execute('DELETE FROM vote_rollups')
+    conn.execute(f'''
+        INSERT INTO vote_rollups (bucket, span, post_id, community_id, score)
+        SELECT {_BUCKET.format('v')}, {HOUR}, v.post_id, p.community_id, SUM({_SCORE.format('v')})
+        FROM votes v LEFT JOIN posts p ON p.id = v.post_id
+        WHERE v.created_at IS NOT NULL
+        GROUP BY 1, v.post_id
+    ''')
+    conn.commit()
+    return compact(conn)
+
+
+def window_start(window, now=None):
+    """Начало периода: с точностью до часа, чтобы запрос не менялся каждую секунду"""
+    now = now or time.time()
+    return int(now - TOP_WINDOWS[window]) // HOUR * HOUR
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] in ('compact', 'rebuild'):
+        for path in backup.database_files('instance/app.db'):
+            conn = sqlite3.connect(path)
+            try:
+                if sys.argv[1] == 'compact':
+                    print(f"{path}: compacted {compact(conn)} hourly rows")
+                else:
+                    print(f"{path}: rebuilt, compacted {rebuild(conn)} hourly rows")
+            finally:
+                conn.close()
+    else:
+        print("Available commands:")
+        print("  python rollups.py compact   - Fold old hourly buckets into daily ones")
+        print("  python rollups.py rebuild   - Recompute rollups from votes")
@@ -0,0 +1,422 @@
+"""Шардирование данных сообществ по нескольким файлам SQLite.
+
+Пользователи, реестр сообществ, подписки и закладки остаются в основном
+файле (instance/app.db). Таблицы posts, comments и votes раскладываются
+по файлам instance/app.shardN.db по community_id, поэтому запись в одном
+большом сообществе не блокирует запись во всех остальных.
+
+Запуск:
+  python sharding.py status          - текущее количество шардов
+  python sharding.py reshard N       - перераспределить данные на N шардов (0 - один файл)
+  python sharding.py bench [N]       - сравнить скорость параллельной записи
+"""
+import contextlib
+import heapq
+import itertools
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+# Таблицы, которые живут в шардах
+SHARDED_TABLES = ('posts', 'comments', 'votes')
+
+# Что еще копируется в схему шарда (счетчики поколений для кэша запросов, счетчики строк
+# и итоги голосов - они ведутся триггерами на таблицах шарда; история правок постов;
+# счетчики профилей по постам и комментариям шарда)
+SHARD_SCHEMA_TABLES = SHARDED_TABLES + ('table_generations', 'table_rows', 'vote_rollups', 'post_revisions',
+                                        'user_counters')
+
+# Имя, под которым основной файл подключается к соединению шарда
+COMMON_SCHEMA = 'common'
+
+
+def shard_for(community_id, shard_count):
+    """Номер шарда для сообщества (посты без сообщества живут в шарде 0)"""
+    if not shard_count or community_id is None:
+        return 0
+    return int(community_id) % shard_count
+
+
+def shard_path(db_path, shard):
+    """Путь к файлу шарда рядом с основной базой"""
+    base, ext = os.path.splitext(db_path)
+    return f'{base}.shard{shard}{ext or ".db"}'
+
+
+def ensure_meta_tables(conn):
+    """Создает служебные таблицы шардирования в основной базе"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS app_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+    # Глобальный реестр постов: выдает id и знает сообщество (а значит и шард)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS post_shards (
+            post_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            community_id INTEGER
+        )
+    ''')
+
+
+def read_shard_count(conn):
+    """Читает количество шардов из основной базы (0 - шардирование выключено)"""
+    row = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name='app_meta'"
+    ).fetchone()
+    if not row:
+        return 0
+    row = conn.execute("SELECT value FROM app_meta WHERE key = 'shard_count'").fetchone()
+    return int(row[0]) if row else 0
+
+
+def connect_shard(db_path, shard, timeout=5.0, factory=sqlite3.Connection):
+    """Открывает шард и подключает к нему основную базу.
+
+    Неквалифицированные имена SQLite ищет сначала в main, поэтому posts,
+    comments и votes берутся из шарда, а users, communities и bookmarks -
+    из подключенной основной базы. Запросы приложения не меняются.
+    """
+    conn = sqlite3.connect(shard_path(db_path, shard), timeout=timeout, factory=factory)
+    conn.row_factory = sqlite3.Row
+    conn.execute(f'ATTACH DATABASE ? AS {COMMON_SCHEMA}', (db_path,))
+    return conn
+
+
+def copy_schema(src, dst, tables=SHARD_SCHEMA_TABLES):
+    """Копирует CREATE TABLE/INDEX/TRIGGER для таблиц шарда из основной базы.
+
+    Схема берется из sqlite_master, поэтому шарды автоматически получают
+    все колонки и индексы, добавленные миграциями init_db.py.
+    """
+    placeholders = ','.join('?' * len(tables))
+    rows = src.execute(f'''
+        SELECT type, name, sql FROM sqlite_master
+        WHERE tbl_name IN ({placeholders}) AND sql IS NOT NULL
+        ORDER BY type != 'table'
+    ''', tables).fetchall()
+    for row in rows:
+        exists = dst.execute(
+            'SELECT 1 FROM sqlite_master WHERE type = ? AND name = ?', (row[0], row[1])
+        ).fetchone()
+        if not exists:
+            dst.execute(row[2])
+
+
+def sync_shard_schema(db_path):
+    """Добавляет в существующие шарды колонки и индексы, появившиеся в основной базе"""
+    conn = sqlite3.connect(db_path)
+    try:
+        count = read_shard_count(conn)
+        for shard in range(count):
+            shard_conn = sqlite3.connect(shard_path(db_path, shard))
+            try:
+                for table in SHARDED_TABLES:
+                    have = {c[1] for c in shard_conn.execute(f'PRAGMA table_info({table})')}
+                    for column in conn.execute(f'PRAGMA table_info({table})').fetchall():
+                        if have and column[1] not in have:
+                            default = f' DEFAULT {column[4]}' if column[4] is not None else ''
+                            shard_conn.execute(
+                                f'ALTER TABLE {table} ADD COLUMN {column[1]} {column[2]}{default}'
+                            )
+                copy_schema(conn, shard_conn)
+                shard_conn.commit()
+            finally:
+                shard_conn.close()
+        return count
+    finally:
+        conn.close()
+
+
+def merge_sorted(results, key, limit=None, reverse=True):
+    """K-way слияние уже отсортированных результатов шардов"""
+    merged = heapq.merge(*results, key=key, reverse=reverse)
+    if limit:
+        return list(itertools.islice(merged, limit))
+    return list(merged)
+
+
+def _columns(conn, table):
+    return [c[1] for c in conn.execute(f'PRAGMA table_info({table})')]
+
+
+def _insert(conn, table, row, columns):
+    placeholders = ','.join('?' * len(columns))
+    cursor = conn.execute(
+        f'INSERT INTO {table} ({",".join(columns)}) VALUES ({placeholders})',
+        [row[c] for c in columns]
+    )
+    return cursor.lastrowid
+
+
+def reshard(db_path, new_count, chunk_size=1000):
+    """Перераспределяет posts/comments/votes на new_count шардов.
+
+    Выполняется при остановленном приложении. Новые шарды сначала пишутся
+    во временные файлы и подменяют старые только после успешного копирования.
+    id постов сохраняются (на них ссылаются закладки и URL), id комментариев
+    выдаются заново с пересчетом parent_id, так как в разных шардах они
+    могут совпадать.
+    """
+    if new_count < 0:
+        raise ValueError('Количество шардов не может быть отрицательным')
+
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    ensure_meta_tables(conn)
+    conn.commit()
+
+    old_count = read_shard_count(conn)
+    if old_count == new_count:
+        print(f'Database already has {old_count} shard(s), nothing to do')
+        conn.close()
+        return
+
+    if old_count:
+        sources = [sqlite3.connect(shard_path(db_path, i)) for i in range(old_count)]
+        for source in sources:
+            source.row_factory = sqlite3.Row
+    else:
+        sources = [conn]
+
+    if new_count:
+        new_paths = [shard_path(db_path, i) + '.new' for i in range(new_count)]
+        auto_vacuum = conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+        targets = []
+        for path in new_paths:
+            if os.path.exists(path):
+                os.remove(path)
+            target = sqlite3.connect(path)
+            target.row_factory = sqlite3.Row
+            # Шард наследует режим auto_vacuum основной базы (задается до создания таблиц)
+            target.execute(f'PRAGMA auto_vacuum = {auto_vacuum}')
+            copy_schema(conn, target)
+            targets.append(target)
+    else:
+        new_paths = []
+        targets = [conn]
+
+    post_columns = _columns(targets[0], 'posts')
+    comment_columns = [c for c in _columns(targets[0], 'comments') if c != 'id']
+    vote_columns = [c for c in _columns(targets[0], 'votes') if c != 'id']
+    revision_columns = _columns(targets[0], 'post_revisions')
+
+    moved = {'posts': 0, 'comments': 0, 'votes': 0, 'revisions': 0}
+    registry = []
+
+    for source in sources:
+        post_target = {}
+
+        cursor = source.execute('SELECT * FROM posts ORDER BY id')
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                shard = shard_for(row['community_id'], new_count)
+                _insert(targets[shard], 'posts', row, post_columns)
+                post_target[row['id']] = shard
+                registry.append((row['id'], row['community_id']))
+                moved['posts'] += 1
+
+        # Родительский комментарий всегда имеет меньший id, поэтому его
+        # новый id уже известен к моменту копирования ответа
+        comment_ids = {}
+        cursor = source.execute('SELECT * FROM comments ORDER BY id')
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                shard = post_target.get(row['post_id'], 0)
+                values = dict(row)
+                values['parent_id'] = comment_ids.get(row['parent_id'])
+                comment_ids[row['id']] = _insert(targets[shard], 'comments', values, comment_columns)
+                moved['comments'] += 1
+
+        cursor = source.execute('SELECT * FROM votes ORDER BY id')
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                shard = post_target.get(row['post_id'], 0)
+                _insert(targets[shard], 'votes', row, vote_columns)
+                moved['votes'] += 1
+
+        cursor = source.execute('SELECT * FROM post_revisions ORDER BY post_id, revision')
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                shard = post_target.get(row['post_id'], 0)
+                _insert(targets[shard], 'post_revisions', row, revision_columns)
+                moved['revisions'] += 1
+
+    for target in targets:
+        if target is not conn:
+            target.commit()
+            target.close()
+    for source in sources:
+        if source is not conn:
+            source.close()
+
+    # Переключаем основную базу одной транзакцией
+    if not old_count:
+        for table in ('post_revisions', 'votes', 'comments', 'posts'):
+            conn.execute(f'DELETE FROM {table}')
+    conn.execute('DELETE FROM post_shards')
+    if new_count:
+        conn.executemany('INSERT INTO post_shards (post_id, community_id) VALUES (?, ?)', registry)
+    conn.execute(
+        "INSERT OR REPLACE INTO app_meta (key, value) VALUES ('shard_count', ?)",
+        (str(new_count),)
+    )
+    conn.commit()
+    conn.close()
+
+    for i, path in enumerate(new_paths):
+        os.replace(path, shard_path(db_path, i))
+    for i in range(new_count, old_count):
+        os.remove(shard_path(db_path, i))
+
+    print(f"Resharded {old_count} -> {new_count}: "
+          f"{moved['posts']} posts, {moved['comments']} comments, {moved['votes']} votes, "
+          f"{moved['revisions']} revisions")
+
+    # Счетчики профилей считают посты своего шарда - после переноса их нужно собрать заново
+    import profiles
+    profiles.recount(db_path)
+
+
+def show_status(db_path):
+    """Показывает количество шардов и распределение постов"""
+    if not os.path.exists(db_path):
+        print('Database does not exist!')
+        return
+
+    conn = sqlite3.connect(db_path)
+    count = read_shard_count(conn)
+    conn.close()
+
+    print(f'Shards: {count}')
+    for shard in range(count):
+        shard_conn = sqlite3.connect(shard_path(db_path, shard))
+        posts = shard_conn.execute('SELECT COUNT(*) FROM posts').fetchone()[0]
+        votes = shard_conn.execute('SELECT COUNT(*) FROM votes').fetchone()[0]
+        shard_conn.close()
+        print(f'  shard {shard}: {posts} posts, {votes} votes')
+
+
+def _vote_writer(db_path, shard_count, community_id, post_ids, user_ids, stop_at, counter, lock):
+    import profiles
+
+    if shard_count:
+        conn = connect_shard(db_path, shard_for(community_id, shard_count), timeout=30)
+    else:
+        conn = sqlite3.connect(db_path, timeout=30)
+    writes = 0
+    try:
+        for user_id, post_id in zip(itertools.cycle(user_ids), itertools.cycle(post_ids)):
+            if time.perf_counter() >= stop_at:
+                break
+            conn.execute(
+                'INSERT OR REPLACE INTO votes (user_id, post_id, vote_type) VALUES (?, ?, ?)',
+                (user_id, post_id, 'up')
+            )
+            conn.execute('UPDATE posts SET upvotes = upvotes + 1 WHERE id = ?', (post_id,))
+            # Карма автора, как в vote_post
+            profiles.add(conn, 1, karma=1)
+            conn.commit()
+            writes += 1
+    finally:
+        conn.close()
+    with lock:
+        counter.append(writes)
+
+
+def _bench_run(db_path, shard_count, communities, duration):
+    stop_at = time.perf_counter() + duration
+    counter = []
+    lock = threading.Lock()
+    threads = [
+        threading.Thread(target=_vote_writer,
+                         args=(db_path, shard_count, community_id, post_ids,
+                               range(1, 501), stop_at, counter, lock))
+        for community_id, post_ids in communities.items()
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counter) / (time.perf_counter() - started)
+
+
+def benchmark(shard_count=4, writers=None, duration=3.0):
+    """Сравнивает пропускную способность параллельной записи голосов:
+    один файл против shard_count шардов (по одному писателю на сообщество)"""
+    import init_db
+
+    writers = writers or shard_count
+    results = {}
+    for mode in (0, shard_count):
+        with tempfile.TemporaryDirectory() as tmp:
+            cwd = os.getcwd()
+            os.chdir(tmp)
+            try:
+                with contextlib.redirect_stdout(open(os.devnull, 'w')):
+                    init_db.init_database()
+                db_path = os.path.join(tmp, 'instance', 'app.db')
+
+                conn = sqlite3.connect(db_path)
+                owner = conn.execute('SELECT id FROM users LIMIT 1').fetchone()[0]
+                communities = {}
+                for i in range(writers):
+                    community_id = conn.execute(
+                        'INSERT INTO communities (name, display_name, owner_id) VALUES (?, ?, ?)',
+                        (f'bench{i}', f'Bench {i}', owner)
+                    ).lastrowid
+                    communities[community_id] = [
+                        conn.execute(
+                            'INSERT INTO posts (title, content, user_id, community_id) VALUES (?, ?, ?, ?)',
+                            (f'post {j}', 'bench', owner, community_id)
+                        ).lastrowid
+                        for j in range(20)
+                    ]
+                conn.commit()
+                conn.close()
+
+                if mode:
+                    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+                        reshard(db_path, mode)
+                results[mode] = _bench_run(db_path, mode, communities, duration)
+            finally:
+                os.chdir(cwd)
+
+    print(f'Concurrent vote writers: {writers}, duration: {duration}s')
+    print(f'  single file:  {results[0]:10.1f} writes/s')
+    print(f'  {shard_count} shards:     {results[shard_count]:10.1f} writes/s')
+    print(f'  speedup:      {results[shard_count] / results[0]:10.2f}x')
+    return results
+
+
+if __name__ == '__main__':
+    DATABASE = 'instance/app.db'
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'status':
+        show_status(DATABASE)
+    elif len(sys.argv) > 2 and sys.argv[1] == 'reshard':
+        reshard(DATABASE, int(sys.argv[2]))
+    elif len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 4)
+    else:
+        print("Available commands:")
+        print("  python sharding.py status      - Show shard layout")
+        print("  python sharding.py reshard N   - Move posts/comments/votes to N shards (0 - single file)")
+        print("  python sharding.py bench [N]   - Benchmark concurrent writes: single file vs N shards")
@@ -0,0 +1,239 @@
+"""Поиск почти одинаковых постов по 64-битным отпечаткам SimHash.
+
+Отпечаток строится по шинглам из трех слов заголовка и текста: у
+перепощенного с мелкими правками текста он отличается от оригинала в
+нескольких битах. Отпечатки лежат в post_fingerprints основной базы (общей
+для всех шардов) вместе с четырьмя 16-битными полосами, у каждой свой индекс.
+Если отпечатки отличаются не больше чем в MAX_DISTANCE < 4 битах, хотя бы
+одна полоса совпадает целиком, поэтому проверка нового поста - четыре поиска
+по индексу и сравнение нескольких кандидатов, а не проход по всем постам.
+
+Запуск:
+  python simhash.py backfill [порог]  - отпечатки для постов, у которых их нет
+  python simhash.py rebuild [порог]   - пересчитать все отпечатки заново
+  python simhash.py bench [N]         - время проверки на N случайных отпечатках
+"""
+import hashlib
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+import sharding
+
+BITS = 64
+BANDS = 4
+BAND_BITS = BITS // BANDS
+BAND_MASK = (1 << BAND_BITS) - 1
+
+# Порог по умолчанию: отпечатки, различающиеся не больше чем в стольких битах,
+# считаются дубликатами. Больше BANDS - 1 поиск по полосам находит не все пары
+MAX_DISTANCE = 3
+
+# Сколько слов в шингле и сколько слов нужно, чтобы строить отпечаток:
+# у коротких постов ("Всем привет!") совпадения случайны
+SHINGLE_WORDS = 3
+MIN_WORDS = 8
+
+# Ограничение кандидатов на полосу: частое значение полосы не должно
+# превращать проверку в перебор
+MAX_CANDIDATES = 200
+
+_WORD = re.compile(r'\w+')
+
+# Метрики проверок (читаются из /debug/duplicates)
+simhash_stats = {'checked': 0, 'skipped': 0, 'flagged': 0, 'rejected': 0,
+                 'lookup_seconds': 0.0, 'max_lookup_seconds': 0.0}
+_stats_lock = threading.Lock()
+
+
+def install_post_fingerprints(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS post_fingerprints (
+            post_id INTEGER PRIMARY KEY,
+            fingerprint INTEGER NOT NULL,   -- 64 бита со знаком
+            band0 INTEGER NOT NULL,
+            band1 INTEGER NOT NULL,
+            band2 INTEGER NOT NULL,
+            band3 INTEGER NOT NULL,
+            duplicate_of INTEGER,           -- пост, на который похож этот
+            distance INTEGER
+        )
+    ''')
+    for band in range(BANDS):
+        conn.execute(f'''
+            CREATE INDEX IF NOT EXISTS idx_post_fingerprints_band{band}
+            ON post_fingerprints (band{band})
+        ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_post_fingerprints_duplicate
+        ON post_fingerprints (duplicate_of) WHERE duplicate_of IS NOT NULL
+    ''')
+
+
+def fingerprint(title, content):
+    """64-битный SimHash заголовка и текста или None, если текст слишком короткий"""
+    words = _WORD.findall(f'{title} {content}'.lower())
+    if len(words) < MIN_WORDS:
+        return None
+    weights = [0] * BITS
+    shingles = {' '.join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+    for shingle in shingles:
+        digest = hashlib.blake2b(shingle.encode(), digest_size=8).digest()
+        value = int.from_bytes(digest, 'big')
+        for bit in range(BITS):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    return sum(1 << bit for bit in range(BITS) if weights[bit] > 0)
+
+
+def distance(a, b):
+    # int.bit_count появился только в Python 3.10
+    return bin((a ^ b) & ((1 << BITS) - 1)).count('1')
+
+
+def bands(value):
+    return [value >> (band * BAND_BITS) & BAND_MASK for band in range(BANDS)]
+
+
+def _signed(value):
+    """SQLite хранит INTEGER как 64 бита со знаком"""
+    return value - (1 << BITS) if value >= 1 << (BITS - 1) else value
+
+
+def find_duplicate(conn, value, max_distance=MAX_DISTANCE, before=None):
+    """(post_id, расстояние) ближайшего поста с отпечатком не дальше max_distance или None.
+
+    before - учитывать только посты с меньшим id (для пакетного заполнения).
+    """
+    started = time.perf_counter()
+    found = None
+    for band, band_value in enumerate(bands(value)):
+        sql = f'SELECT post_id, fingerprint FROM post_fingerprints WHERE band{band} = ?'
+        params = [band_value]
+        if before is not None:
+            sql += ' AND post_id < ?'
+            params.append(before)
+        for post_id, other in conn.execute(f'{sql} LIMIT {MAX_CANDIDATES}', params):
+            bits = distance(value, other)
+            if bits <= max_distance and (found is None or (bits, post_id) < (found[1], found[0])):
+                found = (post_id, bits)
+    elapsed = time.perf_counter() - started
+    with _stats_lock:
+        simhash_stats['checked'] += 1
+        simhash_stats['lookup_seconds'] += elapsed
+        simhash_stats['max_lookup_seconds'] = max(simhash_stats['max_lookup_seconds'], elapsed)
+    return found
+
+
+def record(conn, post_id, value, duplicate=None, schema='main'):
+    """Сохраняет отпечаток поста; schema - имя основной базы в соединении (common в шарде)"""
+    duplicate_of, bits = duplicate or (None, None)
+    conn.execute(f'''
+        INSERT OR REPLACE INTO {schema}.post_fingerprints
+            (post_id, fingerprint, band0, band1, band2, band3, duplicate_of, distance)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (post_id, _signed(value), *bands(value), duplicate_of, bits))
+
+
+def count(name):
+    with _stats_lock:
+        simhash_stats[name] += 1
+
+
+def info():
+    with _stats_lock:
+        stats = dict(simhash_stats)
+    total = stats.pop('lookup_seconds')
+    stats['avg_lookup_ms'] = round(total / stats['checked'] * 1000, 3) if stats['checked'] else None
+    stats['max_lookup_ms'] = round(stats.pop('max_lookup_seconds') * 1000, 3)
+    return stats
+
+
+def _post_dbs(db_path):
+    main = sqlite3.connect(db_path)
+    shard_count = sharding.read_shard_count(main)
+    main.close()
+    if not shard_count:
+        return [sqlite3.connect(db_path)]
+    return [sharding.connect_shard(db_path, shard) for shard in range(shard_count)]
+
+
+def backfill(db_path, max_distance=MAX_DISTANCE, rebuild=False):
+    """Строит отпечатки постов без отпечатка (rebuild - всех постов) в порядке id,
+    так что дубликатом помечается более поздний пост. Возвращает (записано, помечено)"""
+    started = time.perf_counter()
+    main = sqlite3.connect(db_path)
+    install_post_fingerprints(main)
+    if rebuild:
+        main.execute('DELETE FROM post_fingerprints')
+    main.commit()
+    known = {row[0] for row in main.execute('SELECT post_id FROM post_fingerprints')}
+
+    # В памяти только id и отпечатки, тексты читаются порциями
+    pending = []
+    for conn in _post_dbs(db_path):
+        try:
+            cursor = conn.execute('SELECT id, title, content FROM posts')
+            while True:
+                rows = cursor.fetchmany(1000)
+                if not rows:
+                    break
+                for post_id, title, content in rows:
+                    if post_id in known:
+                        continue
+                    value = fingerprint(title or '', content or '')
+                    if value is not None:
+                        pending.append((post_id, value))
+        finally:
+            conn.close()
+    pending.sort()
+
+    flagged = 0
+    with main:
+        for post_id, value in pending:
+            duplicate = find_duplicate(main, value, max_distance, before=post_id)
+            if duplicate:
+                flagged += 1
+            record(main, post_id, value, duplicate)
+    main.close()
+
+    print(f"SimHash: {len(pending)} posts fingerprinted, {flagged} flagged as near-duplicates "
+          f"(max distance {max_distance}) in {time.perf_counter() - started:.2f}s")
+    return len(pending), flagged
+
+
+def bench(n=100000, lookups=1000):
+    """Среднее время проверки при n отпечатках в индексе"""
+    conn = sqlite3.connect(':memory:')
+    install_post_fingerprints(conn)
+    rng = random.Random(1)
+    values = [rng.getrandbits(BITS) for _ in range(n)]
+    with conn:
+        for post_id, value in enumerate(values, 1):
+            record(conn, post_id, value)
+    started = time.perf_counter()
+    hits = 0
+    for value in rng.sample(values, min(lookups, n)):
+        # Копия с MAX_DISTANCE измененными битами
+        for bit in rng.sample(range(BITS), MAX_DISTANCE):
+            value ^= 1 << bit
+        hits += find_duplicate(conn, value) is not None
+    elapsed = time.perf_counter() - started
+    print(f"{n} fingerprints: {elapsed / lookups * 1000:.3f} ms per lookup, {hits}/{lookups} found")
+
+
+if __name__ == '__main__':
+    DATABASE = 'instance/app.db'
+
+    if len(sys.argv) in (2, 3) and sys.argv[1] in ('backfill', 'rebuild'):
+        threshold = int(sys.argv[2]) if len(sys.argv) == 3 else MAX_DISTANCE
+        backfill(DATABASE, threshold, rebuild=sys.argv[1] == 'rebuild')
+    elif len(sys.argv) in (2, 3) and sys.argv[1] == 'bench':
+        bench(int(sys.argv[2]) if len(sys.argv) == 3 else 100000)
+    else:
+        print("Available commands:")
+        print("  python simhash.py backfill [max_distance]  - Fingerprint posts that have none")
+        print("  python simhash.py rebuild [max_distance]   - Recompute all fingerprints")
+        print("  python simhash.py bench [n]                - Time lookups against n fingerprints")
@@ -0,0 +1,151 @@
+"""Быстрый старт рабочего процесса.
+
+Раньше каждый запуск импортировал init_db и выполнял update_database(),
+который проверяет каждую таблицу и колонку, а первый запрос к каждой
+странице компилировал ее шаблон. Теперь:
+
+- init_db в конце записывает в PRAGMA user_version версию схемы; при старте
+  читается только это число из заголовка файла, и init_db импортируется,
+  лишь если база отсутствует или ее схема старше SCHEMA_VERSION;
+- скомпилированные шаблоны хранятся в байткод-кэше Jinja на диске
+  (TEMPLATE_CACHE_DIR), общем для всех процессов; precompile заполняет его
+  заранее, например при выкладке.
+
+Запуск:
+  python startup.py precompile   - скомпилировать все шаблоны в байткод-кэш
+  python startup.py bench [N]    - время до первого ответа нового процесса
+"""
+import json
+import os
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from jinja2 import FileSystemBytecodeCache
+
+# Версия схемы базы. Увеличивать при каждом изменении схемы в init_db.py,
+# иначе уже обновленные базы не получат новые таблицы при старте
+SCHEMA_VERSION = 6
+
+
+def schema_version(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute('PRAGMA user_version').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def mark_schema_current(conn):
+    conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+
+def prepare_database(db_path):
+    """Создает или обновляет базу, только если это нужно; возвращает, что сделано"""
+    if not os.path.exists(db_path):
+        import init_db
+
+        init_db.init_database()
+        return 'created'
+    if schema_version(db_path) < SCHEMA_VERSION:
+        import init_db
+
+        init_db.update_database()
+        return 'updated'
+    return 'current'
+
+
+def configure_template_cache(app, directory):
+    """Подключает байткод-кэш шаблонов (до первого обращения к app.jinja_env)"""
+    if not directory:
+        return
+    os.makedirs(directory, exist_ok=True)
+    app.jinja_options = dict(app.jinja_options, bytecode_cache=FileSystemBytecodeCache(directory))
+
+
+def precompile_templates(app):
+    """Загружает все шаблоны: из байткод-кэша, а недостающие компилирует и записывает в него"""
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+# Новый процесс: импорт приложения и первый запрос к главной странице
+_FIRST_RESPONSE = '''
+import json, sys, time
+started = time.perf_counter()
+sys.path.insert(0, {repo!r})
+import app
+imported = time.perf_counter()
+response = app.app.test_client().get('/')
+assert response.status_code == 200, response.status_code
+print(json.dumps({{'import': imported - started, 'request': time.perf_counter() - imported}}))
+'''
+
+
+def _first_response(repo, workdir):
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', _FIRST_RESPONSE.format(repo=repo)], cwd=workdir,
+                            capture_output=True, text=True, check=True).stdout
+    total = time.perf_counter() - started
+    result = json.loads(output.strip().splitlines()[-1])
+    result['total'] = total
+    return result
+
+
+def bench(runs=5):
+    """Медианы времени до первого ответа: без байткод-кэша и с заполненным кэшем"""
+    import app as appmod
+
+    repo = os.path.dirname(os.path.abspath(__file__))
+    cache_dir = appmod.app.config['TEMPLATE_CACHE_DIR']
+    workdir = tempfile.mkdtemp()
+    try:
+        # Отдельная база, чтобы не трогать рабочую; схема уже текущая
+        shutil.copytree(os.path.join(repo, 'templates'), os.path.join(workdir, 'templates'))
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            with open(os.devnull, 'w') as devnull:
+                stdout, sys.stdout = sys.stdout, devnull
+                try:
+                    prepare_database('instance/app.db')
+                finally:
+                    sys.stdout = stdout
+        finally:
+            os.chdir(cwd)
+
+        for mode in ('cold', 'warm'):
+            results = []
+            for _ in range(runs):
+                shutil.rmtree(os.path.join(workdir, cache_dir), ignore_errors=True)
+                if mode == 'warm':
+                    _first_response(repo, workdir)
+                results.append(_first_response(repo, workdir))
+            print(f"{mode:5} (bytecode cache {'filled' if mode == 'warm' else 'empty'}): "
+                  f"total {statistics.median(r['total'] for r in results) * 1000:.0f} ms, "
+                  f"import {statistics.median(r['import'] for r in results) * 1000:.0f} ms, "
+                  f"first request {statistics.median(r['request'] for r in results) * 1000:.0f} ms")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 2 and sys.argv[1] == 'precompile':
+        import app as appmod
+
+        started = time.perf_counter()
+        count = precompile_templates(appmod.app)
+        print(f"Compiled {count} templates into {appmod.app.config['TEMPLATE_CACHE_DIR']} "
+              f"in {time.perf_counter() - started:.2f}s")
+    elif len(sys.argv) in (2, 3) and sys.argv[1] == 'bench':
+        bench(int(sys.argv[2]) if len(sys.argv) == 3 else 5)
+    else:
+        print("Available commands:")
+        print("  python startup.py precompile   - Compile all templates into the bytecode cache")
+        print("  python startup.py bench [n]    - Time to first response of a fresh process")
@@ -0,0 +1,17 @@
+// Подгрузка блоков боковой панели после основного контента страницы.
+// Каждый блок - отдельный URL со своими заголовками кэширования, поэтому
+// браузер и прокси берут его из кэша на следующих страницах.
+(function() {
+    document.addEventListener('DOMContentLoaded', function() {
+        document.querySelectorAll('[data-fragment]').forEach(el => {
+            fetch(el.dataset.fragment, {credentials: 'same-origin'})
+                .then(response => response.ok ? response.text() : '')
+                .then(html => {
+                    if (html) {
+                        el.innerHTML = html;
+                    }
+                })
+                .catch(() => {});
+        });
+    });
+})();
@@ -0,0 +1,49 @@
+// Живые обновления счетчиков постов и новых постов через Server-Sent Events
+(function() {
+    const eventsUrl = document.currentScript.dataset.eventsUrl;
+
+    document.addEventListener('DOMContentLoaded', function() {
+        const cards = document.querySelectorAll('[data-post-id]');
+        const feed = document.querySelector('[data-live-feed]');
+        if (!window.EventSource || (!cards.length && !feed)) {
+            return;
+        }
+
+        // Подписываемся только на посты, которые есть на странице
+        const params = new URLSearchParams();
+        params.set('posts', Array.from(cards, el => el.dataset.postId).join(','));
+        if (feed) {
+            params.set('feed', '1');
+        }
+        const source = new EventSource(eventsUrl + '?' + params.toString());
+
+        function updateCounters(event) {
+            const data = JSON.parse(event.data);
+            document.querySelectorAll('[data-post-id="' + data.post_id + '"] [data-live]').forEach(el => {
+                const field = el.dataset.live;
+                if (field in data) {
+                    el.textContent = data[field];
+                }
+            });
+        }
+
+        source.addEventListener('vote', updateCounters);
+        source.addEventListener('comment', updateCounters);
+
+        let newPosts = 0;
+        source.addEventListener('post', function() {
+            if (!feed) {
+                return;
+            }
+            newPosts += 1;
+            let banner = feed.querySelector('.live-new-posts');
+            if (!banner) {
+                banner = document.createElement('a');
+                banner.className = 'alert alert-info live-new-posts';
+                banner.href = window.location.pathname;
+                feed.insertBefore(banner, feed.querySelector('.post-card'));
+            }
+            banner.textContent = 'Новых постов: ' + newPosts + ' — обновить ленту';
+        });
+    });
+})();
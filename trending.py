@@ -0,0 +1,160 @@
+"""Сообщества "в тренде" по росту подписок.
+
+toggle_subscription в той же транзакции, что и подписку, увеличивает счетчик
+подписок или отписок в часовой корзине subscription_buckets. Рейтинг
+считается по корзинам последней недели (а не по всем подпискам) и хранится
+в памяти процесса: его пересчитывает не чаще раза в refresh секунд первый
+запрос, заставший устаревший список, остальные в это время получают прежний.
+
+Запуск:
+  python trending.py           - пересчитать и показать рейтинг
+  python trending.py backfill  - заполнить корзины по подпискам последней недели
+"""
+import math
+import sqlite3
+import sys
+import threading
+import time
+from collections import namedtuple
+
+HOUR = 3600
+DAY = 86400
+
+# Окна роста: короткое и длинное
+SHORT_WINDOW = DAY
+LONG_WINDOW = 7 * DAY
+
+TrendingCommunity = namedtuple('TrendingCommunity', [
+    'id', 'name', 'display_name', 'subscribers_count', 'growth_day', 'growth_week', 'score',
+])
+
+TRENDING_SQL = '''
+    SELECT c.id, c.name, c.display_name, c.subscribers_count,
+           SUM(CASE WHEN b.bucket >= ? THEN b.joins - b.leaves ELSE 0 END) AS growth_day,
+           SUM(b.joins - b.leaves) AS growth_week
+    FROM subscription_buckets b
+    JOIN communities c ON c.id = b.community_id
+    WHERE b.bucket >= ? AND c.is_public = 1
+    GROUP BY b.community_id
+'''
+
+
+def install_subscription_buckets(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS subscription_buckets (
+            bucket INTEGER NOT NULL,        -- начало часа, unix time
+            community_id INTEGER NOT NULL,
+            joins INTEGER NOT NULL DEFAULT 0,
+            leaves INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (bucket, community_id)
+        ) WITHOUT ROWID
+    ''')
+
+
+def record(cursor, community_id, joined, now=None, count=1, schema='main'):
+    """Учитывает count подписок (joined=True) или отписок в текущей часовой корзине.
+
+    schema - имя основной базы в соединении (common в шарде).
+    """
+    bucket = int(now or time.time()) // HOUR * HOUR
+    column = 'joins' if joined else 'leaves'
+    cursor.execute(f'''
+        INSERT INTO {schema}.subscription_buckets (bucket, community_id, {column}) VALUES (?, ?, ?)
+        ON CONFLICT(bucket, community_id) DO UPDATE SET {column} = {column} + excluded.{column}
+    ''', (bucket, community_id, count))
+
+
+def backfill(conn, now=None):
+    """Заполняет корзины по подпискам длинного окна (отписки в истории не сохранились)"""
+    now = int(now or time.time())
+    conn.execute('DELETE FROM subscription_buckets')
+    conn.execute(f'''
+        INSERT INTO subscription_buckets (bucket, community_id, joins)
+        SELECT CAST(strftime('%s', subscribed_at) AS INTEGER) / {HOUR} * {HOUR} AS hour,
+               community_id, COUNT(*)
+        FROM community_subscriptions
+        WHERE subscribed_at >= datetime(?, 'unixepoch')
+        GROUP BY hour, community_id
+    ''', (now - LONG_WINDOW,))
+    conn.commit()
+
+
+def prune(conn, now=None):
+    """Удаляет корзины, вышедшие из длинного окна"""
+    cutoff = int(now or time.time()) - LONG_WINDOW
+    deleted = conn.execute('DELETE FROM subscription_buckets WHERE bucket < ?', (cutoff,)).rowcount
+    conn.commit()
+    return deleted
+
+
+def score(growth_day, growth_week, subscribers_count):
+    """Рост за сутки плюс средний суточный рост за неделю, деленные на логарифм
+    размера: десять новых подписчиков у сообщества из двадцати весят больше,
+    чем у сообщества из десяти тысяч"""
+    return (growth_day + growth_week / 7) / math.log2(max(subscribers_count, 0) + 2)
+
+
+def compute(conn, k=10, now=None):
+    """Top-k сообществ по росту: один запрос по корзинам длинного окна"""
+    now = int(now or time.time())
+    rows = conn.execute(TRENDING_SQL, (now - SHORT_WINDOW, now - LONG_WINDOW)).fetchall()
+    ranked = []
+    for row in rows:
+        community_id, name, display_name, subscribers, growth_day, growth_week = tuple(row)
+        value = score(growth_day, growth_week, subscribers or 0)
+        if value > 0:
+            ranked.append(TrendingCommunity(community_id, name, display_name, subscribers,
+                                            growth_day, growth_week, round(value, 3)))
+    ranked.sort(key=lambda community: (community.score, community.growth_day), reverse=True)
+    return ranked[:k]
+
+
+class TrendingCache:
+    """Рейтинг в памяти процесса, пересчитывается не чаще раза в refresh секунд"""
+
+    def __init__(self, refresh=300, k=10):
+        self.refresh = refresh
+        self.k = k
+        self.communities = []
+        self.refreshed_at = None
+        self._lock = threading.Lock()
+        self.stats = {'refreshes': 0, 'failures': 0, 'last_duration': None}
+
+    def top(self, conn, n=None):
+        stale = self.refreshed_at is None or time.monotonic() - self.refreshed_at >= self.refresh
+        # Пересчитывает один поток, остальные не ждут и берут прежний список
+        if stale and self._lock.acquire(blocking=False):
+            try:
+                started = time.perf_counter()
+                self.communities = compute(conn, self.k)
+                self.stats['refreshes'] += 1
+                self.stats['last_duration'] = round(time.perf_counter() - started, 4)
+            except sqlite3.OperationalError:
+                # База еще не обновлена через init_db.py update
+                self.stats['failures'] += 1
+            finally:
+                self.refreshed_at = time.monotonic()
+                self._lock.release()
+        return self.communities[:n or self.k]
+
+    def info(self):
+        return dict(self.stats, size=len(self.communities), refresh=self.refresh)
+
+
+if __name__ == '__main__':
+    conn = sqlite3.connect('instance/app.db')
+    try:
+        if len(sys.argv) > 1 and sys.argv[1] == 'backfill':
+            backfill(conn)
+            print(f"Backfilled {conn.execute('SELECT COUNT(*) FROM subscription_buckets').fetchone()[0]} buckets")
+        elif len(sys.argv) == 1:
+            for community in compute(conn):
+                print(f"r/{community.name}: score {community.score}, "
+                      f"{community.growth_day:+d} day / {community.growth_week:+d} week, "
+                      f"{community.subscribers_count} subscribers")
+        else:
+            print("Available commands:")
+            print("  python trending.py            - Show trending communities")
+            print("  python trending.py backfill   - Rebuild buckets from last week's subscriptions")
+    finally:
+        conn.close()